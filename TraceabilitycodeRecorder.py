@@ -1,142 +1,199 @@
-import os
+import time
+
+# webdav3、barcode、ttkbootstrap 导入较慢，在首次使用时才导入
+startup_started = time.perf_counter()
+
 import json
-from webdav3.client import Client
 import tkinter as tk
 from tkinter import ttk
-from ttkbootstrap import Style
-from tkinter import messagebox, simpledialog
-from barcode import Code128
-from barcode.writer import ImageWriter
-from io import BytesIO
-from PIL import ImageTk, Image
+from tkinter import messagebox, simpledialog, filedialog
 import datetime
 import logging
+import threading
+import queue
+import functools
+
+from traceability_core import (
+    TraceabilityService, SalesListener, data_filename, format_import_summary,
+    load_webdav_config, perf_stats, timed,
+)
+from traceability_labels import generate_label_sheets
+
+# 扫码枪
+SCANNER_MAX_KEY_INTERVAL = 0.05  # 扫码枪连续按键的最大间隔（秒）
+SCANNER_IDLE_TIMEOUT_MS = 100  # 没有回车后缀时，停顿这么久视为一次扫码结束
+SCANNER_FLUSH_DELAY_MS = 300  # 扫到的追溯码攒一批再提交
+
+# 销售平台
+SALES_FLUSH_INTERVAL_MS = 500  # 收到的销售事件每隔这么久合并删除一次
+
+# 条形码图像尺寸
+BARCODE_MODULE_WIDTH = 2  # 每个模块的像素宽度
+BARCODE_HEIGHT = 60  # 条高（像素）
+BARCODE_QUIET_ZONE = 10  # 左右留白（模块数）
+BARCODE_CACHE_SIZE = 256  # 缓存的条形码图像数量
+
+
+@functools.lru_cache(maxsize=BARCODE_CACHE_SIZE)
+@timed('render.barcode_image')
+def generate_barcode_image(code, module_width=BARCODE_MODULE_WIDTH, height=BARCODE_HEIGHT):
+    # 生成不含数字的Code128条形码图像：按目标尺寸直接生成一行像素，再纵向平铺到整个图像
+    from barcode import Code128
+    modules = '0' * BARCODE_QUIET_ZONE + Code128(code).build()[0] + '0' * BARCODE_QUIET_ZONE
+    black = ' '.join(['#000000'] * module_width)
+    white = ' '.join(['#ffffff'] * module_width)
+    row = ' '.join(black if module == '1' else white for module in modules)
+    width = len(modules) * module_width
+    image = tk.PhotoImage(width=width, height=height)
+    image.put('{' + row + '}', to=(0, 0, width, height))
+    return image, (width, height)
+
+
+class VirtualListView:
+    """虚拟列表：Listbox 只保存可见的几行，滚动时按需生成，条目再多也不卡
+
+    items 是任意序列，format_row(item) 生成显示文本，双击或回车时调用 on_select(item)。
+    """
+
+    def __init__(self, parent, format_row, on_select, height=15, width=50):
+        self.format_row = format_row
+        self.on_select = on_select
+        self.height = max(height, 1)
+        self.items = []
+        self.top = 0  # 第一个可见条目的位置
+        self.selected = 0
+
+        self.frame = tk.Frame(parent)
+        self.listbox = tk.Listbox(self.frame, height=self.height, width=width, selectmode=tk.SINGLE,
+                                  activestyle='none', exportselection=False)
+        self.scrollbar = tk.Scrollbar(self.frame, orient=tk.VERTICAL, command=self.on_scroll)
+        self.listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+
+        self.listbox.bind('<Button-1>', self.on_click)
+        self.listbox.bind('<Double-Button-1>', self.on_activate)  # 双击选择
+        self.listbox.bind('<Return>', self.on_activate)  # 回车键选择
+        self.listbox.bind('<Up>', lambda event: self.move_selection(-1))  # 上键
+        self.listbox.bind('<Down>', lambda event: self.move_selection(1))  # 下键
+        self.listbox.bind('<Prior>', lambda event: self.move_selection(-self.height))
+        self.listbox.bind('<Next>', lambda event: self.move_selection(self.height))
+        self.listbox.bind('<Home>', lambda event: self.move_selection(-len(self.items)))
+        self.listbox.bind('<End>', lambda event: self.move_selection(len(self.items)))
+        self.listbox.bind('<MouseWheel>', lambda event: self.scroll_by(-1 if event.delta > 0 else 1))
+        self.listbox.bind('<Button-4>', lambda event: self.scroll_by(-1))
+        self.listbox.bind('<Button-5>', lambda event: self.scroll_by(1))
+
+    def set_items(self, items, keep_position=False):
+        self.items = items
+        if keep_position:
+            self.selected = min(self.selected, max(len(items) - 1, 0))
+            self.top = min(self.top, max(len(items) - self.height, 0))
+        else:
+            self.top = 0
+            self.selected = 0
+        self.render()
+
+    def selected_item(self):
+        if 0 <= self.selected < len(self.items):
+            return self.items[self.selected]
+        return None
+
+    @timed('render.list_view')
+    def render(self):
+        self.listbox.delete(0, tk.END)
+        end = min(self.top + self.height, len(self.items))
+        rows = [self.format_row(self.items[i]) for i in range(self.top, end)]
+        if rows:
+            self.listbox.insert(tk.END, *rows)
+        if self.top <= self.selected < end:
+            self.listbox.select_set(self.selected - self.top)
+        if self.items:
+            self.scrollbar.set(self.top / len(self.items), end / len(self.items))
+        else:
+            self.scrollbar.set(0, 1)
+
+    def scroll_to(self, top):
+        self.top = max(0, min(top, len(self.items) - self.height))
+        self.render()
+        return 'break'
 
+    def scroll_by(self, rows):
+        return self.scroll_to(self.top + rows)
 
-# 日志配置
-log_directory = os.path.join(os.environ['USERPROFILE'], 'Documents', 'Traceability code records', 'log')
-os.makedirs(log_directory, exist_ok=True)
-log_filename = os.path.join(log_directory, 'tracker.log')
-logging.basicConfig(filename=log_filename, level=logging.INFO,
-                    format='%(asctime)s - %(levelname)s - %(message)s')
-
-# medicine_data.txt 文件路径
-data_directory = os.path.join(os.environ['USERPROFILE'], 'Documents', 'Traceability code records', 'userdata')
-os.makedirs(data_directory, exist_ok=True)
-data_filename = os.path.join(data_directory, 'medicine_data.txt')
-
-
-def load_webdav_config():
-    with open('webdav_config.json', 'r') as file:
-        config = json.load(file)
-        # print("Loaded WebDAV configuration:", config)
-        # logging.info("Loaded WebDAV configuration: %s", config)
-        return config
-
-
-def read_data_from_webdav(filename):
-    config = load_webdav_config()
-    client = Client(config)
-    print("Connecting to WebDAV...")
-    logging.info("Connecting to WebDAV...")
-    try:
-        client.download_sync(remote_path=f'{config["webdav_root"]}{filename}', local_path=filename)
-        print(f"Downloaded '{filename}' from WebDAV.")
-        logging.info(f"Downloaded '{filename}' from WebDAV.")
-        data = read_data(filename)
-        client.clean(local_path=filename)
-        print(f"Cleared temporary file '{filename}'.")
-        logging.info(f"Cleared temporary file '{filename}'.")
-        return data
-    except Exception as e:
-        print(f"Error reading data from WebDAV: {e}")
-        logging.error(f"Error reading data from WebDAV: {e}")
-        return {}
-
-
-def write_data_to_webdav(filename, data):
-    config = load_webdav_config()
-    client = Client(config)
-    print("Connecting to WebDAV...")
-    logging.info("Connecting to WebDAV...")
-    try:
-        write_data(filename, data)
-        client.upload_sync(remote_path=f'{config["webdav_root"]}{filename}', local_path=filename)
-        print(f"Uploaded '{filename}' to WebDAV.")
-        logging.info(f"Uploaded '{filename}' to WebDAV.")
-        client.clean(local_path=filename)
-        print(f"Cleared temporary file '{filename}'.")
-        logging.info(f"Cleared temporary file '{filename}'.")
-    except Exception as e:
-        print(f"Error writing data to WebDAV: {e}")
-        logging.error(f"Error writing data to WebDAV: {e}")
-
-
-def read_data(filename):
-    data = {}
-    try:
-        with open(filename, 'r') as file:
-            for line in file:
-                parts = line.strip().split(',')
-                barcode = parts[0]
-                data[barcode] = parts[1:]
-        return data
-    except FileNotFoundError:
-        return {}
-
-
-def write_data(filename, data):
-    with open(filename, 'w') as file:
-        for barcode, values in data.items():
-            line = f"{barcode},{','.join(values)}\n"
-            file.write(line)
-
-
-def generate_barcode_image(code):
-    # 生成不含数字的Code128条形码图像
-    code128 = Code128(code, writer=ImageWriter())
-    buffer = BytesIO()
-    code128.write(buffer, options={"write_text": False, "module_width": 0.3, "module_height": 10})
-    buffer.seek(0)
-    img = Image.open(buffer)
-    img = img.resize((img.width // 2, img.height // 2), Image.LANCZOS)
-    return ImageTk.PhotoImage(img), img.size
-
-
-def check_webdav_connection(filename):
-    """检查WebDAV连接并读取数据文件"""
-    config = load_webdav_config()
-    client = Client(config)
-    try:
-        # 尝试下载文件
-        client.download_sync(remote_path=f'{config["webdav_root"]}{filename}', local_path=filename)
-        data = read_data(filename)
-        client.clean(local_path=filename)
-        print(f"WebDAV connection successful.")
-        logging.info(f"WebDAV connection successful.")
-        return True, data
-    except Exception as e:
-        # print(f"Error checking WebDAV connection: {e}")
-        # logging.error(f"Error checking WebDAV connection: {e}")
-        return False, {}
+    def on_scroll(self, action, amount, unit=None):
+        # 滚动条回调：moveto 按比例定位，scroll 按行或按页滚动
+        if action == 'moveto':
+            self.scroll_to(int(float(amount) * len(self.items)))
+        else:
+            self.scroll_by(int(amount) * (self.height if unit == 'pages' else 1))
+
+    def move_selection(self, delta):
+        if self.items:
+            self.selected = max(0, min(self.selected + delta, len(self.items) - 1))
+            # 让选中项保持可见
+            if self.selected < self.top:
+                self.top = self.selected
+            elif self.selected >= self.top + self.height:
+                self.top = self.selected - self.height + 1
+            self.render()
+        return 'break'
+
+    def on_click(self, event):
+        index = self.listbox.nearest(event.y)
+        if self.top + index < len(self.items):
+            self.selected = self.top + index
+            self.render()
+        self.listbox.focus_set()
+        return 'break'
+
+    def on_activate(self, event):
+        item = self.selected_item()
+        if item is not None:
+            self.on_select(item)
+        return 'break'
 
 
 class MedicineTrackerApp:
     def __init__(self, root, filename):
         self.root = root
         self.filename = filename
-        self.data = None
         self.last_searched_barcode = None
+        self.connection_status_label = None
+        self.sync_status = None
+        self.check_results = queue.Queue()
+        self.import_button = None
+        self.export_button = None
+        self.label_button = None
+        self.io_status_label = None
+        self.scanner_mode = False
+        self.last_key_time = 0
+        self.burst_length = 0
+        self.scan_pending = {}  # 待提交的追溯码 -> 条形码
+        self.scan_idle_timer = None
+        self.scan_flush_timer = None
+        self.scan_flash_timer = None
+        self.sales_listener = None
+        self.sales_timer = None
         root.resizable(False, False)
         root.iconbitmap('app_icon.ico')
 
-
-        # 检查WebDAV连接
-        self.webdav_connected, self.data = check_webdav_connection(self.filename)
-        if not self.webdav_connected:
-            # 如果WebDAV连接失败，尝试从本地读取数据
-            self.data = read_data(self.filename)
-
+        # 先从本地快照和日志读取数据，界面立即可用；存储、日志、索引和同步都由核心服务管理
+        try:
+            self.service = TraceabilityService(self.filename, background=True, echo=True)
+        except ValueError as e:
+            # 命令行或另一个界面正在使用数据
+            logging.error(f"Failed to open data: {e}")
+            messagebox.showerror("错误", str(e))
+            root.destroy()
+            raise SystemExit(1)
+        self.config = self.service.config
+        self.data = self.service.data
+        self.trace_index = self.service.trace_index
+
+        # 在后台检查WebDAV连接（远端未变化时不下载），上传也在后台线程进行
+        self.start_webdav_check()
+        self.root.after(200, self.poll_sync_status)
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
 
 
         # 设置窗口标题
@@ -149,6 +206,7 @@ class MedicineTrackerApp:
         self.barcode_entry.grid(row=0, column=0, pady=10, padx=20, sticky='ew')  # 使用grid布局
         self.barcode_entry.focus_set()  # 默认焦点
         self.barcode_entry.bind('<Return>', self.on_search_or_add_traceability)
+        self.barcode_entry.bind('<Key>', self.on_entry_key)
 
         # 添加追溯码按钮
         self.add_traceability_button = tk.Button(root, text="添加追溯码", command=self.on_add_traceability)
@@ -168,9 +226,12 @@ class MedicineTrackerApp:
         self.medication_label.grid(row=2, column=0, columnspan=2, pady=10)  # 使用grid布局
 
         # 显示追溯码列表
-        self.traceability_listbox = tk.Listbox(root, width=50)
-        self.traceability_listbox.grid(row=3, column=0, columnspan=2, pady=10)  # 使用grid布局
-        self.traceability_listbox.bind('<Double-Button-1>', self.on_copy_and_delete)
+        self.traceability_list = VirtualListView(root, str, self.on_copy_and_delete, height=10)
+        self.traceability_list.frame.grid(row=3, column=0, columnspan=2, pady=10)  # 使用grid布局
+
+        # 扫码模式的提示
+        self.scan_status_label = tk.Label(root, text="", bg='white')
+        self.scan_status_label.grid(row=4, column=0, columnspan=2)
 
         # 设置主窗口的背景颜色
         self.root.configure(bg='white')
@@ -180,6 +241,36 @@ class MedicineTrackerApp:
         self.settings_button = tk.Button(root, text="设置", command=self.open_settings_window)
         self.settings_button.grid(row=7, column=0, columnspan=2, pady=5)  # 使用grid布局
 
+        self.root.after_idle(self.report_startup_time)
+
+    def report_startup_time(self):
+        # 记录冷启动耗时，超过目标时间时给出警告
+        elapsed_ms = (time.perf_counter() - startup_started) * 1000
+        perf_stats.record('app.startup', elapsed_ms)
+        target_ms = self.config['startup_time_target_ms']
+        if elapsed_ms > target_ms:
+            logging.warning(f"Startup took {elapsed_ms:.0f} ms, exceeding the {target_ms} ms target.")
+        else:
+            logging.info(f"Startup took {elapsed_ms:.0f} ms.")
+        print(f"Startup took {elapsed_ms:.0f} ms.")
+
+    def start_webdav_check(self):
+        self.service.webdav_checking = True
+        webdav_sync = self.service.webdav_sync
+        threading.Thread(target=lambda: self.check_results.put(webdav_sync.check()), daemon=True).start()
+
+    def on_webdav_checked(self, connected, remote_data, changes):
+        # 连接检查完成：由核心服务合并远端数据和检查期间的本地修改
+        self.refresh_changed(self.service.on_webdav_checked(connected, remote_data, changes))
+        self.update_connection_status()
+        # 合并远端修改后再归档冷数据，是否仍在库以合并后的数据为准
+        self.service.archive_if_due()
+
+    def refresh_changed(self, barcodes):
+        # 正在显示的药品被修改时刷新
+        if self.last_searched_barcode in barcodes and self.last_searched_barcode in self.data:
+            self.display_info(self.last_searched_barcode)
+
     def open_settings_window(self):
         settings_window = tk.Toplevel(self.root)
         settings_window.title("设置")
@@ -220,6 +311,16 @@ class MedicineTrackerApp:
         notebook.add(io_tab, text="导入导出")
         self.create_io_interface(io_tab)
 
+        # 统计标签页
+        stats_tab = ttk.Frame(notebook)
+        notebook.add(stats_tab, text="统计")
+        self.create_stats_interface(stats_tab)
+
+        # 诊断标签页
+        diagnostics_tab = ttk.Frame(notebook)
+        notebook.add(diagnostics_tab, text="诊断")
+        self.create_diagnostics_interface(diagnostics_tab)
+
         # 关于标签页
         about_tab = ttk.Frame(notebook)
         notebook.add(about_tab, text="关于")
@@ -227,12 +328,14 @@ class MedicineTrackerApp:
 
     def create_lab_interface(self, parent):
         # 监听扫码枪
-        checkbox_var = tk.BooleanVar()
-        ttk.Checkbutton(parent, text="监听扫码枪", variable=checkbox_var).pack(pady=5)
+        scanner_var = tk.BooleanVar(value=self.scanner_mode)
+        ttk.Checkbutton(parent, text="监听扫码枪", variable=scanner_var,
+                        command=lambda: self.set_scanner_mode(scanner_var.get())).pack(pady=5)
 
         # 监听销售平台
-        checkbox_var = tk.BooleanVar()
-        ttk.Checkbutton(parent, text="监听销售平台", variable=checkbox_var).pack(pady=5)
+        sales_var = tk.BooleanVar(value=self.sales_listener is not None)
+        ttk.Checkbutton(parent, text="监听销售平台", variable=sales_var,
+                        command=lambda: sales_var.set(self.set_sales_listener(sales_var.get()))).pack(pady=5)
 
         # 连接状态
         self.connection_status_label = ttk.Label(parent, text="", font=("Arial", 10))
@@ -240,10 +343,58 @@ class MedicineTrackerApp:
         self.update_connection_status()
 
     def update_connection_status(self):
-        if self.webdav_connected:
-            self.connection_status_label.config(text="已成功连接WebDAV服务器", foreground="green")
-        else:
+        # 设置窗口未打开时没有状态标签
+        if self.connection_status_label is None or not self.connection_status_label.winfo_exists():
+            return
+        if self.service.webdav_checking:
+            self.connection_status_label.config(text="正在连接WebDAV服务器...", foreground="orange")
+        elif not self.service.webdav_connected:
             self.connection_status_label.config(text="未连接WebDAV服务器", foreground="red")
+        elif self.sync_status is not None:
+            text, color = self.sync_status
+            self.connection_status_label.config(text=text, foreground=color)
+        else:
+            self.connection_status_label.config(text="已成功连接WebDAV服务器", foreground="green")
+
+    def poll_sync_status(self):
+        # 在界面线程中读取后台同步线程的状态
+        changed = False
+        try:
+            connected, remote_data, changes = self.check_results.get_nowait()
+            self.on_webdav_checked(connected, remote_data, changes)
+        except queue.Empty:
+            pass
+        while True:
+            try:
+                state, count = self.service.sync_worker.statuses.get_nowait()
+            except queue.Empty:
+                break
+            if state == 'remote':
+                remote_data, changes = count
+                if remote_data is not None:
+                    self.on_webdav_checked(True, remote_data, [])
+                else:
+                    self.refresh_changed(self.service.apply_remote_changes(changes))
+                continue
+            changed = True
+            if state == 'syncing':
+                self.sync_status = (f"正在同步 {count} 条修改...", "orange")
+            elif state == 'synced':
+                count, pushed = count
+                self.service.webdav_sync.acknowledge(pushed)
+                self.sync_status = (f"已同步 {count} 条修改到WebDAV服务器", "green")
+            else:
+                self.sync_status = (f"同步失败，{count} 条修改等待重试", "red")
+        if changed:
+            self.update_connection_status()
+        self.root.after(200, self.poll_sync_status)
+
+    def on_close(self):
+        # 退出前保存扫到的追溯码和收到的销售事件，并尽量把未上传的修改同步完
+        self.set_sales_listener(False)
+        self.flush_scans()
+        self.service.close()
+        self.root.destroy()
 
     def create_login_interface(self, parent):
         style = ttk.Style()
@@ -315,19 +466,246 @@ class MedicineTrackerApp:
             json.dump(config, file, indent=4)
 
         # 更新连接状态
-        self.webdav_connected = check_webdav_connection(config)
+        self.service.reset_webdav()
+        self.sync_status = None
+        self.start_webdav_check()
         self.update_connection_status()
 
     def create_io_interface(self, parent):
         # 设置居中布局
         parent.columnconfigure(0, weight=1)
 
-        import_button = ttk.Button(parent, text="导入")
-        import_button.pack(pady=5)
+        self.import_button = ttk.Button(parent, text="导入", command=self.start_import)
+        self.import_button.pack(pady=5)
+
+        self.export_button = ttk.Button(parent, text="导出", command=self.start_export)
+        self.export_button.pack(pady=5)
+
+        self.label_button = ttk.Button(parent, text="打印当前药品的追溯码标签", command=self.start_labels)
+        self.label_button.pack(pady=5)
 
-        export_button = ttk.Button(parent, text="导出")
-        export_button.pack(pady=5)
+        # 进度
+        self.io_progress = ttk.Progressbar(parent, length=300, maximum=100)
+        self.io_progress.pack(pady=5)
+        self.io_status_label = ttk.Label(parent, text="", wraplength=360)
+        self.io_status_label.pack(padx=10, pady=5)
 
+    def update_io_status(self, text, percent=None):
+        # 设置窗口关闭后导入导出仍在后台进行，只是不再显示进度
+        if self.io_status_label is None or not self.io_status_label.winfo_exists():
+            return
+        self.io_status_label.config(text=text)
+        if percent is not None:
+            self.io_progress['value'] = percent
+
+    def set_io_buttons_state(self, state):
+        for button in (self.import_button, self.export_button, self.label_button):
+            if button is not None and button.winfo_exists():
+                button.config(state=state)
+
+    def start_import(self):
+        filename = filedialog.askopenfilename(title="选择导入文件",
+                                              filetypes=[("CSV/JSONL 文件", "*.csv *.jsonl *.json"), ("所有文件", "*.*")])
+        if not filename:
+            return
+        progress = queue.Queue()
+
+        def run_import():
+            # 读取、查重和提交都在后台线程，界面只接收进度和最后的统计
+            try:
+                stats = self.service.import_file(
+                    filename, lambda done, total, stats: progress.put(
+                        ('progress', (done * 100 / max(total, 1), stats['imported']))))
+                progress.put(('done', stats))
+            except Exception as e:
+                logging.error(f"Failed to import '{filename}': {e}")
+                progress.put(('error', e))
+
+        self.set_io_buttons_state(tk.DISABLED)
+        self.update_io_status("正在导入...", 0)
+        threading.Thread(target=run_import, daemon=True).start()
+        self.root.after(50, self.poll_import, progress)
+
+    def poll_import(self, progress):
+        while True:
+            try:
+                kind, value = progress.get_nowait()
+            except queue.Empty:
+                break
+            if kind == 'error':
+                self.finish_import(f"导入失败: {value}")
+                messagebox.showerror("错误", f"无法导入文件: {value}")
+                return
+            if kind == 'done':
+                self.finish_import(format_import_summary(value))
+                return
+            percent, imported = value
+            self.update_io_status(f"正在导入... 已新增 {imported} 个追溯码", percent)
+        self.root.after(50, self.poll_import, progress)
+
+    def finish_import(self, message):
+        logging.info(message)
+        self.set_io_buttons_state(tk.NORMAL)
+        self.update_io_status(message, 100)
+        if self.last_searched_barcode in self.data:
+            self.display_info(self.last_searched_barcode)
+
+    def start_export(self):
+        filename = filedialog.asksaveasfilename(title="导出到", defaultextension=".csv",
+                                                filetypes=[("CSV 文件", "*.csv"), ("JSONL 文件", "*.jsonl")])
+        if not filename:
+            return
+        progress = queue.Queue()
+
+        def export():
+            try:
+                count = self.service.export(filename,
+                                            lambda done, total: progress.put(('progress', done * 100 / max(total, 1))))
+                progress.put(('done', f"导出完成：共 {count} 个追溯码"))
+            except Exception as e:
+                progress.put(('done', f"导出失败: {e}"))
+
+        def poll_export():
+            while True:
+                try:
+                    kind, value = progress.get_nowait()
+                except queue.Empty:
+                    break
+                if kind == 'done':
+                    logging.info(value)
+                    self.set_io_buttons_state(tk.NORMAL)
+                    self.update_io_status(value, 100)
+                    return
+                self.update_io_status("正在导出...", value)
+            self.root.after(50, poll_export)
+
+        self.set_io_buttons_state(tk.DISABLED)
+        self.update_io_status("正在导出...", 0)
+        threading.Thread(target=export, daemon=True).start()
+        self.root.after(50, poll_export)
+
+    def start_labels(self):
+        # 当前药品的全部追溯码排成标签页，在后台线程中用多个进程渲染
+        barcode = self.last_searched_barcode
+        if barcode not in self.data or len(self.data[barcode]) < 2:
+            messagebox.showwarning("警告", "请先查询有追溯码的条形码")
+            return
+        filename = filedialog.asksaveasfilename(title="标签保存到", defaultextension=".pdf",
+                                                filetypes=[("PDF 文件", "*.pdf"), ("PNG 图像", "*.png")])
+        if not filename:
+            return
+        codes = list(self.data[barcode].codes())
+        progress = queue.Queue()
+
+        def generate():
+            try:
+                filenames = generate_label_sheets(
+                    codes, filename, progress=lambda done: progress.put(('progress', done * 100 / len(codes))))
+                progress.put(('done', f"已生成 {len(codes)} 个标签：{filenames[0]}"
+                                      + (f" 等 {len(filenames)} 个文件" if len(filenames) > 1 else "")))
+            except Exception as e:
+                progress.put(('done', f"生成标签失败: {e}"))
+
+        def poll_labels():
+            while True:
+                try:
+                    kind, value = progress.get_nowait()
+                except queue.Empty:
+                    break
+                if kind == 'done':
+                    logging.info(value)
+                    self.set_io_buttons_state(tk.NORMAL)
+                    self.update_io_status(value, 100)
+                    return
+                self.update_io_status("正在生成标签...", value)
+            self.root.after(50, poll_labels)
+
+        self.set_io_buttons_state(tk.DISABLED)
+        self.update_io_status("正在生成标签...", 0)
+        threading.Thread(target=generate, daemon=True).start()
+        self.root.after(50, poll_labels)
+
+    def create_stats_interface(self, parent):
+        # 库存统计：读取随修改增量更新的汇总，不扫描数据和日志
+        summary_label = ttk.Label(parent)
+        summary_label.pack(pady=(5, 0))
+        views = {"在库最多": ("药品名称", "条形码", "在库"), "滞销": ("药品名称", "在库", "最近删除"),
+                 "每日进出": ("日期", "添加", "删除")}
+        view = tk.StringVar(value="在库最多")
+        selector = ttk.Combobox(parent, textvariable=view, values=list(views), state='readonly', width=10)
+        selector.pack(pady=5)
+        tree = ttk.Treeview(parent, columns=('a', 'b', 'c'), show='headings', height=7)
+        for column, width in zip(('a', 'b', 'c'), (150, 110, 110)):
+            tree.column(column, width=width, anchor=tk.W if column == 'a' else tk.E)
+        tree.pack(fill=tk.BOTH, expand=True, padx=5, pady=(0, 5))
+
+        def refresh(event=None):
+            stats = self.service.stats
+            medications, on_hand = stats.summary()
+            summary_label.config(text=f"药品 {medications} 种，在库追溯码 {on_hand} 个")
+            for column, text in zip(('a', 'b', 'c'), views[view.get()]):
+                tree.heading(column, text=text)
+            tree.delete(*tree.get_children())
+            if view.get() == "在库最多":
+                rows = [(medication, barcode, count) for barcode, medication, count in stats.top_stock()]
+            elif view.get() == "滞销":
+                rows = [(medication, count, last_deleted or "从未")
+                        for barcode, medication, count, last_deleted in stats.slowest()]
+            else:
+                rows = stats.recent_days()
+            for row in rows:
+                tree.insert('', tk.END, values=row)
+
+        selector.bind('<<ComboboxSelected>>', refresh)
+        parent.bind('<Visibility>', refresh)  # 切换到该标签页时刷新
+        refresh()
+
+    def create_diagnostics_interface(self, parent):
+        # 各项热点操作的耗时统计（毫秒）
+        columns = ('count', 'mean', 'p50', 'p95', 'max', 'slow')
+        tree = ttk.Treeview(parent, columns=columns, height=8)
+        tree.heading('#0', text="操作")
+        tree.column('#0', width=110)
+        for column, text in zip(columns, ("次数", "平均", "p50", "p95", "最大", "慢")):
+            tree.heading(column, text=text)
+            tree.column(column, width=44, anchor=tk.E)
+        tree.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+
+        buttons = ttk.Frame(parent)
+        buttons.pack(pady=5)
+        ttk.Button(buttons, text="刷新", command=lambda: self.refresh_diagnostics(tree)).pack(side=tk.LEFT, padx=5)
+        ttk.Button(buttons, text="导出", command=self.export_diagnostics).pack(side=tk.LEFT, padx=5)
+        ttk.Button(buttons, text="清空",
+                   command=lambda: (perf_stats.reset(), self.refresh_diagnostics(tree))).pack(side=tk.LEFT, padx=5)
+        self.refresh_diagnostics(tree)
+
+    def refresh_diagnostics(self, tree):
+        tree.delete(*tree.get_children())
+        summary = perf_stats.summary()
+        # 总耗时最多的排在前面
+        for name in sorted(summary, key=lambda name: -summary[name]['mean_ms'] * summary[name]['count']):
+            stats = summary[name]
+            tree.insert('', tk.END, text=name, values=(
+                stats['count'], f"{stats['mean_ms']:.1f}", f"{stats['p50_ms']:.1f}",
+                f"{stats['p95_ms']:.1f}", f"{stats['max_ms']:.0f}", stats['slow']))
+
+    def export_diagnostics(self):
+        filename = filedialog.asksaveasfilename(title="导出诊断信息", defaultextension=".json",
+                                                filetypes=[("JSON 文件", "*.json")])
+        if not filename:
+            return
+        report = {
+            'created': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            'slow_operation_ms': perf_stats.slow_threshold_ms,
+            'storage_mode': self.config['storage_mode'],
+            'webdav_connected': self.service.webdav_connected,
+            'records': len(self.data),
+            'operations': perf_stats.summary(),
+        }
+        with open(filename, 'w', encoding='utf-8') as file:
+            json.dump(report, file, ensure_ascii=False, indent=4)
+        logging.info(f"Exported diagnostics to '{filename}'.")
+        messagebox.showinfo("提示", f"诊断信息已导出到 {filename}")
 
     def create_about_interface(self, parent):
         # 设置居中布局
@@ -340,17 +718,16 @@ class MedicineTrackerApp:
         version_label = ttk.Label(parent, text=f"版本: {version_number}")
         version_label.pack(pady=5)
 
+    @timed('render.show_all')
     def show_all_medications(self):
         # 创建一个顶级窗口来显示所有药品信息
         all_medications_window = tk.Toplevel(self.root)
         all_medications_window.title("所有药品信息")
 
-        # 计算弹窗大小
-        item_height = 20  # 每个项目的高度
+        # 固定弹窗大小，条目再多也只显示可见的几行
+        window_width = 400
+        window_height = 360
         padding = 10  # 内边距
-        border_width = 2  # 边框宽度
-        window_width = 400  # 固定宽度
-        window_height = (len(self.data) * item_height) + (padding * 2) + border_width * 2
 
         # 居中显示弹窗
         screen_width = all_medications_window.winfo_screenwidth()
@@ -359,37 +736,46 @@ class MedicineTrackerApp:
         y = (screen_height - window_height) // 2
         all_medications_window.geometry(f"{window_width}x{window_height}+{x+30}+{y-20}")
 
-        all_medications_listbox = tk.Listbox(all_medications_window, selectmode=tk.SINGLE, width=50,
-                                             height=len(self.data))
-        all_medications_listbox.pack(padx=padding, pady=padding, fill=tk.BOTH, expand=True)
-
-        for barcode, (medication, *traceabilities) in self.data.items():
-            info_text = f"条形码: {barcode}  \n追溯码数量: {len(traceabilities)}  \n药品名称: {medication}"
-            all_medications_listbox.insert(tk.END, info_text)
-
-        # 默认选择第一个项目
-        all_medications_listbox.select_set(0)  # 选择第一个项目
-        all_medications_listbox.event_generate("<<ListboxSelect>>")  # 触发选择事件
-
-        def on_select(event):
-            selected_index = all_medications_listbox.curselection()
-            if selected_index:
-                index = selected_index[0]
-                barcode, (medication, *traceabilities) = list(self.data.items())[index]
-                self.display_info(barcode)
-                self.last_searched_barcode = barcode
-                all_medications_window.destroy()
-
-        all_medications_listbox.bind('<<ListboxSelect>>', lambda event: None)  # 避免默认选择行为
-        all_medications_listbox.bind('<Double-Button-1>', lambda event: on_select(event))  # 双击选择
-        all_medications_listbox.bind('<Return>', lambda event: on_select(event))  # 回车键选择
-        all_medications_listbox.bind('<Up>',
-                                     lambda event: self.handle_up_down_key(all_medications_listbox, event))  # 上键
-        all_medications_listbox.bind('<Down>',
-                                     lambda event: self.handle_up_down_key(all_medications_listbox, event))  # 下键
-        all_medications_listbox.focus_set()  # 设置焦点
+        # 过滤输入框：输入条形码或药品名称的一部分
+        filter_entry = tk.Entry(all_medications_window)
+        filter_entry.pack(padx=padding, pady=(padding, 0), fill=tk.X)
+
+        def on_select(barcode):
+            self.display_info(barcode)
+            self.last_searched_barcode = barcode
+            all_medications_window.destroy()
+
+        medications_list = VirtualListView(all_medications_window, self.format_medication_row, on_select)
+        medications_list.frame.pack(padx=padding, pady=padding, fill=tk.BOTH, expand=True)
+        # 过滤只比较名称，打开窗口时取一次，不解析每条记录的追溯码
+        names = {barcode: medication.lower() for barcode, medication in self.service.medication_names().items()}
+        all_barcodes = list(names)
+        medications_list.set_items(all_barcodes)
+
+        last_term = ['']
+
+        def on_filter(event):
+            term = filter_entry.get().strip().lower()
+            if term == last_term[0]:
+                return
+            # 在上次结果的基础上继续缩小范围，删减输入时再从全部条目过滤
+            source = medications_list.items if last_term[0] and term.startswith(last_term[0]) else all_barcodes
+            last_term[0] = term
+            if term:
+                items = [barcode for barcode in source if term in barcode or term in names[barcode]]
+            else:
+                items = all_barcodes
+            medications_list.set_items(items)
+
+        filter_entry.bind('<KeyRelease>', on_filter)
+        filter_entry.bind('<Down>', lambda event: medications_list.listbox.focus_set())
+        medications_list.listbox.focus_set()  # 设置焦点
         all_medications_window.bind('<Escape>', lambda event: all_medications_window.destroy())
 
+    def format_medication_row(self, barcode):
+        medication, count = self.service.summary(barcode)
+        return f"{medication}    条形码: {barcode}    追溯码数量: {count}"
+
     def center_window(self, window):
         # 获取屏幕尺寸
         screen_width = window.winfo_screenwidth()
@@ -400,7 +786,142 @@ class MedicineTrackerApp:
         y = (screen_height - 420) // 2  # 调整窗口高度
         window.geometry(f"400x420+{x}+{y}")  # 调整窗口高度
 
+    def set_scanner_mode(self, enabled):
+        self.scanner_mode = enabled
+        if enabled:
+            self.scan_feedback(True, "扫码模式：先扫条形码，再连续扫追溯码")
+            self.barcode_entry.focus_set()
+        else:
+            self.flush_scans()
+            self.scan_status_label.config(text="")
+
+    def on_entry_key(self, event):
+        # 记录按键间隔：扫码枪模拟的键盘输入比人手快得多
+        if not event.char or not event.char.isprintable():
+            return
+        now = event.time / 1000  # 事件自带的时间戳，界面繁忙时也不受排队影响
+        if 0 <= now - self.last_key_time <= SCANNER_MAX_KEY_INTERVAL:
+            self.burst_length += 1
+        else:
+            self.burst_length = 1
+        self.last_key_time = now
+        if self.scanner_mode:
+            # 没有回车后缀的扫码枪：停顿片刻后视为一次扫码结束
+            if self.scan_idle_timer is not None:
+                self.root.after_cancel(self.scan_idle_timer)
+            self.scan_idle_timer = self.root.after(SCANNER_IDLE_TIMEOUT_MS, self.on_scan_idle)
+
+    def is_scanner_burst(self, text):
+        return text.isdigit() and len(text) in (13, 20) and self.burst_length >= len(text)
+
+    def on_scan_idle(self):
+        self.scan_idle_timer = None
+        text = self.barcode_entry.get().strip()
+        if self.is_scanner_burst(text):
+            self.handle_scan(text)
+
+    def handle_scan(self, text):
+        # 13位为条形码，20位为追溯码；全程不弹出对话框
+        if self.scan_idle_timer is not None:
+            self.root.after_cancel(self.scan_idle_timer)
+            self.scan_idle_timer = None
+        self.barcode_entry.delete(0, tk.END)
+        self.burst_length = 0
+        if len(text) == 13:
+            if text in self.data:
+                self.display_info(text)
+                self.last_searched_barcode = text
+                self.scan_feedback(True, f"条形码: {text}  {self.data[text][0]}")
+            else:
+                self.scan_feedback(False, f"未找到条形码 {text}，请先手动创建记录")
+            return
+
+        barcode = self.last_searched_barcode
+        if barcode is None:
+            self.scan_feedback(False, "请先扫描条形码")
+            return
+        owner = self.trace_index.barcode_of(text)
+        if (text in self.scan_pending or text in self.data[barcode]
+                or (owner is not None and owner in self.data and text in self.data[owner])):
+            self.scan_feedback(False, f"重复的追溯码: {text}")
+            return
+        if self.service.seen_before(text) and not self.config['scanner_accept_seen_before']:
+            self.scan_feedback(False, f"该追溯码已于 {self.find_traceability_date(text)} 添加过: {text}")
+            return
+        self.scan_pending[text] = barcode
+        self.scan_feedback(True, f"已扫描 {len(self.scan_pending)} 个待保存: {text}")
+        if self.scan_flush_timer is None:
+            self.scan_flush_timer = self.root.after(SCANNER_FLUSH_DELAY_MS, self.flush_scans)
+
+    def flush_scans(self):
+        # 把攒下的追溯码一次性提交
+        if self.scan_flush_timer is not None:
+            self.root.after_cancel(self.scan_flush_timer)
+            self.scan_flush_timer = None
+        if not self.scan_pending:
+            return
+        operations = [('ADD', barcode, traceability, None) for traceability, barcode in self.scan_pending.items()]
+        self.scan_pending = {}
+        self.service.commit_operations(operations)
+        if self.last_searched_barcode in self.data:
+            self.display_info(self.last_searched_barcode)
+
+    def scan_feedback(self, accepted, message):
+        # 用颜色和提示音反馈扫码结果
+        self.scan_status_label.config(text=message, fg='green' if accepted else 'red')
+        self.barcode_entry.config(bg='#d8f5d8' if accepted else '#f8d0d0')
+        if not accepted:
+            self.root.bell()
+        if self.scan_flash_timer is not None:
+            self.root.after_cancel(self.scan_flash_timer)
+        self.scan_flash_timer = self.root.after(300, lambda: self.barcode_entry.config(bg='white'))
+
+    def set_sales_listener(self, enabled):
+        """启动或停止销售平台监听，返回监听是否在运行"""
+        if enabled and self.sales_listener is None:
+            try:
+                self.sales_listener = SalesListener(self.config['sales_listener_host'],
+                                                    self.config['sales_listener_port'])
+            except OSError as e:
+                messagebox.showerror("错误", f"无法启动销售平台监听: {e}")
+                logging.error(f"Failed to start sales listener: {e}")
+                return False
+            print(f"Sales listener started at {self.sales_listener.url}")
+            logging.info(f"Sales listener started at {self.sales_listener.url}")
+            self.sales_timer = self.root.after(SALES_FLUSH_INTERVAL_MS, self.flush_sales)
+        elif not enabled and self.sales_listener is not None:
+            if self.sales_timer is not None:
+                self.root.after_cancel(self.sales_timer)
+                self.sales_timer = None
+            listener = self.sales_listener
+            self.sales_listener = None
+            listener.stop()
+            self.commit_sales(listener.drain())
+            print("Sales listener stopped")
+            logging.info("Sales listener stopped")
+        return self.sales_listener is not None
+
+    def flush_sales(self):
+        # 定时把这段时间收到的销售事件合并成一批删除
+        self.sales_timer = None
+        if self.sales_listener is None:
+            return
+        self.commit_sales(self.sales_listener.drain())
+        self.sales_timer = self.root.after(SALES_FLUSH_INTERVAL_MS, self.flush_sales)
+
+    def commit_sales(self, events):
+        """删除售出的追溯码：一批事件只写一次存储和日志"""
+        if not events:
+            return
+        operations = self.service.commit_sales(events)
+        if operations:
+            self.refresh_changed({barcode for _, barcode, _, _ in operations})
+            self.scan_status_label.config(text=f"销售平台：已删除 {len(operations)} 个售出的追溯码", fg='green')
+
     def on_search_or_add_traceability(self, event):
+        if self.scanner_mode and self.is_scanner_burst(self.barcode_entry.get().strip()):
+            self.handle_scan(self.barcode_entry.get().strip())
+            return
         if not self.barcode_entry.get() and self.last_searched_barcode is not None:
             self.barcode_entry.delete(0, tk.END)  # 清除输入框内容
             self.on_add_traceability()
@@ -428,26 +949,24 @@ class MedicineTrackerApp:
         elif search_term.isdigit():  # 如果是数字但不是13位
             messagebox.showerror("错误", "条形码必须是13位数字。")
         else:  # 如果不是数字，按药品名称搜索
-            matches = []
-            for barcode, (medication, *traceabilities) in self.data.items():
-                if search_term.lower() in medication.lower():
-                    matches.append((medication, barcode, traceabilities))
+            matches = self.service.search(search_term)
             if matches:
                 self.show_multiple_matches(matches)
             else:
                 messagebox.showinfo("提示", "未找到相关药品，请检查输入。")
 
-    def show_multiple_matches(self, matches):
+    def show_multiple_matches(self, barcodes):
         # 创建一个顶级窗口来显示多个匹配项
         match_window = tk.Toplevel(self.root)
         match_window.title("匹配结果")
 
-        # 计算弹窗大小
+        # 计算弹窗大小，最多显示一屏
+        visible_rows = min(len(barcodes), 15)
         item_height = 20  # 每个项目的高度
         padding = 10  # 内边距
         border_width = 2  # 边框宽度
         window_width = 400  # 固定宽度
-        window_height = (len(matches) * item_height) + (padding * 2) + border_width * 2
+        window_height = (visible_rows * item_height) + (padding * 2) + border_width * 2
 
         # 居中显示弹窗
         screen_width = match_window.winfo_screenwidth()
@@ -456,57 +975,33 @@ class MedicineTrackerApp:
         y = (screen_height - window_height) // 2
         match_window.geometry(f"{window_width}x{window_height}+{x+30}+{y-20}")
 
-        listbox = tk.Listbox(match_window, selectmode=tk.SINGLE, width=50, height=len(matches))
-        listbox.pack(padx=padding, pady=padding, fill=tk.BOTH, expand=True)
-
-        for medication, barcode, traceabilities in matches:
-            info_text = f"条形码: {barcode}\n  追溯码数量: {len(traceabilities)}\n  药品名称: {medication}"
-            listbox.insert(tk.END, info_text)
+        def on_select(barcode):
+            self.display_info(barcode)
+            self.last_searched_barcode = barcode
+            match_window.destroy()
 
-        # 默认选择第一个项目
-        listbox.select_set(0)  # 选择第一个项目
-        listbox.event_generate("<<ListboxSelect>>")  # 触发选择事件
+        match_list = VirtualListView(match_window, self.format_medication_row, on_select, height=visible_rows)
+        match_list.frame.pack(padx=padding, pady=padding, fill=tk.BOTH, expand=True)
+        match_list.set_items(barcodes)
         match_window.bind('<Escape>', lambda event: match_window.destroy())
+        match_list.listbox.focus_set()
 
-        def on_select(event):
-            selected_index = listbox.curselection()
-            if selected_index:
-                index = selected_index[0]
-                _, barcode, _ = matches[index]
-                self.display_info(barcode)
-                self.last_searched_barcode = barcode
-                match_window.destroy()
-
-        listbox.bind('<<ListboxSelect>>', lambda event: None)  # 避免默认选择行为
-        listbox.bind('<Double-Button-1>', lambda event: on_select(event))  # 双击选择
-        listbox.bind('<Return>', lambda event: on_select(event))  # 回车键选择
-        listbox.bind('<Up>', lambda event: self.handle_up_down_key(listbox, event))  # 上键
-        listbox.bind('<Down>', lambda event: self.handle_up_down_key(listbox, event))  # 下键
-        listbox.focus_set()
-
-    def handle_up_down_key(self, listbox, event):
-        current_selection = listbox.curselection()
-        if current_selection:
-            index = current_selection[0]
-            if event.keysym == 'Up':
-                new_index = max(0, index - 1)
-            else:
-                new_index = min(len(listbox.get(0, tk.END)) - 1, index + 1)
-            listbox.select_clear(current_selection)
-            listbox.select_set(new_index)
-            listbox.event_generate("<<ListboxSelect>>")
-        else:
-            listbox.select_set(0)  # 如果没有选择任何项，选择第一个
-            listbox.event_generate("<<ListboxSelect>>")
-
+    @timed('render.display_info')
     def display_info(self, barcode):
-        medication, traceabilities = self.data[barcode][0], self.data[barcode][1:]
+        medication, traceabilities = self.data[barcode][0], self.data[barcode].codes()
         num_traceabilities = len(traceabilities)
         info_text = f"药品名称: {medication}\n条形码: {barcode}\n追溯码数量: {num_traceabilities}"
         self.medication_label.config(text=info_text)
-        self.traceability_listbox.delete(0, tk.END)
-        for trace in traceabilities:
-            self.traceability_listbox.insert(tk.END, trace)
+        # 同一条形码刷新时（如删除后）保持滚动位置，只重绘可见行
+        self.traceability_list.set_items(traceabilities, keep_position=(barcode == self.last_searched_barcode))
+        if self.config['barcode_prewarm']:
+            self.root.after_idle(self.prewarm_barcode_images)
+
+    def prewarm_barcode_images(self):
+        # 空闲时生成当前可见追溯码的条形码图像，双击时直接从缓存取
+        view = self.traceability_list
+        for traceability in view.items[view.top:view.top + view.height]:
+            generate_barcode_image(traceability)
 
 
 
@@ -523,24 +1018,14 @@ class MedicineTrackerApp:
                         response = messagebox.askyesno("提示",
                                                        f"该追溯码已于 {self.find_traceability_date(traceability)} 添加过，是否继续添加？")
                         if response:
-                            self.data[barcode] = [medication, traceability]
-                            if self.webdav_connected:
-                                write_data_to_webdav(self.filename, self.data)
-                            else:
-                                write_data(self.filename, self.data)
+                            self.service.create(barcode, medication, traceability)
                             self.display_info(barcode)
                             self.last_searched_barcode = barcode
-                            self.log_event('CREATE', barcode, medication, traceability)
                             break
                     else:
-                        self.data[barcode] = [medication, traceability]
-                        if self.webdav_connected:
-                            write_data_to_webdav(self.filename, self.data)
-                        else:
-                            write_data(self.filename, self.data)
+                        self.service.create(barcode, medication, traceability)
                         self.display_info(barcode)
                         self.last_searched_barcode = barcode
-                        self.log_event('CREATE', barcode, medication, traceability)
                         break
                 elif traceability:
                     messagebox.showerror("错误", "追溯码必须是20位数字。")
@@ -550,20 +1035,12 @@ class MedicineTrackerApp:
 
 
     def check_traceability_in_logs(self, traceability):
-        # 检查日志文件是否存在该追溯码
-        with open(log_filename, 'r') as log_file:
-            for line in log_file:
-                if traceability in line:
-                    return True
-        return False
+        # 检查该追溯码是否添加过（查索引，不再扫描日志）
+        return self.service.seen_before(traceability)
 
     def find_traceability_date(self, traceability):
-        # 查找追溯码的日期
-        with open(log_filename, 'r') as log_file:
-            for line in reversed(list(log_file)):
-                if traceability in line:
-                    return line.split(' - ')[0]
-        return "未知"
+        # 查找追溯码最近一次添加的日期
+        return self.service.last_seen(traceability) or "未知"
 
     def on_add_traceability(self):
         if self.last_searched_barcode is None:
@@ -580,24 +1057,12 @@ class MedicineTrackerApp:
                     response = messagebox.askyesno("提示",
                                                    f"该追溯码已于 {self.find_traceability_date(traceability)} 添加过，是否继续添加？")
                     if response:
-                        self.data[self.last_searched_barcode].append(traceability)
-                        if self.webdav_connected:
-                            write_data_to_webdav(self.filename, self.data)
-                        else:
-                            write_data(self.filename, self.data)
+                        self.service.add(self.last_searched_barcode, [traceability])
                         self.display_info(self.last_searched_barcode)
-                        self.log_event('ADD', self.last_searched_barcode, self.data[self.last_searched_barcode][0],
-                                       traceability)
                         break
                 else:
-                    self.data[self.last_searched_barcode].append(traceability)
-                    if self.webdav_connected:
-                        write_data_to_webdav(self.filename, self.data)
-                    else:
-                        write_data(self.filename, self.data)
+                    self.service.add(self.last_searched_barcode, [traceability])
                     self.display_info(self.last_searched_barcode)
-                    self.log_event('ADD', self.last_searched_barcode, self.data[self.last_searched_barcode][0],
-                                   traceability)
                     break
             elif traceability:
                 messagebox.showerror("错误", "追溯码必须是20位数字。")
@@ -606,14 +1071,11 @@ class MedicineTrackerApp:
 
         self.barcode_entry.focus_set()
 
-    def on_copy_and_delete(self, event):
-        selected_index = self.traceability_listbox.curselection()
-        if selected_index:
-            traceability = self.traceability_listbox.get(selected_index)
-            self.root.clipboard_clear()
-            self.root.clipboard_append(traceability)
-            # 显示删除确认对话框
-            self.show_delete_confirmation(traceability)
+    def on_copy_and_delete(self, traceability):
+        self.root.clipboard_clear()
+        self.root.clipboard_append(traceability)
+        # 显示删除确认对话框
+        self.show_delete_confirmation(traceability)
 
     def show_delete_confirmation(self, traceability):
         # 创建一个顶级窗口来显示条形码图像
@@ -649,25 +1111,13 @@ class MedicineTrackerApp:
 
     def delete_traceability(self, traceability, window):
         barcode = self.last_searched_barcode
-        self.data[barcode].remove(traceability)
-        if self.webdav_connected:
-            write_data_to_webdav(self.filename, self.data)
-        else:
-            write_data(self.filename, self.data)
+        self.service.delete(barcode, [traceability])
         self.display_info(barcode)
         window.destroy()
-        self.log_event('DELETE', barcode, self.data[barcode][0], traceability)
-
-    def log_event(self, action, barcode, medication, traceability=None):
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        message = f"{timestamp} - {action} - Barcode: {barcode}, Medication: {medication}"
-        if traceability:
-            message += f", Traceability: {traceability}"
-        logging.info(message)
-        print(message)  # 输出到控制台
 
 
 if __name__ == "__main__":
+    from ttkbootstrap import Style
     root = tk.Tk()
     style = Style(theme='litera')
     app = MedicineTrackerApp(root, data_filename)
@@ -0,0 +1,505 @@
+"""追溯码记录器热点路径基准测试
+
+生成指定规模的合成数据（条形码、追溯码、日志），测量数据读写、按名称/条形码查询、
+追溯码查重、历史某一时刻的数据重建、条形码图像生成，以及对本地 WebDAV 替身服务器的
+同步往返，结果写成 JSON
+以便跨版本比较。
+
+用法：
+    python benchmarks/run_benchmarks.py                    # 完整规模：1万条形码、100万追溯码、500 MB 日志
+    python benchmarks/run_benchmarks.py --quick            # 缩小规模，用于快速检查
+    python benchmarks/run_benchmarks.py --output result.json
+"""
+import argparse
+import datetime
+import email.utils
+import hashlib
+import itertools
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from xml.sax.saxutils import escape
+
+REPO_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FULL_SCALE = {'barcodes': 10000, 'codes': 1000000, 'log_mb': 500, 'history_events_per_day': 1000}
+QUICK_SCALE = {'barcodes': 1000, 'codes': 100000, 'log_mb': 20, 'history_events_per_day': 100}
+HISTORY_DAYS = 365
+HISTORY_SNAPSHOT_DAYS = 7  # 合成历史中每隔几天保存一次快照
+
+NAME_CHARACTERS = '阿莫西林胶囊布洛芬缓释片头孢克肟颗粒维生素钙镁锌感冒灵复方甘草口服液氨酚烷胺对乙酰氨基酚'
+NAME_SUFFIXES = ['片', '胶囊', '颗粒', '口服液', '注射液', '软膏', '滴眼液']
+
+
+class Benchmarks:
+    """记录每项测量的耗时（秒/次）"""
+
+    def __init__(self):
+        self.results = {}
+
+    def measure(self, name, func, repeat=5, number=1):
+        runs = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            for _ in range(number):
+                func()
+            runs.append((time.perf_counter() - started) / number)
+        self.results[name] = {'repeat': repeat, 'number': number, 'min': min(runs),
+                              'median': statistics.median(runs), 'mean': statistics.mean(runs)}
+        print(f"{name:36s} median {statistics.median(runs) * 1000:10.3f} ms")
+
+    def size(self, name, size):
+        # 记录数据量（字节），如传输格式的大小
+        self.results[name] = {'bytes': size}
+        print(f"{name:36s} {size / 1024:16.1f} KB")
+
+    def skip(self, name, reason):
+        self.results[name] = {'skipped': reason}
+        print(f"{name:36s} skipped: {reason}")
+
+
+def generate_dataset(directory, scale, rng):
+    """生成数据文件和 tracker.log，返回 (条形码列表, 追溯码列表)"""
+    barcodes = [f"69{rng.randrange(10 ** 11):011d}" for _ in range(scale['barcodes'])]
+    barcodes = list(dict.fromkeys(barcodes))
+    codes_per_barcode = max(1, scale['codes'] // len(barcodes))
+    codes = []
+    with open(os.path.join(directory, 'medicine_data.txt'), 'w') as file:
+        for number, barcode in enumerate(barcodes):
+            name = ''.join(rng.choice(NAME_CHARACTERS) for _ in range(rng.randint(2, 6))) + rng.choice(NAME_SUFFIXES)
+            record_codes = [f"{number:08d}{index:012d}" for index in range(codes_per_barcode)]
+            codes.extend(record_codes)
+            file.write(f"{barcode},{name},{','.join(record_codes)}\n")
+
+    # 与 log_event 写入格式相同的事件行，间或夹杂连接信息，直到达到目标大小
+    target = scale['log_mb'] * 1024 * 1024
+    started = datetime.datetime(2024, 1, 1)
+    size = 0
+    count = 0
+    with open(os.path.join(directory, 'log', 'tracker.log'), 'w') as log:
+        while size < target:
+            lines = []
+            for _ in range(1000):
+                timestamp = (started + datetime.timedelta(seconds=count * 7)).strftime("%Y-%m-%d %H:%M:%S")
+                number = rng.randrange(len(codes))
+                barcode = barcodes[min(number // codes_per_barcode, len(barcodes) - 1)]
+                if count % 50 == 0:
+                    lines.append(f"{timestamp},000 - INFO - WebDAV connection successful.\n")
+                action = 'DELETE' if count % 10 == 0 else 'ADD'
+                lines.append(f"{timestamp},000 - INFO - {timestamp} - {action} - Barcode: {barcode}, "
+                             f"Medication: 药品, Traceability: {codes[number]}\n")
+                count += 1
+            chunk = ''.join(lines)
+            log.write(chunk)
+            size += len(chunk.encode('utf-8'))
+    return barcodes, codes
+
+
+class LocalWebDAVServer:
+    """本地 WebDAV 替身：GET（条件请求、Range）、PUT、HEAD、DELETE、MKCOL、PROPFIND，文件存放在目录中"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def local_path(self):
+                path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+                path = re.sub('/+', '/', path).strip('/')
+                return os.path.join(server.directory, *path.split('/')) if path else server.directory
+
+            def etag(self, path):
+                stat = os.stat(path)
+                return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+            def send(self, status, body=b'', headers=None):
+                self.send_response(status)
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(body)
+
+            def read_body(self):
+                if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+                    chunks = []
+                    while True:
+                        size = int(self.rfile.readline().strip(), 16)
+                        if size == 0:
+                            self.rfile.readline()
+                            return b''.join(chunks)
+                        chunks.append(self.rfile.read(size))
+                        self.rfile.readline()
+                return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+            def do_GET(self):
+                path = self.local_path()
+                if not os.path.isfile(path):
+                    self.send(404)
+                    return
+                etag = self.etag(path)
+                if self.headers.get('If-None-Match') == etag:
+                    self.send(304, headers={'ETag': etag})
+                    return
+                with open(path, 'rb') as file:
+                    body = file.read()
+                match = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+                if match and int(match.group(1)) < len(body):
+                    offset = int(match.group(1))
+                    self.send(206, body[offset:], {'ETag': etag, 'Content-Range':
+                                                   f'bytes {offset}-{len(body) - 1}/{len(body)}'})
+                    return
+                self.send(200, body, {'ETag': etag})
+
+            def do_HEAD(self):
+                # 客户端用 HEAD 检查目录是否存在
+                if os.path.isdir(self.local_path()):
+                    self.send(200)
+                    return
+                self.do_GET()
+
+            def do_PUT(self):
+                path = self.local_path()
+                body = self.read_body()
+                if not os.path.isdir(os.path.dirname(path)):
+                    self.send(409)
+                    return
+                with open(path, 'wb') as file:
+                    file.write(body)
+                self.send(201, headers={'ETag': self.etag(path)})
+
+            def do_DELETE(self):
+                path = self.local_path()
+                if not os.path.isfile(path):
+                    self.send(404)
+                    return
+                os.remove(path)
+                self.send(204)
+
+            def do_MKCOL(self):
+                self.read_body()
+                os.makedirs(self.local_path(), exist_ok=True)
+                self.send(201)
+
+            def do_PROPFIND(self):
+                self.read_body()
+                path = self.local_path()
+                if not os.path.exists(path):
+                    self.send(404)
+                    return
+                href = urllib.parse.urlsplit(self.path).path
+                entries = [(href, path)]
+                if os.path.isdir(path) and self.headers.get('Depth', '1') != '0':
+                    base = href if href.endswith('/') else href + '/'
+                    entries += [(base + urllib.parse.quote(name), os.path.join(path, name))
+                                for name in sorted(os.listdir(path))]
+                responses = ''.join(self.propstat(entry_href, entry_path) for entry_href, entry_path in entries)
+                body = ('<?xml version="1.0" encoding="utf-8"?>'
+                        f'<d:multistatus xmlns:d="DAV:">{responses}</d:multistatus>').encode('utf-8')
+                self.send(207, body, {'Content-Type': 'application/xml; charset=utf-8'})
+
+            def propstat(self, href, path):
+                stat = os.stat(path)
+                modified = email.utils.formatdate(stat.st_mtime, usegmt=True)
+                if os.path.isdir(path):
+                    properties = '<d:resourcetype><d:collection/></d:resourcetype>'
+                else:
+                    properties = (f'<d:resourcetype/><d:getcontentlength>{stat.st_size}</d:getcontentlength>'
+                                  f'<d:getetag>{escape(self.etag(path))}</d:getetag>')
+                return (f'<d:response><d:href>{escape(href)}</d:href><d:propstat><d:prop>{properties}'
+                        f'<d:getlastmodified>{modified}</d:getlastmodified></d:prop>'
+                        '<d:status>HTTP/1.1 200 OK</d:status></d:propstat></d:response>')
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def bench_storage(recorder, benchmarks, directory, barcodes, rng):
+    data_filename = os.path.join(directory, 'medicine_data.txt')
+    benchmarks.measure('read_data', lambda: recorder.read_data(data_filename), repeat=3)
+    data = recorder.read_data(data_filename)
+    copy_filename = os.path.join(directory, 'medicine_data.copy.txt')
+    benchmarks.measure('write_data', lambda: recorder.write_data(copy_filename, data), repeat=3)
+
+    store = recorder.JournaledStore(copy_filename, compact_threshold=1 << 40)
+    barcode = barcodes[0]
+    counter = iter(range(10 ** 9))
+    benchmarks.measure('journal_apply_single_op',
+                       lambda: store.apply('ADD', barcode, f"9{next(counter):019d}"), repeat=5, number=20)
+    store.journal.close()
+
+    sharded_filename = os.path.join(directory, 'medicine_data.sharded.txt')
+    shutil.copy(data_filename, sharded_filename)
+    recorder.ShardedStore(sharded_filename, compact_threshold=1 << 40).journal.close()  # 先完成拆分
+
+    def open_sharded_and_lookup():
+        sharded = recorder.ShardedStore(sharded_filename, compact_threshold=1 << 40)
+        sharded.data.get(rng.choice(barcodes))
+        sharded.journal.close()
+    benchmarks.measure('sharded_open_and_lookup', open_sharded_and_lookup, repeat=5)
+
+    lazy_filename = os.path.join(directory, 'medicine_data.lazy.txt')
+    shutil.copy(data_filename, lazy_filename)
+    recorder.LazyStore(lazy_filename, compact_threshold=1 << 40).close()  # 先建立偏移索引
+
+    def open_lazy_and_lookup():
+        lazy = recorder.LazyStore(lazy_filename, compact_threshold=1 << 40)
+        lazy.data.get(rng.choice(barcodes))
+        lazy.close()
+    benchmarks.measure('lazy_open_and_lookup', open_lazy_and_lookup, repeat=5)
+
+    # WebDAV 基线的压缩传输格式：打包、解包耗时和传输量
+    benchmarks.size('transfer_size_text', os.path.getsize(data_filename))
+    for codec in ('gzip', 'zstd'):
+        if codec == 'zstd' and recorder.load_zstandard() is None:
+            for name in ('pack_data_zstd', 'unpack_data_zstd', 'transfer_size_zstd'):
+                benchmarks.skip(name, "No module named 'zstandard'")
+            continue
+        benchmarks.measure(f'pack_data_{codec}', lambda: recorder.pack_data(data, codec), repeat=3)
+        packed = recorder.pack_data(data, codec)
+        benchmarks.measure(f'unpack_data_{codec}', lambda: recorder.unpack_data(packed), repeat=3)
+        benchmarks.size(f'transfer_size_{codec}', len(packed))
+    return data
+
+
+def bench_search(recorder, benchmarks, data, barcodes, rng):
+    # on_search 的条形码路径：查找记录并取出全部追溯码用于显示
+    def barcode_path():
+        barcode = rng.choice(barcodes)
+        if barcode in data:
+            list(data[barcode].codes())
+    benchmarks.measure('on_search_barcode_path', barcode_path, repeat=5, number=1000)
+
+    # on_search 的名称路径：首次搜索建立索引，之后直接查询
+    benchmarks.measure('search_index_build', lambda: recorder.MedicationSearchIndex(data), repeat=3)
+    index = recorder.MedicationSearchIndex(data)
+    names = [data[barcode][0] for barcode in barcodes]
+    benchmarks.measure('on_search_name_path',
+                       lambda: index.search(rng.choice(names)[:2]), repeat=5, number=200)
+
+
+def bench_traceability(recorder, benchmarks, directory, codes, rng):
+    log_filename = os.path.join(directory, 'log', 'tracker.log')
+    index_filename = os.path.join(directory, 'log', 'tracker.idx')
+    benchmarks.measure('trace_index_rebuild',
+                       lambda: recorder.TraceabilityIndex(index_filename + '.rebuild', log_filename), repeat=1)
+    recorder.TraceabilityIndex(index_filename, log_filename)
+    benchmarks.measure('trace_index_load', lambda: recorder.TraceabilityIndex(index_filename, log_filename),
+                       repeat=3)
+
+    # 直接调用核心服务中的方法，只提供它用到的属性
+    service = types.SimpleNamespace(trace_index=recorder.TraceabilityIndex(index_filename, log_filename))
+    check = recorder.TraceabilityService.seen_before
+    find_date = recorder.TraceabilityService.last_seen
+    benchmarks.measure('check_traceability_in_logs', lambda: check(service, rng.choice(codes)), repeat=5, number=10000)
+    benchmarks.measure('find_traceability_date', lambda: find_date(service, rng.choice(codes)), repeat=5, number=10000)
+
+
+def bench_history(recorder, benchmarks, directory, data, barcodes, events_per_day, rng):
+    # 一年的事件日志，每周一个快照；对比从最近快照重建和从第一个快照重放全年
+    history_directory = os.path.join(directory, 'history')
+    audit_log = recorder.AuditLog(os.path.join(history_directory, 'audit'))
+    snapshots = recorder.StateSnapshots(os.path.join(history_directory, 'snapshots'), audit_log)
+    first = recorder.StateSnapshots(os.path.join(history_directory, 'first'), audit_log)
+    data = {barcode: values.copy() for barcode, values in data.items()}
+    started = datetime.datetime(2024, 1, 1)
+    copy = {barcode: values.copy() for barcode, values in data.items()}
+    first.take(lambda copy=copy: copy, started.strftime("%Y-%m-%d %H:%M:%S"))
+    counter = itertools.count()
+    for day in range(HISTORY_DAYS):
+        events = []
+        for number in range(events_per_day):
+            timestamp = (started + datetime.timedelta(days=day, seconds=number * 40)).strftime("%Y-%m-%d %H:%M:%S")
+            barcode = rng.choice(barcodes)
+            traceability = f"8{next(counter):019d}"
+            recorder.apply_operation(data, 'ADD', barcode, traceability)
+            events.append((timestamp, 'ADD', barcode, data[barcode][0], traceability))
+        audit_log.write_many(events)
+        if day % HISTORY_SNAPSHOT_DAYS == HISTORY_SNAPSHOT_DAYS - 1:
+            # 之后还要修改 data，在这里复制
+            copy = {barcode: values.copy() for barcode, values in data.items()}
+            snapshots.take(lambda copy=copy: copy,
+                           (started + datetime.timedelta(days=day, hours=23)).strftime("%Y-%m-%d %H:%M:%S"))
+    audit_log.close()
+    snapshots.close()
+    first.close()
+
+    def random_time():
+        return (started + datetime.timedelta(seconds=rng.randrange(HISTORY_DAYS * 86400))).strftime("%Y-%m-%d %H:%M:%S")
+    snapshots.reconstruct(random_time(), rng.choice(barcodes))  # 先读入条形码分段索引
+    benchmarks.measure('history_barcode_at',
+                       lambda: snapshots.reconstruct(random_time(), rng.choice(barcodes)), repeat=5, number=10)
+    benchmarks.measure('history_state_at', lambda: snapshots.reconstruct(random_time()), repeat=3)
+    end = (started + datetime.timedelta(days=HISTORY_DAYS - 1, hours=22)).strftime("%Y-%m-%d %H:%M:%S")
+    benchmarks.measure('history_full_replay', lambda: first.reconstruct(end), repeat=1)
+
+
+def bench_barcode_image(benchmarks, codes, rng):
+    import TraceabilitycodeRecorder as recorder  # 条形码图像在界面模块中生成
+    try:
+        import barcode  # noqa: F401
+        root = recorder.tk.Tk()
+        root.withdraw()
+    except (ImportError, recorder.tk.TclError) as e:
+        benchmarks.skip('generate_barcode_image_cold', str(e))
+        benchmarks.skip('generate_barcode_image_cached', str(e))
+        return
+
+    def cold():
+        recorder.generate_barcode_image.cache_clear()
+        recorder.generate_barcode_image(rng.choice(codes))
+    benchmarks.measure('generate_barcode_image_cold', cold, repeat=5, number=20)
+    code = codes[0]
+    recorder.generate_barcode_image(code)
+    benchmarks.measure('generate_barcode_image_cached', lambda: recorder.generate_barcode_image(code),
+                       repeat=5, number=1000)
+    root.destroy()
+
+
+def bench_webdav(recorder, benchmarks, directory, barcodes):
+    try:
+        import webdav3.client  # noqa: F401
+    except ImportError as e:
+        for name in ('webdav_pull_unchanged', 'webdav_push_batch', 'webdav_pull_changes'):
+            benchmarks.skip(name, str(e))
+        return
+
+    server_directory = os.path.join(directory, 'webdav')
+    os.makedirs(server_directory)
+    shutil.copy(os.path.join(directory, 'medicine_data.txt'), os.path.join(server_directory, 'medicine_data.txt'))
+    server = LocalWebDAVServer(server_directory)
+
+    # 两个终端各用一个目录，远端路径相同
+    terminals = []
+    for name in ('terminal-a', 'terminal-b'):
+        terminal_directory = os.path.join(directory, name)
+        os.makedirs(terminal_directory)
+        with open(os.path.join(terminal_directory, 'webdav_config.json'), 'w') as file:
+            json.dump({'webdav_hostname': server.url, 'webdav_login': '', 'webdav_password': '',
+                       'webdav_root': '/'}, file)
+        os.chdir(terminal_directory)
+        terminals.append((terminal_directory, recorder.WebDAVSync('medicine_data.txt')))
+    recorder.reset_webdav_client()
+
+    def run(terminal, func):
+        os.chdir(terminal[0])
+        return func(terminal[1])
+
+    try:
+        for terminal in terminals:
+            run(terminal, lambda sync: sync.check())
+        benchmarks.measure('webdav_pull_unchanged', lambda: run(terminals[0], lambda sync: sync.pull()), repeat=10)
+
+        counter = iter(range(10 ** 9))
+
+        def push_batch(size):
+            operations = [('ADD', barcodes[0], f"8{next(counter):019d}", None) for _ in range(size)]
+            return run(terminals[1], lambda sync: sync.push(operations))
+        benchmarks.measure('webdav_push_batch', lambda: push_batch(10), repeat=10)
+
+        def pull_changes():
+            push_batch(100)
+            run(terminals[0], lambda sync: sync.pull())
+        benchmarks.measure('webdav_pull_changes', pull_changes, repeat=10)
+    finally:
+        os.chdir(directory)
+        server.stop()
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIRECTORY, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="追溯码记录器基准测试")
+    parser.add_argument('--quick', action='store_true', help="使用缩小的数据规模")
+    parser.add_argument('--barcodes', type=int)
+    parser.add_argument('--codes', type=int)
+    parser.add_argument('--log-mb', type=int)
+    parser.add_argument('--history-events-per-day', type=int)
+    parser.add_argument('--seed', type=int, default=20240101)
+    parser.add_argument('--output', help="结果 JSON 文件，默认写到 benchmarks/results-<时间>.json")
+    parser.add_argument('--keep', action='store_true', help="保留生成的数据目录")
+    args = parser.parse_args()
+
+    scale = dict(QUICK_SCALE if args.quick else FULL_SCALE)
+    for key in scale:
+        if getattr(args, key) is not None:
+            scale[key] = getattr(args, key)
+    output = args.output or os.path.join(REPO_DIRECTORY, 'benchmarks',
+                                         f"results-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    output = os.path.abspath(output)
+
+    directory = tempfile.mkdtemp(prefix='recorder-bench-')
+    try:
+        # 程序在导入时按 USERPROFILE 建立数据和日志目录，指向临时目录以免影响真实数据
+        os.environ['USERPROFILE'] = directory
+        os.makedirs(os.path.join(directory, 'log'))
+        os.chdir(directory)
+        sys.path.insert(0, REPO_DIRECTORY)
+        benchmarks = Benchmarks()
+        benchmarks.measure('module_import', lambda: __import__('traceability_core'), repeat=1)
+        import traceability_core as recorder
+
+        rng = random.Random(args.seed)
+        print(f"Generating dataset {scale} in {directory} ...")
+        barcodes, codes = generate_dataset(directory, scale, rng)
+
+        data = bench_storage(recorder, benchmarks, directory, barcodes, rng)
+        bench_search(recorder, benchmarks, data, barcodes, rng)
+        bench_traceability(recorder, benchmarks, directory, codes, rng)
+        bench_history(recorder, benchmarks, directory, data, barcodes, scale['history_events_per_day'], rng)
+        bench_barcode_image(benchmarks, codes, rng)
+        bench_webdav(recorder, benchmarks, directory, barcodes)
+
+        with open(os.path.join(directory, 'medicine_data.txt'), 'rb') as file:
+            data_digest = hashlib.sha256(file.read()).hexdigest()
+        report = {
+            'revision': git_revision(),
+            'created': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'seed': args.seed,
+            'scale': scale,
+            'dataset_sha256': data_digest,
+            'results': benchmarks.results,
+        }
+        with open(output, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f"Results written to {output}")
+    finally:
+        os.chdir(REPO_DIRECTORY)
+        if not args.keep:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
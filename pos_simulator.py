@@ -0,0 +1,63 @@
+"""销售平台模拟器：按指定速率向追溯码记录器的销售监听接口推送售出的追溯码
+
+用法示例：
+    python pos_simulator.py medicine_data.txt --rate 200 --count 1000
+"""
+import argparse
+import itertools
+import json
+import time
+import urllib.request
+
+from traceability_core import load_app_config, open_store
+
+
+def read_sale_candidates(filename, count=None):
+    """按记录器的存储模式读取最多 count 个 (条形码, 追溯码)，作为"售出"的商品"""
+    store = open_store(filename, load_app_config())
+    try:
+        candidates = ((barcode, traceability) for barcode, record in store.data.items()
+                      for traceability in record.codes())
+        return list(itertools.islice(candidates, count))
+    finally:
+        store.close()
+
+
+def post_sales(url, events, include_barcode=True):
+    body = [{'barcode': barcode, 'traceability': traceability} if include_barcode else traceability
+            for barcode, traceability in events]
+    request = urllib.request.Request(url, data=json.dumps(body).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json'}, method='POST')
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.load(response)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="向销售监听接口推送模拟的销售事件")
+    parser.add_argument('data_file', help="追溯码记录器的数据文件，从中挑选售出的追溯码")
+    parser.add_argument('--url', default='http://127.0.0.1:8765/sale')
+    parser.add_argument('--rate', type=float, default=100, help="每秒推送的追溯码数")
+    parser.add_argument('--count', type=int, default=100, help="推送的追溯码总数")
+    parser.add_argument('--batch', type=int, default=10, help="每次请求包含的追溯码数")
+    parser.add_argument('--no-barcode', action='store_true', help="只推送追溯码，不附带条形码")
+    args = parser.parse_args()
+
+    candidates = read_sale_candidates(args.data_file, args.count)
+    accepted = rejected = 0
+    started = time.perf_counter()
+    for position in range(0, len(candidates), args.batch):
+        batch = candidates[position:position + args.batch]
+        result = post_sales(args.url, batch, include_barcode=not args.no_barcode)
+        accepted += result['accepted']
+        rejected += result['rejected']
+        # 按目标速率等待
+        delay = (position + len(batch)) / args.rate - (time.perf_counter() - started)
+        if delay > 0:
+            time.sleep(delay)
+    elapsed = time.perf_counter() - started
+    print(f"Sent {len(candidates)} sale events in {elapsed:.2f}s "
+          f"({len(candidates) / elapsed if elapsed else 0:.0f}/s), accepted {accepted}, rejected {rejected}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,5 @@
+import os
+import tempfile
+
+# traceability_core 导入时按 USERPROFILE 建立日志等目录，测试时放到临时目录
+os.environ['USERPROFILE'] = tempfile.mkdtemp(prefix='traceability-tests-')
@@ -0,0 +1,67 @@
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+import traceability_core as core
+
+
+class CodeArchiveTest(unittest.TestCase):
+    """归档分段和按追溯码排序的定长索引"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.archive = core.CodeArchive(self.directory)
+
+    def tearDown(self):
+        self.archive.close()
+        shutil.rmtree(self.directory)
+
+    def record(self, traceability, time='2023-01-05 10:00:00'):
+        return {'time': time, 'action': 'ADD', 'barcode': '6900000000001', 'medication': '阿莫西林胶囊',
+                'traceability': traceability}
+
+    def test_index_lines_have_fixed_width(self):
+        self.archive.append([self.record(f"8{number:019d}") for number in (5, 1, 3)])
+        self.archive.append([self.record(f"8{number:019d}") for number in (4, 2)])
+        with open(os.path.join(self.directory, 'archive-202301.idx'), 'rb') as file:
+            lines = file.read().splitlines(keepends=True)
+        self.assertEqual(len(lines), 5)
+        for line in lines:
+            self.assertEqual(len(line), core.ARCHIVE_INDEX_WIDTH)
+            self.assertEqual(line[20:21], b',')
+            self.assertFalse(line.endswith(b'\r\n'))
+        self.assertEqual(lines, sorted(lines))
+        self.assertEqual([record['traceability'] for record in self.archive.lookup(f"8{3:019d}")], [f"8{3:019d}"])
+
+
+class ArchiveColdDataTest(unittest.TestCase):
+    """冷数据归档不修改数据，仍在库的追溯码留在索引中"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        config = dict(core.DEFAULT_APP_CONFIG, archive_after_days=30, snapshot_interval_hours=1000)
+        self.service = core.TraceabilityService(os.path.join(self.directory, 'medicine_data.txt'), config)
+
+    def tearDown(self):
+        self.service.close()
+        shutil.rmtree(self.directory)
+
+    def test_on_hand_codes_stay_resolvable(self):
+        on_hand, sold = '82000000000000000001', '82000000000000000002'
+        self.service.create('6900000000011', '布洛芬缓释胶囊', on_hand)
+        self.service.add('6900000000011', [sold])
+        self.service.delete('6900000000011', [sold])
+
+        # 31 天后两个追溯码的最近添加都早于期限
+        result = self.service.archive_cold_data(now=datetime.datetime.now() + datetime.timedelta(days=31))
+        self.assertEqual(set(result), {'events', 'index_entries'})
+        self.assertEqual(self.service.lookup('6900000000011'), ('布洛芬缓释胶囊', [on_hand]))
+        self.assertIn(on_hand, self.service.trace_index.entries)
+        self.assertNotIn(sold, self.service.trace_index.entries)
+        self.assertEqual(self.service.archive.summary(sold)[2], '6900000000011')
+
+
+if __name__ == '__main__':
+    unittest.main()
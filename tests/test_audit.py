@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import traceability_core as core
+
+
+class AuditLogTest(unittest.TestCase):
+    """事件日志的条形码索引偏移按文件实际末尾计算"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def event(self, barcode, number):
+        return ('2024-03-01 10:00:00', 'ADD', barcode, '阿莫西林胶囊', f"8{number:019d}")
+
+    def test_offsets_follow_other_writers(self):
+        first = core.AuditLog(self.directory)
+        second = core.AuditLog(self.directory)
+        try:
+            first.write_many([self.event('6900000000001', 1)])
+            second.write_many([self.event('6900000000002', 2)])
+            first.write_many([self.event('6900000000001', 3), self.event('6900000000002', 4)])
+            second.write_many([self.event('6900000000002', 5)])
+        finally:
+            first.close()
+            second.close()
+        audit_log = core.AuditLog(self.directory)
+        self.assertEqual([event['traceability'][-1] for event in audit_log.query(barcode='6900000000001')],
+                         ['1', '3'])
+        self.assertEqual([event['traceability'][-1] for event in audit_log.query(barcode='6900000000002')],
+                         ['2', '4', '5'])
+
+    def test_mismatched_index_falls_back_to_scan(self):
+        audit_log = core.AuditLog(self.directory)
+        audit_log.write_many([self.event('6900000000001', 1), self.event('6900000000002', 2)])
+        audit_log.close()
+        index_filename = audit_log.path(audit_log.segments()[0], '.idx')
+        with open(index_filename, 'w') as file:
+            file.write('6900000000001,0\n6900000000002,0\n')
+        self.assertEqual([event['barcode'] for event in audit_log.query(barcode='6900000000002')],
+                         ['6900000000002'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+
+import traceability_core as core
+
+
+def record_lists(data):
+    return {barcode: list(record) for barcode, record in data.items()}
+
+
+class PackDataTest(unittest.TestCase):
+    """WebDAV 压缩传输格式 pack_data / unpack_data"""
+
+    def sample(self):
+        removed = core.MedicationRecord('头孢克肟片', [f"8{number:019d}" for number in range(40)])
+        for number in range(0, 40, 3):
+            removed.remove(f"8{number:019d}")
+        return {
+            '6900000000001': core.MedicationRecord('阿莫西林胶囊', ['81000000000000000001', '99999999999999999999',
+                                                               '00000000000000000007']),
+            # 长度不是20位或含非数字的旧数据与20位追溯码混在一起，顺序不变
+            '6900000000002': core.MedicationRecord('布洛芬缓释胶囊', ['123', '81000000000000000002', 'LOT-A1',
+                                                                 '8100000000000000000', '810000000000000000021']),
+            '6900000000003': core.MedicationRecord('维生素C片', []),
+            '6900000000004': removed,
+            '0': core.MedicationRecord('名称，含逗号以外的符号 ·', ['81000000000000000003']),
+        }
+
+    def test_round_trip(self):
+        data = self.sample()
+        codecs = ['none', 'gzip'] + (['zstd'] if core.load_zstandard() is not None else [])
+        for codec in codecs:
+            with self.subTest(codec=codec):
+                self.assertEqual(record_lists(core.unpack_data(core.pack_data(data, codec))), record_lists(data))
+
+    def test_empty_data(self):
+        self.assertEqual(core.unpack_data(core.pack_data({})), {})
+
+    def test_only_requested_barcodes(self):
+        data = self.sample()
+        unpacked = core.unpack_data(core.pack_data(data), barcodes={'6900000000002', '6900000000004'})
+        self.assertEqual(record_lists(unpacked),
+                         {barcode: list(data[barcode]) for barcode in ('6900000000002', '6900000000004')})
+
+    def test_version_marker(self):
+        blob = core.pack_data(self.sample(), 'gzip')
+        self.assertEqual(blob[:len(core.PACK_MAGIC)], core.PACK_MAGIC)
+        self.assertEqual(blob[len(core.PACK_MAGIC)], core.PACK_VERSION)
+        self.assertEqual(blob[len(core.PACK_MAGIC) + 1], core.PACK_CODECS['gzip'])
+
+    def test_unknown_version_is_rejected(self):
+        blob = bytearray(core.pack_data(self.sample(), 'none'))
+        blob[len(core.PACK_MAGIC)] = core.PACK_VERSION + 1
+        with self.assertRaises(ValueError):
+            core.unpack_data(bytes(blob))
+
+    def test_malformed_content_is_rejected(self):
+        blob = core.pack_data(self.sample(), 'none')
+        codec = bytearray(blob)
+        codec[len(core.PACK_MAGIC) + 1] = 9
+        for bad in (b'', b'81000000000000000001', core.PACK_MAGIC, blob[:-1], bytes(codec),
+                    core.PACK_MAGIC + bytes([core.PACK_VERSION, core.PACK_CODECS['gzip']]) + b'not gzip'):
+            with self.assertRaises(ValueError):
+                core.unpack_data(bad)
+
+    def test_pack_without_position_markers(self):
+        # 早先打包的记录没有标出旧数据的位置，旧数据放在最后
+        code = 81000000000000000001
+        record = core.MedicationRecord.from_packed('阿莫西林胶囊', [code >> 64], [code & core.LOW_64_MASK], ['LOT-A1'])
+        self.assertEqual(list(record), ['阿莫西林胶囊', '81000000000000000001', 'LOT-A1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import random
+import unittest
+
+import traceability_core as core
+
+
+def code(number):
+    return f"8{number:019d}"
+
+
+class MedicationRecordTest(unittest.TestCase):
+    """MedicationRecord 的行为和原来的 [药品名称, 追溯码, ...] 列表一致"""
+
+    def build(self, values):
+        return core.MedicationRecord('阿莫西林胶囊', values), ['阿莫西林胶囊'] + list(values)
+
+    def assertSameAsList(self, record, expected):
+        self.assertEqual(list(record), expected)
+        self.assertEqual(len(record), len(expected))
+        for index in range(-len(expected), len(expected)):
+            self.assertEqual(record[index], expected[index], index)
+        for index in (len(expected), -len(expected) - 1):
+            with self.assertRaises(IndexError):
+                record[index]
+        for piece in (slice(None), slice(1, None), slice(-2, None), slice(None, None, -1), slice(1, 3)):
+            self.assertEqual(record[piece], expected[piece])
+        self.assertEqual(list(record.codes()), expected[1:])
+        self.assertEqual(len(record.codes()), len(expected) - 1)
+
+    def test_indexing_and_slicing(self):
+        record, expected = self.build([code(1), code(2), code(3)])
+        self.assertSameAsList(record, expected)
+        self.assertEqual(record[-len(record)], '阿莫西林胶囊')
+
+    def test_other_codes_keep_insertion_order(self):
+        values = ['OLD-1', code(1), 'short', code(2), '123']
+        record, expected = self.build(values)
+        self.assertSameAsList(record, expected)
+        record.append('OLD-2')
+        record.append(code(3))
+        expected += ['OLD-2', code(3)]
+        self.assertSameAsList(record, expected)
+
+    def test_remove_and_contains(self):
+        values = [code(1), 'OLD-1', code(2), 'OLD-2', code(3)]
+        record, expected = self.build(values)
+        for value in ('OLD-1', code(2)):
+            record.remove(value)
+            expected.remove(value)
+            self.assertNotIn(value, record)
+            self.assertSameAsList(record, expected)
+        for value in (code(1), 'OLD-2', code(3)):
+            self.assertIn(value, record)
+        for value in (code(9), 'OLD-9'):
+            self.assertNotIn(value, record)
+            with self.assertRaises(ValueError):
+                record.remove(value)
+
+    def test_random_operations_match_list(self):
+        generator = random.Random(7)
+        pool = [code(number) for number in range(40)] + [f"OLD-{number}" for number in range(10)]
+        record, expected = self.build([])
+        for step in range(2000):
+            value = generator.choice(pool)
+            if value in expected:
+                record.remove(value)
+                expected.remove(value)
+            else:
+                record.append(value)
+                expected.append(value)
+            self.assertEqual(value in record, value in expected)
+            if step % 50 == 0:
+                self.assertSameAsList(record, expected)
+        self.assertSameAsList(record, expected)
+        self.assertSameAsList(record.copy(), expected)
+
+    def test_packed_round_trip_keeps_order(self):
+        record, expected = self.build([code(1), 'OLD-1', code(2), 'OLD-2'])
+        record.remove(code(1))
+        expected.remove(code(1))
+        high, low, others = record.packed()
+        self.assertSameAsList(core.MedicationRecord.from_packed(record.medication, high, low, others), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import traceability_core as core
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class ServiceLockTest(unittest.TestCase):
+    """同一用户目录只允许一个进程打开服务"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'medicine_data.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_second_service_is_refused_until_close(self):
+        service = core.TraceabilityService(self.filename)
+        try:
+            with self.assertRaises(ValueError):
+                core.TraceabilityService(self.filename)
+        finally:
+            service.close()
+        core.TraceabilityService(self.filename).close()
+
+    def test_cli_reports_locked_data(self):
+        service = core.TraceabilityService(self.filename)
+        try:
+            result = subprocess.run([sys.executable, os.path.join(ROOT, 'traceability_cli.py'), '--data', self.filename,
+                                     '--json', 'lookup', '6900000000001'],
+                                    capture_output=True, text=True, encoding='utf-8', env=dict(os.environ))
+        finally:
+            service.close()
+        self.assertEqual(result.returncode, 1)
+        self.assertEqual(result.stdout, '')
+        self.assertIn('正被另一个追溯码记录器', result.stderr)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,242 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import traceability_core as core
+
+
+def code(number):
+    return f"8{number:019d}"
+
+
+# 覆盖建立、添加、删除、删除后重新添加、非20位的旧数据和整条记录重建
+OPERATIONS = [
+    ('CREATE', '6900000000001', code(1), '阿莫西林胶囊'),
+    ('ADD', '6900000000001', code(2), None),
+    ('ADD', '6900000000001', code(3), None),
+    ('CREATE', '6900000000002', code(11), '布洛芬缓释胶囊'),
+    ('ADD', '6900000000002', 'LOT-A1', None),
+    ('DELETE', '6900000000001', code(2), None),
+    ('CREATE', '6900000000003', code(21), '头孢克肟片'),
+    ('DELETE', '6900000000003', code(21), None),
+    ('ADD', '6900000000001', code(2), None),
+    ('CREATE', '6900000000002', code(12), '布洛芬缓释胶囊'),
+]
+
+MORE_OPERATIONS = [
+    ('ADD', '6900000000002', code(13), None),
+    ('CREATE', '6900000000004', code(31), '维生素C片'),
+    ('DELETE', '6900000000001', code(1), None),
+]
+
+
+def expected_after(*batches):
+    data = {}
+    for operations in batches:
+        for operation in operations:
+            core.apply_operation(data, *operation)
+    return as_lists(data)
+
+
+def as_lists(records):
+    return {barcode: list(record) for barcode, record in dict(records).items()}
+
+
+class StoreReloadTest(unittest.TestCase):
+    """各存储模式修改、合并后重新打开，读到的数据与修改后内存中的一致"""
+
+    MODES = ('journal', 'lazy', 'sharded', 'sqlite')
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'medicine_data.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def open(self, mode, compact_threshold=1 << 30):
+        config = dict(core.DEFAULT_APP_CONFIG, storage_mode=mode, journal_compact_threshold=compact_threshold,
+                      shard_count=4)
+        return core.open_store(self.filename, config)
+
+    def assertStoreEqual(self, store, expected):
+        self.assertEqual(as_lists(store.data), expected)
+        self.assertEqual(len(store.data), len(expected))
+        self.assertEqual(as_lists(store.copy_records()), expected)
+        self.assertEqual(as_lists(store.iter_records()), expected)
+
+    def test_reload_after_mutations(self):
+        expected = expected_after(OPERATIONS)
+        for mode in self.MODES:
+            with self.subTest(mode=mode):
+                store = self.open(mode)
+                for operation in OPERATIONS:
+                    store.apply(*operation)
+                self.assertStoreEqual(store, expected)
+                store.close()
+
+                store = self.open(mode)
+                try:
+                    self.assertStoreEqual(store, expected)
+                finally:
+                    store.close()
+            shutil.rmtree(self.directory)
+            os.makedirs(self.directory)
+
+    def test_reload_after_compaction(self):
+        # 合并前后都有修改；第二次合并时快照中已有的记录一部分被修改，一部分原样复制
+        expected = expected_after(OPERATIONS, MORE_OPERATIONS)
+        for mode in ('journal', 'lazy', 'sharded'):
+            with self.subTest(mode=mode):
+                store = self.open(mode)
+                store.apply_batch(OPERATIONS)
+                store.compact()
+                self.assertEqual(os.path.getsize(store.journal_filename), 0)
+                self.assertFalse(os.path.exists(store.old_journal_filename))
+                store.apply_batch(MORE_OPERATIONS[:1])
+                store.compact()
+                store.apply_batch(MORE_OPERATIONS[1:])  # 留在日志中，重新打开时重放
+                self.assertStoreEqual(store, expected)
+                store.close()
+
+                store = self.open(mode)
+                try:
+                    self.assertStoreEqual(store, expected)
+                    store.compact()
+                finally:
+                    store.close()
+                store = self.open(mode)
+                try:
+                    self.assertStoreEqual(store, expected)
+                finally:
+                    store.close()
+            shutil.rmtree(self.directory)
+            os.makedirs(self.directory)
+
+    def test_lazy_offsets_follow_compaction(self):
+        # 合并后保存的偏移索引与新快照一致，重新打开时直接使用而不重新扫描
+        store = self.open('lazy')
+        store.apply_batch(OPERATIONS)
+        store.compact()
+        store.close()
+        with open(self.filename + '.offsets', 'r', encoding='utf-8') as file:
+            file.readline()
+            offsets = dict(line.rstrip('\n').rsplit(',', 1) for line in file)
+        self.assertEqual(set(offsets), set(expected_after(OPERATIONS)))
+
+        records = core.LazyRecords(self.filename)
+        try:
+            scanned = records.scan()
+            self.assertEqual({barcode: int(offset) for barcode, offset in offsets.items()}, scanned)
+            self.assertEqual(as_lists(records), expected_after(OPERATIONS))
+        finally:
+            records.close()
+
+    def test_sharded_manifest_counts(self):
+        # 清单中的记录数与各分片一致，只有修改过的分片被重写
+        store = self.open('sharded')
+        store.apply_batch(OPERATIONS)
+        store.compact()
+        store.close()
+        with open(os.path.join(self.filename + '.shards', 'manifest.json'), 'r') as file:
+            manifest = json.load(file)
+        self.assertEqual(manifest['shard_count'], 4)
+        counts = [0] * 4
+        for barcode in expected_after(OPERATIONS):
+            counts[core.shard_of(barcode, 4)] += 1
+        self.assertEqual(manifest['counts'], counts)
+
+        untouched = next(index for index, count in enumerate(counts)
+                         if core.shard_of('6900000000004', 4) != index
+                         and core.shard_of('6900000000002', 4) != index)
+        shard_filename = os.path.join(self.filename + '.shards', f'shard-{untouched:03d}.txt')
+        modified = os.stat(shard_filename).st_mtime_ns if os.path.exists(shard_filename) else None
+        store = self.open('sharded')
+        try:
+            store.apply_batch(MORE_OPERATIONS[:2])
+            store.compact()
+            self.assertEqual(len(store.data), len(expected_after(OPERATIONS, MORE_OPERATIONS[:2])))
+        finally:
+            store.close()
+        self.assertEqual(os.stat(shard_filename).st_mtime_ns if os.path.exists(shard_filename) else None, modified)
+
+    def test_sharded_splits_existing_data_file(self):
+        # 首次以分片模式打开时，拆分已有的数据文件和日志
+        store = self.open('journal')
+        store.apply_batch(OPERATIONS)
+        store.compact()
+        store.apply_batch(MORE_OPERATIONS)
+        store.close()
+
+        store = self.open('sharded')
+        try:
+            self.assertStoreEqual(store, expected_after(OPERATIONS, MORE_OPERATIONS))
+        finally:
+            store.close()
+
+
+class SQLiteMigrationTest(unittest.TestCase):
+    """SQLite 存储首次打开时从已有的文本数据迁移，之后以数据库为准"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'medicine_data.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_migrates_data_file_and_journal(self):
+        # 快照和尚未合并的日志都迁移过来
+        core.write_data(self.filename, {'6900000000009': core.MedicationRecord('阿司匹林肠溶片', [code(91), 'LOT-B2'])})
+        with open(self.filename + '.journal', 'w') as journal:
+            journal.writelines(core.format_operation(*operation) for operation in OPERATIONS)
+        expected = expected_after([('CREATE', '6900000000009', code(91), '阿司匹林肠溶片'),
+                                   ('ADD', '6900000000009', 'LOT-B2', None)], OPERATIONS)
+
+        store = core.SQLiteStore(self.filename)
+        try:
+            self.assertEqual(as_lists(store.data), expected)
+            self.assertEqual(as_lists(store.iter_records()), expected)
+            store.apply_batch(MORE_OPERATIONS)
+        finally:
+            store.close()
+
+        # 迁移只做一次：之后文本文件的变化不再读入
+        core.write_data(self.filename, {'6900000000010': core.MedicationRecord('维生素B1片', [code(101)])})
+        store = core.SQLiteStore(self.filename)
+        try:
+            self.assertEqual(as_lists(store.data), expected_after(
+                [('CREATE', '6900000000009', code(91), '阿司匹林肠溶片'), ('ADD', '6900000000009', 'LOT-B2', None)],
+                OPERATIONS, MORE_OPERATIONS))
+            self.assertEqual(as_lists(store.copy_records()), as_lists(store.data))
+        finally:
+            store.close()
+
+    def test_migrates_shards(self):
+        store = core.ShardedStore(self.filename, shard_count=4)
+        store.apply_batch(OPERATIONS)
+        store.compact()
+        store.apply_batch(MORE_OPERATIONS)
+        store.close()
+
+        store = core.SQLiteStore(self.filename)
+        try:
+            self.assertEqual(as_lists(store.data), expected_after(OPERATIONS, MORE_OPERATIONS))
+        finally:
+            store.close()
+
+    def test_empty_data_is_migrated_once(self):
+        store = core.SQLiteStore(self.filename)
+        store.close()
+        core.write_data(self.filename, {'6900000000010': core.MedicationRecord('维生素B1片', [code(101)])})
+        store = core.SQLiteStore(self.filename)
+        try:
+            self.assertEqual(as_lists(store.data), {})
+        finally:
+            store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
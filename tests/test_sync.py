@@ -0,0 +1,208 @@
+import importlib.util
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import traceability_core as core
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+
+class ApplyRemoteChangesTest(unittest.TestCase):
+    """合并其他终端的修改"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        config = dict(core.DEFAULT_APP_CONFIG, snapshot_interval_hours=0)
+        self.service = core.TraceabilityService(os.path.join(self.directory, 'medicine_data.txt'), config)
+
+    def tearDown(self):
+        self.service.close()
+        shutil.rmtree(self.directory)
+
+    def test_skipped_create_does_not_abort_later_operations(self):
+        # 远端 CREATE 的追溯码本地尚未上传而被跳过，之后对同一条形码的 ADD 改为建立记录
+        local = [('ADD', '6900000000001', '81000000000000000001', None)]
+        changes = [
+            ('CREATE', '6900000000002', '81000000000000000001', '阿莫西林胶囊'),
+            ('ADD', '6900000000002', '81000000000000000002', None),
+            ('DELETE', '6900000000003', '81000000000000000003', None),
+        ]
+        changed = self.service.apply_remote_changes(changes, local)
+        self.assertEqual(changed, {'6900000000002'})
+        self.assertEqual(self.service.lookup('6900000000002'), ('阿莫西林胶囊', ['81000000000000000002']))
+        self.assertIsNone(self.service.lookup('6900000000003'))
+
+    def test_codes_from_replaced_base_are_found_by_sales(self):
+        # 整体替换为远端基线后，售出的追溯码按索引找到持有的条形码，不在库的只计入未找到
+        remote = {'6900000000004': core.MedicationRecord('布洛芬缓释胶囊', ['82000000000000000001'])}
+        self.service.on_webdav_checked(False, remote, [])
+        operations = self.service.commit_sales([(None, '82000000000000000001'), (None, '82000000000000000009')])
+        self.assertEqual(operations, [('DELETE', '6900000000004', '82000000000000000001', None)])
+        self.assertEqual(self.service.lookup('6900000000004'), ('布洛芬缓释胶囊', []))
+
+
+
+@unittest.skipUnless(importlib.util.find_spec('webdav3'), "需要 webdavclient3")
+class TerminalsTest(unittest.TestCase):
+    """多个终端通过本地 WebDAV 替身服务器同步；每个终端一个工作目录，数据文件名相同"""
+
+    def setUp(self):
+        from run_benchmarks import LocalWebDAVServer
+        self.directory = tempfile.mkdtemp()
+        self.server_directory = os.path.join(self.directory, 'webdav')
+        os.makedirs(self.server_directory)
+        open(os.path.join(self.server_directory, 'medicine_data.txt'), 'w').close()
+        self.server = LocalWebDAVServer(self.server_directory)
+        self.cwd = os.getcwd()
+        self.terminals = {}
+        self.service = None
+
+    def tearDown(self):
+        if self.service is not None:
+            self.at('a', self.service.close)
+        self.server.stop()
+        core.reset_webdav_client()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def terminal_directory(self, name):
+        directory = os.path.join(self.directory, name)
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, 'webdav_config.json'), 'w') as file:
+            json.dump({'webdav_hostname': self.server.url, 'webdav_login': '', 'webdav_password': '',
+                       'webdav_root': '/'}, file)
+        return directory
+
+    def at(self, name, function, *args):
+        # 在终端的工作目录中执行
+        os.chdir(os.path.join(self.directory, name))
+        try:
+            return function(*args)
+        finally:
+            os.chdir(self.cwd)
+
+    def sync(self, name, compact_threshold=0):
+        self.terminal_directory(name)
+        self.terminals[name] = self.at(name, core.WebDAVSync, 'medicine_data.txt', 2000, 'gzip', compact_threshold)
+        return self.terminals[name]
+
+    def codes(self, sync, barcode):
+        record = sync.replica.data.get(barcode)
+        return sorted(record.codes()) if record is not None else None
+
+    def restart_server(self):
+        # 换一个端口重新启动，之间的请求都会失败
+        from run_benchmarks import LocalWebDAVServer
+        self.server.stop()
+        self.server = LocalWebDAVServer(self.server_directory)
+        for name in os.listdir(self.directory):
+            if os.path.exists(os.path.join(self.directory, name, 'webdav_config.json')):
+                self.terminal_directory(name)
+        core.reset_webdav_client()
+
+    def test_concurrent_add_and_delete_converge(self):
+        # 两个终端都没看到对方的修改时，同一追溯码的添加和删除按时间戳取最大的一条，两边结果相同
+        a, b = self.sync('a'), self.sync('b')
+        self.at('a', a.pull)
+        self.at('b', b.pull)
+        code = '83000000000000000001'
+        self.assertTrue(self.at('a', a.push, [('CREATE', '6900000000001', code, '阿莫西林胶囊')]))
+        self.at('b', b.pull)
+        self.assertTrue(self.at('a', a.push, [('DELETE', '6900000000001', code, None)]))
+        self.assertTrue(self.at('b', b.push, [('ADD', '6900000000001', code, None)]))
+        self.at('a', a.pull)
+        self.at('b', b.pull)
+        self.assertEqual(self.codes(a, '6900000000001'), self.codes(b, '6900000000001'))
+        # 时钟相同，按终端标识决定先后
+        expected = [code] if b.terminal_id > a.terminal_id else []
+        self.assertEqual(self.codes(a, '6900000000001'), expected)
+        # 看到对方修改之后的删除一定胜出
+        self.assertTrue(self.at('a', a.push, [('DELETE', '6900000000001', code, None)]))
+        self.at('b', b.pull)
+        self.assertEqual(self.codes(a, '6900000000001'), [])
+        self.assertEqual(self.codes(b, '6900000000001'), [])
+
+    def test_replay_after_compaction(self):
+        # 合并后新终端只需下载基线和检查点之后的日志，结果与一直同步的终端相同
+        a, b = self.sync('a'), self.sync('b', compact_threshold=1)
+        self.at('a', a.pull)
+        self.at('a', a.push, [('CREATE', '6900000000002', '83000000000000000002', '布洛芬缓释胶囊'),
+                              ('ADD', '6900000000002', '83000000000000000003', None)])
+        self.at('b', b.pull)  # 超过阈值，合并为新基线
+        self.assertIsNotNone(b.state.get('checkpoint'))
+        self.at('a', a.push, [('DELETE', '6900000000002', '83000000000000000002', None),
+                              ('ADD', '6900000000002', '83000000000000000004', None)])
+        c = self.sync('c')
+        self.at('c', c.pull)
+        self.at('a', a.pull)
+        expected = ['83000000000000000003', '83000000000000000004']
+        for sync in (a, c):
+            self.assertEqual(self.codes(sync, '6900000000002'), expected)
+            self.assertEqual(sorted(self.at('c' if sync is c else 'a', sync.load_replica).data['6900000000002'].codes()),
+                             expected)
+
+    def test_pack_falls_back_to_text_base(self):
+        # 没有压缩副本、副本损坏或已过期（旧版本终端改写了纯文本基线）时都按纯文本基线读取
+        base_filename = os.path.join(self.server_directory, 'medicine_data.txt')
+        with open(base_filename, 'w') as file:
+            file.write('6900000000005,阿莫西林胶囊,85000000000000000001,LOT-A1\n')
+        expected = {'6900000000005': ['阿莫西林胶囊', '85000000000000000001', 'LOT-A1']}
+
+        a = self.sync('a')
+        data, _ = self.at('a', a.pull)
+        self.assertEqual({barcode: list(record) for barcode, record in data.items()}, expected)
+        self.assertTrue(os.path.exists(base_filename + '.pack'))  # 替其他终端上传了副本
+        b = self.sync('b')
+        data, _ = self.at('b', b.pull)
+        self.assertEqual({barcode: list(record) for barcode, record in data.items()}, expected)
+
+        with open(base_filename + '.pack', 'wb') as file:
+            file.write(core.PACK_MAGIC + bytes([core.PACK_VERSION + 1, 0]))
+        c = self.sync('c')
+        data, _ = self.at('c', c.pull)
+        self.assertEqual({barcode: list(record) for barcode, record in data.items()}, expected)
+
+        with open(base_filename, 'a') as file:
+            file.write('6900000000006,布洛芬缓释胶囊,85000000000000000002\n')
+        data, _ = self.at('b', b.pull)
+        self.assertEqual(list(data['6900000000006']), ['布洛芬缓释胶囊', '85000000000000000002'])
+
+    def test_offline_edit_survives_remote_compaction(self):
+        # 上传失败和离线时的修改留在待上传队列，其他终端合并出新基线后仍然保留，重新连接后上传
+        self.terminal_directory('a')
+        config = dict(core.DEFAULT_APP_CONFIG, snapshot_interval_hours=1000, webdav_compact_threshold=0)
+        self.service = self.at('a', core.TraceabilityService, 'medicine_data.txt', config)
+        self.at('a', self.service.check_webdav)
+        self.assertTrue(self.service.webdav_connected)
+        self.at('a', self.service.create, '6900000000003', '头孢克肟片', '84000000000000000001')
+
+        self.server.stop()
+        self.at('a', self.service.add, '6900000000003', ['84000000000000000002'])  # 前台上传失败
+        self.assertFalse(self.service.webdav_connected)
+        self.at('a', self.service.add, '6900000000003', ['84000000000000000003'])  # 离线
+        self.restart_server()
+
+        b = self.sync('b', compact_threshold=1)
+        self.at('b', b.pull)
+        self.at('b', b.push, [('CREATE', '6900000000004', '84000000000000000004', '维生素C片')])
+        self.at('b', b.pull)
+        self.assertIsNotNone(b.state.get('checkpoint'))
+
+        changed = self.at('a', self.service.check_webdav)
+        self.assertIn('6900000000003', changed)
+        self.assertTrue(self.service.webdav_connected)
+        self.assertEqual(self.service.lookup('6900000000003'),
+                         ('头孢克肟片', ['84000000000000000001', '84000000000000000002', '84000000000000000003']))
+        self.assertEqual(self.service.lookup('6900000000004'), ('维生素C片', ['84000000000000000004']))
+        self.assertEqual(self.service.webdav_sync.pending_operations(), [])
+        self.at('b', b.pull)
+        self.assertEqual(self.codes(b, '6900000000003'),
+                         ['84000000000000000001', '84000000000000000002', '84000000000000000003'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,267 @@
+"""追溯码记录器命令行：不打开界面，直接查询、添加、删除、批量导入导出和同步
+
+与图形界面共用数据文件、事件日志和追溯码索引（见 traceability_core）。
+用法示例：
+    python traceability_cli.py lookup 6901234567890
+    python traceability_cli.py at 6901234567890 2024-03-01     # 该条形码在 3 月 1 日结束时的追溯码
+    python traceability_cli.py search 阿莫西林
+    python traceability_cli.py create 6901234567890 阿莫西林胶囊 12345678901234567890
+    python traceability_cli.py add 6901234567890 12345678901234567891 12345678901234567892
+    python traceability_cli.py delete 6901234567890 12345678901234567891
+    python traceability_cli.py add 6901234567890 - < codes.txt     # 从标准输入读取追溯码
+    python traceability_cli.py import codes.csv --sync
+    python traceability_cli.py export all.jsonl
+    python traceability_cli.py sync
+    python traceability_cli.py stats --days 7                  # 库存汇总、滞销药品和最近 7 天的进出
+    python traceability_cli.py archive --sync                  # 把超过 archive_after_days 的冷数据移入归档
+    python traceability_cli.py labels labels.pdf --barcode 6901234567890   # 打印该条形码下全部追溯码的标签
+    python traceability_cli.py labels labels.pdf - < codes.txt
+
+修改类命令加 --sync 时先连接 WebDAV 合并其他终端的修改，再把本次修改上传。
+"""
+import argparse
+import json
+import sys
+
+from traceability_core import TraceabilityService, data_filename, format_import_summary
+from traceability_labels import LabelLayout, generate_label_sheets
+
+
+def read_codes(values):
+    # "-" 表示从标准输入读取，每行一个或以空白分隔
+    codes = []
+    for value in values:
+        if value == '-':
+            codes.extend(sys.stdin.read().split())
+        else:
+            codes.append(value)
+    return codes
+
+
+def print_result(args, result, text):
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False))
+    else:
+        print(text)
+
+
+def connect(service):
+    # 连接失败时修改只保存在本地，与界面离线时相同
+    service.check_webdav()
+    if not service.webdav_connected:
+        print("未连接WebDAV服务器，修改只保存在本地", file=sys.stderr)
+
+
+def command_lookup(service, args):
+    found = service.lookup(args.barcode)
+    if found is None:
+        raise ValueError(f"未找到条形码 {args.barcode}。")
+    medication, codes = found
+    print_result(args, {'barcode': args.barcode, 'medication': medication, 'traceabilities': codes},
+                 f"药品名称: {medication}\n条形码: {args.barcode}\n追溯码数量: {len(codes)}"
+                 + ''.join(f"\n{code}" for code in codes))
+
+
+def command_at(service, args):
+    found = service.lookup_at(args.barcode, args.time)
+    if found is None:
+        raise ValueError(f"{args.time} 时没有条形码 {args.barcode} 的记录。")
+    medication, codes = found
+    print_result(args, {'barcode': args.barcode, 'time': args.time, 'medication': medication,
+                        'traceabilities': codes},
+                 f"截至 {args.time}\n药品名称: {medication}\n条形码: {args.barcode}\n追溯码数量: {len(codes)}"
+                 + ''.join(f"\n{code}" for code in codes))
+
+
+def command_search(service, args):
+    matches = [(barcode, service.data[barcode][0]) for barcode in service.search(args.term)]
+    print_result(args, [{'barcode': barcode, 'medication': medication} for barcode, medication in matches],
+                 '\n'.join(f"{barcode}  {medication}" for barcode, medication in matches) or "未找到相关药品")
+
+
+def command_seen(service, args):
+    results = [{'traceability': code, 'barcode': service.find_traceability_owner(code),
+                'last_seen': service.last_seen(code)} for code in read_codes(args.traceabilities)]
+    print_result(args, results, '\n'.join(
+        f"{result['traceability']}  当前条形码: {result['barcode'] or '无'}  最近添加: {result['last_seen'] or '从未添加'}"
+        for result in results))
+
+
+def command_create(service, args):
+    service.create(args.barcode, args.medication, args.traceability, allow_seen_before=args.allow_seen)
+    print_result(args, {'created': args.barcode, 'added': 1}, f"已创建 {args.barcode} {args.medication}")
+
+
+def command_add(service, args):
+    codes = read_codes(args.traceabilities)
+    service.add(args.barcode, codes, allow_seen_before=args.allow_seen)
+    print_result(args, {'barcode': args.barcode, 'added': len(set(codes))},
+                 f"已添加 {len(set(codes))} 个追溯码到 {args.barcode}")
+
+
+def command_delete(service, args):
+    codes = read_codes(args.traceabilities)
+    service.delete(args.barcode, codes)
+    print_result(args, {'barcode': args.barcode, 'deleted': len(set(codes))},
+                 f"已从 {args.barcode} 删除 {len(set(codes))} 个追溯码")
+
+
+def command_import(service, args):
+    stats = service.import_file(args.filename)
+    print_result(args, stats, format_import_summary(stats))
+    if stats['error_count']:
+        return 1
+
+
+def command_export(service, args):
+    count = service.export(args.filename)
+    print_result(args, {'exported': count}, f"导出完成：共 {count} 个追溯码")
+
+
+def command_sync(service, args):
+    changed = service.check_webdav()
+    if not service.webdav_connected:
+        raise ValueError("无法连接WebDAV服务器。")
+    print_result(args, {'changed_barcodes': len(changed)}, f"同步完成：{len(changed)} 个条形码有变化")
+
+
+def command_stats(service, args):
+    stats = service.stats
+    medications, on_hand = stats.summary()
+    slowest = stats.slowest(args.top)
+    days = stats.recent_days(args.days)
+    result = {'medications': medications, 'on_hand': on_hand,
+              'top_stock': [{'barcode': barcode, 'medication': medication, 'on_hand': count}
+                            for barcode, medication, count in stats.top_stock(args.top)],
+              'slowest': [{'barcode': barcode, 'medication': medication, 'on_hand': count, 'last_deleted': last}
+                          for barcode, medication, count, last in slowest],
+              'daily': [{'date': day, 'added': added, 'deleted': deleted} for day, added, deleted in days]}
+    lines = [f"药品 {medications} 种，在库追溯码 {on_hand} 个", "在库最多:"]
+    lines += [f"  {item['barcode']}  {item['medication']}  {item['on_hand']}" for item in result['top_stock']]
+    lines.append("滞销:")
+    lines += [f"  {item['barcode']}  {item['medication']}  {item['on_hand']}  最近删除: {item['last_deleted'] or '从未'}"
+              for item in result['slowest']]
+    lines.append("每日进出:")
+    lines += [f"  {item['date']}  添加 {item['added']}  删除 {item['deleted']}" for item in result['daily']]
+    print_result(args, result, '\n'.join(lines))
+
+
+def command_archive(service, args):
+    if not service.config['archive_after_days']:
+        print_result(args, {'events': 0, 'index_entries': 0}, "未启用归档（archive_after_days 为 0）")
+        return
+    result = service.archive_cold_data()
+    print_result(args, result, f"归档完成：事件 {result['events']} 条，索引条目 {result['index_entries']} 个")
+
+
+def command_labels(service, args):
+    codes = read_codes(args.traceabilities)
+    for barcode in args.barcode:
+        found = service.lookup(barcode)
+        if found is None:
+            raise ValueError(f"未找到条形码 {barcode}。")
+        codes.extend(found[1])
+    if not codes:
+        raise ValueError("没有要打印的追溯码。")
+    layout = LabelLayout(columns=args.columns, rows=args.rows)
+    filenames = generate_label_sheets(codes, args.filename, layout, workers=args.workers)
+    print_result(args, {'labels': len(codes), 'files': filenames},
+                 f"已生成 {len(codes)} 个标签：{', '.join(filenames)}")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="追溯码记录器命令行")
+    parser.add_argument('--data', default=data_filename, help="数据文件，默认与界面相同")
+    parser.add_argument('--json', action='store_true', help="以 JSON 输出结果")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('lookup', help="按条形码查询药品和追溯码")
+    command.add_argument('barcode')
+    command.set_defaults(handler=command_lookup)
+
+    command = commands.add_parser('at', help="查询条形码在某一时刻的追溯码（按快照和事件日志重建）")
+    command.add_argument('barcode')
+    command.add_argument('time', help="YYYY-MM-DD 或 'YYYY-MM-DD HH:MM:SS'，只有日期时取当天结束")
+    command.set_defaults(handler=command_at)
+
+    command = commands.add_parser('search', help="按药品名称或拼音搜索")
+    command.add_argument('term')
+    command.set_defaults(handler=command_search)
+
+    command = commands.add_parser('seen', help="查询追溯码当前所在的条形码和最近添加时间")
+    command.add_argument('traceabilities', nargs='+', help="追溯码，- 表示从标准输入读取")
+    command.set_defaults(handler=command_seen)
+
+    command = commands.add_parser('create', help="新建药品记录并添加第一个追溯码")
+    command.add_argument('barcode')
+    command.add_argument('medication')
+    command.add_argument('traceability')
+    command.set_defaults(handler=command_create)
+
+    command = commands.add_parser('add', help="向已有条形码添加追溯码")
+    command.add_argument('barcode')
+    command.add_argument('traceabilities', nargs='+', help="追溯码，- 表示从标准输入读取")
+    command.set_defaults(handler=command_add)
+
+    command = commands.add_parser('delete', help="删除条形码下的追溯码")
+    command.add_argument('barcode')
+    command.add_argument('traceabilities', nargs='+', help="追溯码，- 表示从标准输入读取")
+    command.set_defaults(handler=command_delete)
+
+    command = commands.add_parser('import', help="批量导入 CSV/JSONL 文件")
+    command.add_argument('filename')
+    command.set_defaults(handler=command_import)
+
+    command = commands.add_parser('export', help="导出全部记录到 CSV/JSONL 文件")
+    command.add_argument('filename')
+    command.set_defaults(handler=command_export)
+
+    command = commands.add_parser('sync', help="连接WebDAV服务器，合并其他终端的修改")
+    command.set_defaults(handler=command_sync)
+
+    command = commands.add_parser('stats', help="库存统计：在库最多、滞销药品和每日进出")
+    command.add_argument('--top', type=int, default=10, help="列出的药品数")
+    command.add_argument('--days', type=int, default=30, help="列出最近多少天")
+    command.set_defaults(handler=command_stats)
+
+    command = commands.add_parser('archive', help="把超过 archive_after_days 的冷数据移入压缩归档")
+    command.set_defaults(handler=command_archive)
+
+    command = commands.add_parser('labels', help="批量生成追溯码标签页（.pdf 或 .png）")
+    command.add_argument('filename')
+    command.add_argument('traceabilities', nargs='*', help="追溯码，- 表示从标准输入读取")
+    command.add_argument('--barcode', action='append', default=[], help="打印该条形码下的全部追溯码，可重复")
+    command.add_argument('--columns', type=int, default=3, help="每页列数")
+    command.add_argument('--rows', type=int, default=8, help="每页行数")
+    command.add_argument('--workers', type=int, help="渲染进程数，默认按 CPU 数")
+    command.set_defaults(handler=command_labels)
+
+    for name in ('create', 'add', 'delete', 'import', 'archive'):
+        command = commands.choices[name]
+        command.add_argument('--sync', action='store_true', help="先合并远端修改，再上传本次修改")
+    for name in ('create', 'add'):
+        commands.choices[name].add_argument('--allow-seen', action='store_true',
+                                            help="允许添加曾经添加过的追溯码")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        service = TraceabilityService(args.data)
+    except ValueError as e:
+        print(f"错误: {e}", file=sys.stderr)
+        return 1
+    try:
+        if getattr(args, 'sync', False):
+            connect(service)
+        return args.handler(service, args) or 0
+    except ValueError as e:
+        print(f"错误: {e}", file=sys.stderr)
+        return 1
+    finally:
+        service.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,3626 @@
+"""追溯码记录器核心：数据存储、追溯码索引、事件日志、批量导入导出和 WebDAV 同步
+
+不依赖界面库，可供图形界面、命令行（traceability_cli.py）和脚本直接导入：
+
+    from traceability_core import TraceabilityService
+    service = TraceabilityService()
+    print(service.lookup('6901234567890'))
+"""
+import io
+import os
+import json
+import datetime
+import gzip
+import logging
+import logging.handlers
+import locale
+import mmap
+import csv
+import sqlite3
+import re
+import struct
+import sys
+import threading
+import queue
+import time
+import heapq
+import bisect
+import collections
+import uuid
+import shutil
+import tempfile
+import zlib
+import functools
+import itertools
+from abc import ABC, abstractmethod
+from array import array
+from collections.abc import MutableMapping
+
+# webdav3、pypinyin 导入较慢，在首次使用时才导入
+
+# 用户目录（Windows 为 USERPROFILE，其他系统为主目录）
+user_directory = os.environ.get('USERPROFILE', os.path.expanduser('~'))
+
+# 日志配置
+log_directory = os.path.join(user_directory, 'Documents', 'Traceability code records', 'log')
+os.makedirs(log_directory, exist_ok=True)
+log_filename = os.path.join(log_directory, 'tracker.log')
+LOG_MAX_BYTES = 10 * 1024 * 1024  # tracker.log 超过该大小后轮转
+LOG_BACKUP_COUNT = 10
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
+                    handlers=[logging.handlers.RotatingFileHandler(log_filename, maxBytes=LOG_MAX_BYTES,
+                                                                   backupCount=LOG_BACKUP_COUNT)])
+
+# 结构化事件日志目录
+audit_directory = os.path.join(log_directory, 'audit')
+
+# 数据快照目录，用于重建历史某一时刻的数据
+snapshot_directory = os.path.join(log_directory, 'snapshots')
+
+# 追溯码索引文件路径
+index_filename = os.path.join(log_directory, 'tracker.idx')
+
+# 独占锁文件：图形界面和命令行共用数据和日志文件，同时只允许一个进程打开
+lock_filename = os.path.join(log_directory, 'tracker.lock')
+
+# 库存统计文件路径
+stats_filename = os.path.join(log_directory, 'stats.json')
+
+# 冷数据归档目录
+archive_directory = os.path.join(log_directory, 'archive')
+
+# 匹配 log_event 写入的事件行
+LOG_EVENT_PATTERN = re.compile(r'(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}) - (ADD|CREATE|DELETE) - '
+                               r'Barcode: (\S+?), Medication: .*, Traceability: (\d{20})\s*$')
+
+# medicine_data.txt 文件路径
+data_directory = os.path.join(user_directory, 'Documents', 'Traceability code records', 'userdata')
+os.makedirs(data_directory, exist_ok=True)
+data_filename = os.path.join(data_directory, 'medicine_data.txt')
+
+# 应用配置（app_config.json 可选，未配置的项使用以下默认值）
+DEFAULT_APP_CONFIG = {
+    'storage_mode': 'journal',  # journal: 快照+追加日志；lazy: 同 journal，但快照内存映射、按需解析；sharded: 按条形码分片的快照+追加日志；sqlite: SQLite 数据库；text: 每次修改重写整个数据文件
+    'shard_count': 64,  # sharded 模式新建分片目录时的分片数，已有目录以清单为准
+    'audit_segment_size': 16 * 1024 * 1024,  # 事件日志每个分段的字节数，每天也会开始新分段
+    'archive_after_days': 365,  # 早于该天数的事件日志、已不在库且最近添加早于该天数的追溯码索引条目移入压缩归档，0 为不归档
+    'snapshot_interval_hours': 24,  # 每隔多少小时保存一次数据快照，查询历史某一时刻时从最近的快照开始重放
+    'slow_operation_ms': 200,  # 热点操作超过该耗时写入警告日志
+    'journal_compact_threshold': 256 * 1024,  # 日志超过该字节数后在后台合并到快照
+    'webdav_delta_threshold': 64 * 1024,  # 本终端操作日志每段的字节数，写满后开始新的一段
+    'webdav_pull_interval': 30,  # 空闲时每隔多少秒拉取其他终端的新修改
+    'webdav_compact_threshold': 1024 * 1024,  # 各终端操作日志中未并入远端基线的部分超过该字节数时合并到基线，0 为不合并
+    'webdav_transfer_format': 'gzip',  # 远端基线的传输格式：text 只传纯文本；gzip / zstd 另存压缩打包副本（zstd 需要安装 zstandard）
+    'startup_time_target_ms': 1000,  # 从导入模块到窗口可用的目标时间，超出时记录警告
+    'barcode_prewarm': True,  # 显示药品时预先生成可见追溯码的条形码图像
+    'scanner_accept_seen_before': False,  # 扫码模式下是否接受曾经添加过的追溯码
+    'sales_listener_host': '127.0.0.1',  # 销售平台推送售出追溯码的本地监听地址
+    'sales_listener_port': 8765,
+}
+
+# 耗时统计
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)  # 直方图各桶上限，最后一桶为更慢的
+LATENCY_WINDOW = 1000  # 每项操作保留最近多少次耗时用于计算分位数
+
+
+class LatencyStats:
+    """热点操作耗时统计：最近若干次的分位数、累计直方图，超过阈值的操作写入日志"""
+
+    def __init__(self, slow_threshold_ms=DEFAULT_APP_CONFIG['slow_operation_ms']):
+        self.slow_threshold_ms = slow_threshold_ms
+        self.lock = threading.Lock()  # 后台同步线程也会记录
+        self.operations = {}
+
+    def record(self, name, elapsed_ms):
+        with self.lock:
+            stats = self.operations.get(name)
+            if stats is None:
+                stats = self.operations[name] = {
+                    'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'slow': 0,
+                    'recent': collections.deque(maxlen=LATENCY_WINDOW),
+                    'histogram': [0] * (len(LATENCY_BUCKETS_MS) + 1)}
+            stats['count'] += 1
+            stats['total_ms'] += elapsed_ms
+            stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+            stats['recent'].append(elapsed_ms)
+            stats['histogram'][bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+            slow = elapsed_ms >= self.slow_threshold_ms
+            if slow:
+                stats['slow'] += 1
+        if slow:
+            logging.warning(f"Slow operation: {name} took {elapsed_ms:.0f} ms")
+
+    def summary(self):
+        """返回 {操作: 次数、平均、p50/p95（最近 LATENCY_WINDOW 次）、最大、慢操作数、直方图}"""
+        with self.lock:
+            summary = {}
+            for name, stats in self.operations.items():
+                recent = sorted(stats['recent'])
+                summary[name] = {
+                    'count': stats['count'],
+                    'mean_ms': stats['total_ms'] / stats['count'],
+                    'p50_ms': recent[int(0.5 * (len(recent) - 1))],
+                    'p95_ms': recent[int(0.95 * (len(recent) - 1))],
+                    'max_ms': stats['max_ms'],
+                    'slow': stats['slow'],
+                    'histogram': dict(zip([f"<={bound}ms" for bound in LATENCY_BUCKETS_MS] + ['slower'],
+                                          stats['histogram'])),
+                }
+            return summary
+
+    def reset(self):
+        with self.lock:
+            self.operations = {}
+
+
+perf_stats = LatencyStats()
+
+
+def timed(name):
+    """装饰器：把函数耗时记入 perf_stats"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                perf_stats.record(name, (time.perf_counter() - started) * 1000)
+        return wrapper
+    return decorator
+
+
+def load_app_config():
+    config = dict(DEFAULT_APP_CONFIG)
+    try:
+        with open('app_config.json', 'r') as file:
+            config.update(json.load(file))
+    except FileNotFoundError:
+        pass
+    return config
+
+
+def load_webdav_config():
+    with open('webdav_config.json', 'r') as file:
+        config = json.load(file)
+        # print("Loaded WebDAV configuration:", config)
+        # logging.info("Loaded WebDAV configuration: %s", config)
+        return config
+
+
+# 复用的WebDAV客户端（保持同一个HTTP会话）
+_webdav_client = None
+_webdav_client_config = None
+_webdav_client_lock = threading.Lock()
+
+
+def get_webdav_client():
+    """返回长期复用的WebDAV客户端及其配置"""
+    global _webdav_client, _webdav_client_config
+    with _webdav_client_lock:
+        if _webdav_client is None:
+            from webdav3.client import Client
+            _webdav_client_config = load_webdav_config()
+            _webdav_client = Client(_webdav_client_config)
+        return _webdav_client, _webdav_client_config
+
+
+def reset_webdav_client():
+    # 配置变更后丢弃旧客户端，下次使用时按新配置重建
+    global _webdav_client, _webdav_client_config
+    with _webdav_client_lock:
+        _webdav_client = None
+        _webdav_client_config = None
+
+
+@timed('storage.read_data')
+def read_data(filename):
+    try:
+        return dict(iter_data(filename))
+    except FileNotFoundError:
+        return {}
+
+
+def iter_data(filename):
+    # 逐行读取数据文件，依次返回 (条形码, MedicationRecord)
+    with open(filename, 'r') as file:
+        for line in file:
+            parts = line.strip().split(',')
+            yield parts[0], MedicationRecord(parts[1] if len(parts) > 1 else '', parts[2:])
+
+
+def iter_journaled_data(snapshot_filenames, journal_filenames):
+    """逐条返回快照文件加上日志中的修改后的记录
+
+    只有日志涉及的条形码放在内存里，扫描完快照后应用日志再返回。
+    """
+    operations = []
+    for journal_filename in journal_filenames:
+        replay_journal(operations, journal_filename, lambda operations, *operation: operations.append(operation))
+    touched = {operation[1] for operation in operations}
+    pending = {}
+    for filename in snapshot_filenames:
+        for barcode, record in iter_data(filename):
+            if barcode in touched:
+                pending[barcode] = record
+            else:
+                yield barcode, record
+    for operation in operations:
+        apply_operation(pending, *operation)
+    yield from pending.items()
+
+
+@timed('storage.write_data')
+def write_data(filename, data):
+    # 先写临时文件再替换，写入中途崩溃不会截断原文件
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'w') as file:
+        for barcode, values in data.items():
+            line = f"{barcode},{','.join(values)}\n"
+            file.write(line)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_filename, filename)
+
+
+def replay_journal(data, journal_filename, apply=None):
+    # 按顺序把日志中的修改应用到 data
+    apply = apply or apply_operation
+    try:
+        with open(journal_filename, 'r') as journal:
+            for line in journal:
+                if not line.endswith('\n'):
+                    break  # 崩溃时未写完的最后一条记录
+                parts = line.rstrip('\n').split(',', 3)
+                if len(parts) >= 3:
+                    apply(data, *parts)
+    except FileNotFoundError:
+        pass
+
+
+def format_operation(action, barcode, traceability, medication=None):
+    line = f"{action},{barcode},{traceability}"
+    if medication is not None:
+        line += f",{medication}"
+    return line + '\n'
+
+
+def apply_operation(data, action, barcode, traceability, medication=None):
+    """对内存数据应用一条修改（ADD/DELETE/CREATE），重复应用结果不变"""
+    if action == 'CREATE':
+        data[barcode] = MedicationRecord(medication, [traceability])
+    elif action == 'ADD':
+        values = data.get(barcode)
+        if values is not None and traceability not in values:
+            values.append(traceability)
+    elif action == 'DELETE':
+        values = data.get(barcode)
+        if values is not None and traceability in values:
+            values.remove(traceability)
+
+
+# MedicationRecord 哈希表和数组中的标记值
+SLOT_EMPTY = -1
+SLOT_DELETED = -2
+HIGH_DELETED = 0xFF
+HIGH_OTHER = 0xFE  # 该位置是非20位的旧数据，低位数组存它在 _others 中的下标
+LOW_64_MASK = (1 << 64) - 1
+
+
+class MedicationRecord:
+    """一个条形码的记录：药品名称及其追溯码
+
+    20位追溯码按整数保存在数组里（低64位和高位分开存放），另用数组实现的开放寻址
+    哈希表记录每个追溯码的位置，查重和删除都是 O(1)，内存约为字符串列表的几分之一。
+    非20位的旧数据原样放在 _others 里，数组中同样占一个位置，保持添加顺序。
+    兼容原来 [药品名称, 追溯码, ...] 列表的用法：下标、迭代、len、in、append、remove。
+    """
+
+    __slots__ = ('medication', '_low', '_high', '_slots', '_live', '_dead', '_others', '_changes')
+
+    def __init__(self, medication, traceabilities=()):
+        traceabilities = list(traceabilities)
+        self.medication = medication
+        self._others = []  # 不是20位数字的旧数据，按原样保存
+        self._changes = 0  # 修改次数，只读视图据此判断缓存的位置是否过期
+        self._reset(len(traceabilities))
+        for traceability in traceabilities:
+            self.append(traceability)
+
+    def _reset(self, capacity):
+        self._low = array('Q')
+        self._high = array('B')
+        size = 8
+        while size < capacity * 2:
+            size *= 2
+        self._slots = array('i', [SLOT_EMPTY]) * size
+        self._live = 0
+        self._dead = 0
+
+    @staticmethod
+    def _encode(traceability):
+        if len(traceability) == 20 and traceability.isdigit():
+            return int(traceability)
+        return None
+
+    def _code_at(self, index):
+        return (self._high[index] << 64) | self._low[index]
+
+    def _value_at(self, index):
+        # 数组中某个有效位置上的追溯码字符串
+        if self._high[index] == HIGH_OTHER:
+            return self._others[self._low[index]]
+        return f"{self._code_at(index):020d}"
+
+    def _find(self, code):
+        # 返回 (槽位, 位置)；未找到时位置为 -1，槽位为可插入的位置
+        mask = len(self._slots) - 1
+        slot = (hash(code) * 0x9E3779B97F4A7C15 >> 17) & mask
+        free_slot = -1
+        while True:
+            index = self._slots[slot]
+            if index == SLOT_EMPTY:
+                return (slot if free_slot < 0 else free_slot), -1
+            if index == SLOT_DELETED:
+                if free_slot < 0:
+                    free_slot = slot
+            elif self._code_at(index) == code:
+                return slot, index
+            slot = (slot + 1) & mask
+
+    def _rebuild(self):
+        # 去掉已删除的追溯码并重建哈希表
+        entries = list(self._iter_entries())
+        self._others = []
+        self._reset(len(entries) + 1)
+        for entry in entries:
+            if isinstance(entry, str):
+                self._append_other(entry)
+            else:
+                self._insert(entry)
+
+    def _insert(self, code):
+        if (len(self._low) + 1) * 2 > len(self._slots):
+            self._rebuild()
+        slot, index = self._find(code)
+        if index >= 0:
+            return False
+        self._slots[slot] = len(self._low)
+        self._low.append(code & LOW_64_MASK)
+        self._high.append(code >> 64)
+        self._live += 1
+        return True
+
+    def _append_other(self, traceability):
+        self._low.append(len(self._others))
+        self._high.append(HIGH_OTHER)
+        self._others.append(traceability)
+        self._live += 1
+
+    def _iter_entries(self):
+        # 按添加顺序返回有效位置上的内容：20位追溯码为整数，旧数据为字符串
+        high = self._high
+        low = self._low
+        for index in range(len(low)):
+            if high[index] == HIGH_OTHER:
+                yield self._others[low[index]]
+            elif high[index] != HIGH_DELETED:
+                yield (high[index] << 64) | low[index]
+
+    def append(self, traceability):
+        self._changes += 1
+        code = self._encode(traceability)
+        if code is None:
+            self._append_other(traceability)
+        else:
+            self._insert(code)
+
+    def remove(self, traceability):
+        self._changes += 1
+        code = self._encode(traceability)
+        if code is None:
+            # 和列表一样删除第一个相同的值；删除的旧数据在 _others 中留空，重建时去掉
+            if traceability not in self._others:
+                raise ValueError(f"{traceability} not in record")
+            other = self._others.index(traceability)
+            self._others[other] = None
+            index = next(index for index in range(len(self._low))
+                         if self._high[index] == HIGH_OTHER and self._low[index] == other)
+        else:
+            slot, index = self._find(code)
+            if index < 0:
+                raise ValueError(f"{traceability} not in record")
+            self._slots[slot] = SLOT_DELETED
+        self._high[index] = HIGH_DELETED
+        self._live -= 1
+        self._dead += 1
+        if self._dead > 16 and self._dead > self._live:
+            self._rebuild()
+
+    def __contains__(self, traceability):
+        code = self._encode(traceability)
+        if code is None:
+            return traceability in self._others
+        return self._find(code)[1] >= 0
+
+    def codes(self):
+        """按添加顺序返回追溯码的只读序列（按需转换成字符串）"""
+        return TraceabilityCodes(self)
+
+    def __len__(self):
+        return 1 + self._live
+
+    def __iter__(self):
+        yield self.medication
+        for entry in self._iter_entries():
+            yield entry if isinstance(entry, str) else f"{entry:020d}"
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        if index < 0:
+            index += len(self)
+        if index == 0:
+            return self.medication
+        if not 0 < index < len(self):
+            raise IndexError("record index out of range")
+        return self.codes()[index - 1]
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return f"MedicationRecord({self.medication!r}, {len(self) - 1} codes)"
+
+    def packed(self):
+        """按添加顺序返回 (高位数组, 低64位数组, 非20位的旧数据)，供打包传输
+
+        旧数据在数组中的位置高位为 HIGH_OTHER，低位为它在返回的旧数据列表中的下标。
+        """
+        if not self._dead:
+            return array('B', self._high), array('Q', self._low), list(self._others)
+        high = array('B')
+        low = array('Q')
+        others = []
+        for entry in self._iter_entries():
+            if isinstance(entry, str):
+                high.append(HIGH_OTHER)
+                low.append(len(others))
+                others.append(entry)
+            else:
+                high.append(entry >> 64)
+                low.append(entry & LOW_64_MASK)
+        return high, low, others
+
+    @classmethod
+    def from_packed(cls, medication, high, low, others=()):
+        # packed() 的逆过程，直接插入整数，省去字符串转换；
+        # 数组中没有标出位置的旧数据（早先的打包格式）放在最后
+        record = cls(medication)
+        record._reset(len(low))
+        others = list(others)
+        used = 0
+        for code_high, code_low in zip(high, low):
+            if code_high == HIGH_OTHER:
+                record._append_other(others[code_low])
+                used += 1
+            else:
+                record._insert((code_high << 64) | code_low)
+        for other in others[used:]:
+            record._append_other(other)
+        return record
+
+    def copy(self):
+        record = MedicationRecord.__new__(MedicationRecord)
+        record.medication = self.medication
+        record._low = array('Q', self._low)
+        record._high = array('B', self._high)
+        record._slots = array('i', self._slots)
+        record._live = self._live
+        record._dead = self._dead
+        record._others = list(self._others)
+        record._changes = 0
+        return record
+
+
+class TraceabilityCodes:
+    """MedicationRecord 中追溯码的只读序列视图，供列表显示按下标取值
+
+    读取时不整理记录（后台合并可能正在复制它）；有删除的空位时记下各有效追溯码在数组中的
+    位置，记录再被修改后重新计算。
+    """
+
+    __slots__ = ('record', 'positions', 'changes')
+
+    def __init__(self, record):
+        self.record = record
+        self.positions = None
+        self.changes = None
+
+    def __len__(self):
+        return len(self.record) - 1
+
+    def live_positions(self):
+        record = self.record
+        if self.changes != record._changes:
+            high = record._high
+            self.positions = array('i', (index for index in range(len(high)) if high[index] != HIGH_DELETED))
+            self.changes = record._changes
+        return self.positions
+
+    def __getitem__(self, index):
+        record = self.record
+        count = record._live
+        if index < 0:
+            index += count
+        if not 0 <= index < count:
+            raise IndexError(index)
+        if record._dead:
+            index = self.live_positions()[index]
+        return record._value_at(index)
+
+    def __iter__(self):
+        return iter(list(self.record)[1:])
+
+
+class StorageBackend(ABC):
+    """存储引擎接口
+
+    data 是 条形码 -> MedicationRecord 的映射，界面只读取它；所有修改都以
+    (action, barcode, traceability, medication) 的形式交给 apply_batch 持久化。
+    子类实现 load、apply_batch、replace、copy_records，持有文件或连接的还要实现 close。
+    """
+
+    @abstractmethod
+    def load(self):
+        """读取并返回 data"""
+
+    @abstractmethod
+    def apply_batch(self, operations):
+        """持久化一批修改并应用到 data"""
+
+    @abstractmethod
+    def replace(self, data):
+        """用 data 整体替换现有数据"""
+
+    @abstractmethod
+    def copy_records(self):
+        """复制全部记录 {条形码: MedicationRecord}，可在后台线程调用，不把未读取的记录放入缓存"""
+
+    @abstractmethod
+    def iter_records(self):
+        """逐条返回开始读取时的全部记录 (条形码, MedicationRecord)，供后台线程流式导出，不在内存中保留全部记录"""
+
+    def close(self):
+        pass
+
+    def add(self, barcode, traceability):
+        self.apply('ADD', barcode, traceability)
+
+    def delete(self, barcode, traceability):
+        self.apply('DELETE', barcode, traceability)
+
+    def create(self, barcode, medication, traceability):
+        self.apply('CREATE', barcode, traceability, medication)
+
+    def apply(self, action, barcode, traceability, medication=None):
+        self.apply_batch([(action, barcode, traceability, medication)])
+
+
+class TextStore(StorageBackend):
+    """文本存储：每次修改重写整个数据文件"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()  # 快照、导出在后台线程中复制数据
+        self.data = self.load()
+
+    def load(self):
+        return read_data(self.filename)
+
+    @timed('storage.apply_batch')
+    def apply_batch(self, operations):
+        # 一批修改 (action, barcode, traceability, medication) 只写一次文件
+        with self.lock:
+            for operation in operations:
+                apply_operation(self.data, *operation)
+            write_data(self.filename, self.data)
+
+    def replace(self, data):
+        # 用下载的数据整体替换，保持 self.data 对象不变
+        with self.lock:
+            self.data.clear()
+            self.data.update(data)
+            write_data(self.filename, self.data)
+
+    def copy_records(self):
+        with self.lock:
+            return {barcode: values.copy() for barcode, values in self.data.items()}
+
+    def copy_data_files(self, directory):
+        """在锁内把组成当前数据的文件复制到 directory，返回 (快照文件列表, 日志文件列表)"""
+        with self.lock:
+            return copy_files([self.filename], directory, 'snapshot'), []
+
+    def iter_records(self):
+        # 锁内只复制文件，锁外逐行读取复制的文件
+        directory = tempfile.mkdtemp(prefix='export-')
+        try:
+            snapshot_filenames, journal_filenames = self.copy_data_files(directory)
+            yield from iter_journaled_data(snapshot_filenames, journal_filenames)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def copy_files(filenames, directory, prefix):
+    # 按顺序复制到 directory，返回新路径；不存在的文件跳过
+    copies = []
+    for filename in filenames:
+        target = os.path.join(directory, f'{prefix}-{len(copies)}')
+        try:
+            shutil.copyfile(filename, target)
+        except FileNotFoundError:
+            continue
+        copies.append(target)
+    return copies
+
+
+class JournaledStore(TextStore):
+    """日志存储：快照文件 + 追加日志，每次修改只追加并 fsync 一条记录"""
+
+    def __init__(self, filename, compact_threshold=DEFAULT_APP_CONFIG['journal_compact_threshold']):
+        self.journal_filename = filename + '.journal'
+        self.old_journal_filename = self.journal_filename + '.old'
+        self.compact_threshold = compact_threshold
+        self.compact_lock = threading.RLock()  # 合并在锁外写快照，导出复制文件时需要等它写完
+        self.compacting = False
+        super().__init__(filename)
+        self.journal = open(self.journal_filename, 'a')
+        self.journal_size = os.path.getsize(self.journal_filename)
+        if os.path.exists(self.old_journal_filename):
+            # 上次合并未完成，先把数据落到快照
+            self.compact()
+
+    def load(self):
+        # 读取快照后依次重放旧日志和当前日志
+        data = read_data(self.filename)
+        replay_journal(data, self.old_journal_filename)
+        replay_journal(data, self.journal_filename)
+        return data
+
+    @timed('storage.apply_batch')
+    def apply_batch(self, operations):
+        # 一批修改只追加、fsync 一次
+        lines = ''.join(format_operation(*operation) for operation in operations)
+        with self.lock:
+            self.journal.write(lines)
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+            self.journal_size += len(lines)
+            self.apply_in_memory(operations)
+            if self.journal_size >= self.compact_threshold and not self.compacting:
+                self.compacting = True
+                threading.Thread(target=self.compact, daemon=True).start()
+
+    def apply_in_memory(self, operations):
+        for operation in operations:
+            apply_operation(self.data, *operation)
+
+    def replace(self, data):
+        with self.compact_lock:
+            with self.lock:
+                self.data.clear()
+                self.data.update(data)
+            self.compact()
+
+    def snapshot_files(self):
+        return [self.filename]
+
+    def copy_data_files(self, directory):
+        # 合并在存储的锁外写快照，等它写完再复制
+        with self.compact_lock, self.lock:
+            return (copy_files(self.snapshot_files(), directory, 'snapshot'),
+                    copy_files([self.old_journal_filename, self.journal_filename], directory, 'journal'))
+
+    def close(self):
+        with self.lock:
+            self.journal.close()
+
+    @timed('storage.compact')
+    def compact(self):
+        """把日志合并进新的快照"""
+        with self.compact_lock:
+            with self.lock:
+                # 切换到新日志，旧日志保留到快照写完为止
+                self.journal.close()
+                if os.path.exists(self.old_journal_filename):
+                    with open(self.old_journal_filename, 'a') as old_journal, \
+                            open(self.journal_filename, 'r') as journal:
+                        old_journal.write(journal.read())
+                    os.remove(self.journal_filename)
+                else:
+                    os.replace(self.journal_filename, self.old_journal_filename)
+                self.journal = open(self.journal_filename, 'a')
+                self.journal_size = 0
+                snapshot = self.snapshot()
+            try:
+                self.write_snapshot(snapshot)
+                os.remove(self.old_journal_filename)
+                logging.info(f"Compacted journal into '{self.filename}'.")
+            finally:
+                self.compacting = False
+
+    def snapshot(self):
+        # 在锁内复制需要写入快照的数据
+        return {barcode: values.copy() for barcode, values in self.data.items()}
+
+    def write_snapshot(self, snapshot):
+        write_data(self.filename, snapshot)
+
+
+def shard_of(barcode, shard_count):
+    return zlib.crc32(barcode.encode('utf-8')) % shard_count
+
+
+class ShardedRecords(MutableMapping):
+    """按条形码分片的记录表：访问某个条形码时才读取它所在的分片，保存时只写有修改的分片
+
+    分片目录中有 shard-NNN.txt（与数据文件同格式）和清单 manifest.json
+    （分片数和各分片的记录数）。
+    """
+
+    def __init__(self, directory, shard_count):
+        self.directory = directory
+        self.manifest_filename = os.path.join(directory, 'manifest.json')
+        try:
+            with open(self.manifest_filename, 'r') as file:
+                manifest = json.load(file)
+            self.shard_count = manifest['shard_count']
+            self.counts = manifest['counts']
+            self.exists = True
+        except FileNotFoundError:
+            self.shard_count = shard_count
+            self.counts = [0] * shard_count
+            self.exists = False
+        self.shards = [None] * self.shard_count  # 未读取的分片为 None
+        self.dirty = set()
+
+    def shard_filename(self, index):
+        return os.path.join(self.directory, f'shard-{index:03d}.txt')
+
+    def shard(self, index):
+        shard = self.shards[index]
+        if shard is None:
+            shard = self.shards[index] = read_data(self.shard_filename(index))
+        return shard
+
+    def apply(self, action, barcode, traceability, medication=None):
+        # 记录在原处修改，需要在这里标记分片
+        apply_operation(self, action, barcode, traceability, medication)
+        self.dirty.add(shard_of(barcode, self.shard_count))
+
+    def __getitem__(self, barcode):
+        return self.shard(shard_of(barcode, self.shard_count))[barcode]
+
+    def __setitem__(self, barcode, record):
+        index = shard_of(barcode, self.shard_count)
+        self.shard(index)[barcode] = record
+        self.dirty.add(index)
+
+    def __delitem__(self, barcode):
+        index = shard_of(barcode, self.shard_count)
+        del self.shard(index)[barcode]
+        self.dirty.add(index)
+
+    def __contains__(self, barcode):
+        return isinstance(barcode, str) and barcode in self.shard(shard_of(barcode, self.shard_count))
+
+    def __iter__(self):
+        for index in range(self.shard_count):
+            yield from self.shard(index)
+
+    def __len__(self):
+        return sum(self.counts[index] if shard is None else len(shard) for index, shard in enumerate(self.shards))
+
+    def clear(self):
+        # 不必先读取各分片
+        self.shards = [{} for _ in range(self.shard_count)]
+        self.dirty = set(range(self.shard_count))
+
+    def take_dirty(self):
+        """复制有修改的分片 {分片号: 记录}，并清除修改标记"""
+        snapshot = {index: {barcode: record.copy() for barcode, record in self.shards[index].items()}
+                    for index in self.dirty}
+        self.dirty = set()
+        for index, records in snapshot.items():
+            self.counts[index] = len(records)
+        return snapshot
+
+    def save(self, snapshot):
+        # 逐个写入分片，最后写清单；失败的分片留待下次合并
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            for index, records in snapshot.items():
+                write_data(self.shard_filename(index), records)
+            temp_filename = self.manifest_filename + '.tmp'
+            with open(temp_filename, 'w') as file:
+                json.dump({'shard_count': self.shard_count, 'counts': list(self.counts)}, file)
+            os.replace(temp_filename, self.manifest_filename)
+            self.exists = True
+        except Exception:
+            self.dirty.update(snapshot)
+            raise
+
+
+class ShardedStore(JournaledStore):
+    """分片存储：追加日志同 JournaledStore，合并时只重写有修改的分片"""
+
+    def __init__(self, filename, compact_threshold=DEFAULT_APP_CONFIG['journal_compact_threshold'],
+                 shard_count=DEFAULT_APP_CONFIG['shard_count']):
+        self.shard_directory = filename + '.shards'
+        self.shard_count = shard_count
+        super().__init__(filename, compact_threshold)
+
+    def load(self):
+        records = ShardedRecords(self.shard_directory, self.shard_count)
+        if not records.exists and os.path.exists(self.filename):
+            # 首次使用：把整个数据文件拆分到各分片
+            records.update(read_data(self.filename))
+            records.save(records.take_dirty())
+            logging.info(f"Split '{self.filename}' into {records.shard_count} shards.")
+        replay_journal(records, self.old_journal_filename, ShardedRecords.apply)
+        replay_journal(records, self.journal_filename, ShardedRecords.apply)
+        return records
+
+    def apply_in_memory(self, operations):
+        for operation in operations:
+            self.data.apply(*operation)
+
+    def snapshot(self):
+        return self.data.take_dirty()
+
+    def write_snapshot(self, snapshot):
+        self.data.save(snapshot)
+
+    def copy_records(self):
+        """已读取的分片在锁内复制，其余分片在锁外直接读文件，不放入缓存"""
+        records = self.data
+        with self.lock:
+            shards = [None if shard is None else {barcode: record.copy() for barcode, record in shard.items()}
+                      for shard in records.shards]
+        for index, shard in enumerate(shards):
+            if shard is not None:
+                continue
+            shard = read_data(records.shard_filename(index))
+            with self.lock:
+                if records.shards[index] is not None:
+                    # 读文件期间分片被载入，可能已经修改，以内存中的为准
+                    shard = {barcode: record.copy() for barcode, record in records.shards[index].items()}
+            shards[index] = shard
+        return {barcode: record for shard in shards for barcode, record in shard.items()}
+
+    def snapshot_files(self):
+        return [self.data.shard_filename(index) for index in range(self.data.shard_count)]
+
+
+class LazyRecords(MutableMapping):
+    """内存映射的快照文件：启动时只建立 条形码 -> 字节偏移 的索引，首次访问某个条形码时才解析它的行
+
+    索引保存在 <数据文件>.offsets，文件的修改时间和大小不符时重新扫描。访问过或修改过的
+    记录缓存在 records 中并覆盖快照；从快照中删除的条形码记在 removed 中。
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.offsets_filename = filename + '.offsets'
+        self.encoding = locale.getpreferredencoding(False)  # 与 read_data、write_data 的文本模式一致
+        self.lock = threading.RLock()  # 合并时替换映射，与界面线程的读取互斥
+        self.file = None
+        self.map = None
+        self.offsets = {}
+        self.records = {}
+        self.removed = set()
+        self.dirty = set()
+        self.open()
+
+    def open(self):
+        if not os.path.exists(self.filename):
+            return
+        self.file = open(self.filename, 'rb')
+        stat = os.fstat(self.file.fileno())
+        if stat.st_size:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.offsets = self.load_offsets(stat)
+        if self.offsets is None:
+            self.offsets = self.scan()
+            self.save_offsets(self.offsets)
+
+    def close(self):
+        with self.lock:
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def load_offsets(self, stat):
+        # 索引文件第一行为数据文件的 修改时间(ns),大小，与当前文件不符时视为过期
+        try:
+            with open(self.offsets_filename, 'r', encoding='utf-8') as file:
+                if file.readline().strip() != f"{stat.st_mtime_ns},{stat.st_size}":
+                    return None
+                offsets = {}
+                for line in file:
+                    barcode, offset = line.rstrip('\n').rsplit(',', 1)
+                    offsets[barcode] = int(offset)
+                return offsets
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save_offsets(self, offsets):
+        stat = os.stat(self.filename)
+        temp_filename = self.offsets_filename + '.tmp'
+        with open(temp_filename, 'w', encoding='utf-8') as file:
+            file.write(f"{stat.st_mtime_ns},{stat.st_size}\n")
+            file.writelines(f"{barcode},{offset}\n" for barcode, offset in offsets.items())
+        os.replace(temp_filename, self.offsets_filename)
+
+    @timed('storage.lazy_scan')
+    def scan(self):
+        """扫描快照中每行的起始位置，只解码条形码"""
+        offsets = {}
+        if self.map is None:
+            return offsets
+        position = 0
+        size = len(self.map)
+        while position < size:
+            end = self.map.find(b'\n', position)
+            end = size if end < 0 else end
+            comma = self.map.find(b',', position, end)
+            barcode = self.map[position:end if comma < 0 else comma].decode(self.encoding).strip()
+            if barcode:
+                offsets[barcode] = position
+            position = end + 1
+        return offsets
+
+    def raw_line(self, offset):
+        # 快照中一行的内容（不含换行符）
+        end = self.map.find(b'\n', offset)
+        return self.map[offset:len(self.map) if end < 0 else end].rstrip(b'\r')
+
+    def apply(self, action, barcode, traceability, medication=None):
+        # 记录在原处修改，需要在这里标记
+        apply_operation(self, action, barcode, traceability, medication)
+        self.dirty.add(barcode)
+
+    def __getitem__(self, barcode):
+        record = self.records.get(barcode)
+        if record is not None:
+            return record
+        with self.lock:
+            if barcode in self.removed or barcode not in self.offsets:
+                raise KeyError(barcode)
+            parts = self.raw_line(self.offsets[barcode]).decode(self.encoding).strip().split(',')
+        record = self.records[barcode] = MedicationRecord(parts[1] if len(parts) > 1 else '', parts[2:])
+        return record
+
+    def __setitem__(self, barcode, record):
+        self.records[barcode] = record
+        self.removed.discard(barcode)
+        self.dirty.add(barcode)
+
+    def medications(self):
+        """依次返回 (条形码, 药品名称)，未访问过的记录只解码名称，不解析也不缓存"""
+        for barcode in self:
+            record = self.records.get(barcode)
+            if record is not None:
+                yield barcode, record.medication
+                continue
+            with self.lock:
+                if barcode in self.removed or barcode not in self.offsets:
+                    continue
+                parts = self.raw_line(self.offsets[barcode]).split(b',', 2)
+            yield barcode, parts[1].decode(self.encoding).strip() if len(parts) > 1 else ''
+
+    def __delitem__(self, barcode):
+        if barcode not in self:
+            raise KeyError(barcode)
+        self.records.pop(barcode, None)
+        if barcode in self.offsets:
+            self.removed.add(barcode)
+        self.dirty.add(barcode)
+
+    def __contains__(self, barcode):
+        return barcode in self.records or (barcode in self.offsets and barcode not in self.removed)
+
+    def __iter__(self):
+        for barcode in self.offsets:
+            if barcode not in self.removed:
+                yield barcode
+        for barcode in list(self.records):
+            if barcode not in self.offsets:
+                yield barcode
+
+    def __len__(self):
+        return (len(self.offsets) - len(self.removed)
+                + sum(1 for barcode in self.records if barcode not in self.offsets))
+
+    def clear(self):
+        # 不必解析快照中的记录
+        self.records = {}
+        self.removed = set(self.offsets)
+        self.dirty = set(self.offsets)
+
+    def copy_all(self, store_lock):
+        """复制全部记录：在存储的锁内复制缓存和映射内容，未解析的行在锁外解析，不放入缓存"""
+        with store_lock, self.lock:
+            records = {barcode: record.copy() for barcode, record in dict(self.records).items()}
+            removed = set(self.removed)
+            offsets = dict(self.offsets)
+            blob = self.map[:] if self.map is not None else b''
+        copies = {}
+        for barcode, offset in offsets.items():
+            if barcode in removed:
+                continue
+            record = records.get(barcode)
+            if record is None:
+                end = blob.find(b'\n', offset)
+                parts = blob[offset:len(blob) if end < 0 else end].decode(self.encoding).strip().split(',')
+                record = MedicationRecord(parts[1] if len(parts) > 1 else '', parts[2:])
+            copies[barcode] = record
+        for barcode, record in records.items():
+            if barcode not in offsets:
+                copies[barcode] = record
+        return copies
+
+    def take_dirty(self):
+        """复制有修改的记录和删除的条形码，并清除修改标记"""
+        snapshot = ({barcode: self.records[barcode].copy() for barcode in self.dirty if barcode in self.records},
+                    set(self.removed))
+        self.dirty = set()
+        return snapshot
+
+    def save(self, snapshot):
+        """写入新的快照：未修改的行直接从映射中复制，写完后换成新文件的映射和索引"""
+        records, removed = snapshot
+        temp_filename = self.filename + '.tmp'
+        newline = os.linesep.encode('ascii')
+        offsets = {}
+        with open(temp_filename, 'wb') as file:
+            for barcode, offset in self.offsets.items():
+                if barcode in removed:
+                    continue
+                offsets[barcode] = file.tell()
+                record = records.get(barcode)
+                if record is None:
+                    file.write(self.raw_line(offset) + newline)
+                else:
+                    file.write(f"{barcode},{','.join(record)}".encode(self.encoding) + newline)
+            for barcode, record in records.items():
+                if barcode not in self.offsets:
+                    offsets[barcode] = file.tell()
+                    file.write(f"{barcode},{','.join(record)}".encode(self.encoding) + newline)
+            file.flush()
+            os.fsync(file.fileno())
+        with self.lock:
+            # Windows 上映射中的文件不能被替换，先关闭
+            self.close()
+            os.replace(temp_filename, self.filename)
+            self.file = open(self.filename, 'rb')
+            if os.fstat(self.file.fileno()).st_size:
+                self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.offsets = offsets
+            self.removed = {barcode for barcode in self.removed if barcode in offsets}
+        self.save_offsets(offsets)
+
+
+class LazyStore(JournaledStore):
+    """按需加载的存储：追加日志同 JournaledStore，快照内存映射，只解析用到的记录"""
+
+    def load(self):
+        records = LazyRecords(self.filename)
+        replay_journal(records, self.old_journal_filename, LazyRecords.apply)
+        replay_journal(records, self.journal_filename, LazyRecords.apply)
+        return records
+
+    def apply_in_memory(self, operations):
+        for operation in operations:
+            self.data.apply(*operation)
+
+    def snapshot(self):
+        return self.data.take_dirty()
+
+    def write_snapshot(self, snapshot):
+        self.data.save(snapshot)
+
+    def copy_records(self):
+        return self.data.copy_all(self.lock)
+
+    def close(self):
+        super().close()
+        self.data.close()
+
+
+class SQLiteRecords(MutableMapping):
+    """SQLite 中的药品记录：按条形码读取后缓存为 MedicationRecord，修改同时写入数据库和缓存"""
+
+    def __init__(self, connection, lock):
+        self.connection = connection
+        self.lock = lock  # 导出在后台线程中读取
+        self.cache = {}
+
+    def query(self, sql, parameters=()):
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def __getitem__(self, barcode):
+        record = self.cache.get(barcode)
+        if record is None:
+            rows = self.query('SELECT medication FROM medications WHERE barcode = ?', (barcode,))
+            if not rows:
+                raise KeyError(barcode)
+            codes = self.query('SELECT traceability FROM traceability_codes WHERE barcode = ? ORDER BY id',
+                               (barcode,))
+            record = self.cache[barcode] = MedicationRecord(rows[0][0], [code for (code,) in codes])
+        return record
+
+    def __contains__(self, barcode):
+        return barcode in self.cache or bool(self.query('SELECT 1 FROM medications WHERE barcode = ?', (barcode,)))
+
+    def __iter__(self):
+        return iter([barcode for (barcode,) in self.query('SELECT barcode FROM medications ORDER BY rowid')])
+
+    def medications(self):
+        """返回 [(条形码, 药品名称)]，只查名称，不读取追溯码"""
+        return self.query('SELECT barcode, medication FROM medications ORDER BY rowid')
+
+    def __len__(self):
+        return self.query('SELECT COUNT(*) FROM medications')[0][0]
+
+    ALL_RECORDS_SQL = ('SELECT m.barcode, m.medication, t.traceability FROM medications m '
+                       'LEFT JOIN traceability_codes t ON t.barcode = m.barcode ORDER BY m.rowid, t.id')
+
+    @staticmethod
+    def group_rows(rows):
+        # ALL_RECORDS_SQL 的结果 -> {条形码: [药品名称, 追溯码, ...]}
+        records = {}
+        for barcode, medication, traceability in rows:
+            codes = records.get(barcode)
+            if codes is None:
+                codes = records[barcode] = [medication]
+            if traceability is not None:
+                codes.append(traceability)
+        return records
+
+    def items(self):
+        # 一次查询读出全部记录，避免逐个条形码查询
+        records = self.group_rows(self.query(self.ALL_RECORDS_SQL))
+        for barcode, values in records.items():
+            if barcode not in self.cache:
+                self.cache[barcode] = MedicationRecord(values[0], values[1:])
+        return [(barcode, self.cache[barcode]) for barcode in records]
+
+    def __setitem__(self, barcode, record):
+        # 整条替换：调用方负责事务
+        self.connection.execute('INSERT OR REPLACE INTO medications (barcode, medication) VALUES (?, ?)',
+                                (barcode, record[0]))
+        self.connection.execute('DELETE FROM traceability_codes WHERE barcode = ?', (barcode,))
+        self.connection.executemany('INSERT INTO traceability_codes (barcode, traceability) VALUES (?, ?)',
+                                    [(barcode, code) for code in record.codes()])
+        self.cache[barcode] = record
+
+    def __delitem__(self, barcode):
+        self.connection.execute('DELETE FROM traceability_codes WHERE barcode = ?', (barcode,))
+        self.connection.execute('DELETE FROM medications WHERE barcode = ?', (barcode,))
+        self.cache.pop(barcode, None)
+
+    def clear(self):
+        self.connection.execute('DELETE FROM traceability_codes')
+        self.connection.execute('DELETE FROM medications')
+        self.cache = {}
+
+    def apply(self, action, barcode, traceability, medication=None):
+        """与 apply_operation 相同的语义，只写入受影响的行"""
+        if action == 'CREATE':
+            self[barcode] = MedicationRecord(medication, [traceability])
+        elif action == 'ADD':
+            record = self.get(barcode)
+            if record is not None and traceability not in record:
+                self.connection.execute('INSERT INTO traceability_codes (barcode, traceability) VALUES (?, ?)',
+                                        (barcode, traceability))
+                record.append(traceability)
+        elif action == 'DELETE':
+            record = self.get(barcode)
+            if record is not None and traceability in record:
+                self.connection.execute('DELETE FROM traceability_codes WHERE barcode = ? AND traceability = ?',
+                                        (barcode, traceability))
+                record.remove(traceability)
+
+
+class SQLiteStore(StorageBackend):
+    """SQLite 存储：药品和追溯码分表并建索引，WAL 模式，每批修改在一个事务中只写受影响的行
+
+    首次打开空数据库时，从原有的文本数据（含日志和分片）一次性迁移。
+    """
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS medications (barcode TEXT PRIMARY KEY, medication TEXT NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS traceability_codes (id INTEGER PRIMARY KEY, barcode TEXT NOT NULL, '
+        'traceability TEXT NOT NULL, UNIQUE (barcode, traceability))',
+        'CREATE INDEX IF NOT EXISTS traceability_codes_traceability ON traceability_codes (traceability)',
+        'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)',
+    )
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.database_filename = os.path.splitext(filename)[0] + '.db'
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(self.database_filename, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=FULL')  # 与日志存储一样每次提交都落盘
+        with self.connection:
+            for statement in self.SCHEMA:
+                self.connection.execute(statement)
+        self.data = self.load()
+
+    def load(self):
+        records = SQLiteRecords(self.connection, self.lock)
+        if not records.query("SELECT 1 FROM meta WHERE key = 'migrated'"):
+            self.migrate(records)
+        return records
+
+    def migrate(self, records):
+        # 从当前的文本存储读出全部数据，在一个事务中写入数据库
+        if os.path.exists(os.path.join(self.filename + '.shards', 'manifest.json')):
+            source = ShardedStore(self.filename)
+        else:
+            source = JournaledStore(self.filename)
+        try:
+            items = list(source.data.items())
+        finally:
+            source.close()
+        with self.lock, self.connection:
+            medications = [(barcode, record[0]) for barcode, record in items]
+            codes = [(barcode, code) for barcode, record in items for code in record.codes()]
+            self.connection.executemany('INSERT OR REPLACE INTO medications (barcode, medication) VALUES (?, ?)',
+                                        medications)
+            self.connection.executemany('INSERT OR IGNORE INTO traceability_codes (barcode, traceability) '
+                                        'VALUES (?, ?)', codes)
+            self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated', ?)",
+                                    (datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),))
+        if items:
+            logging.info(f"Migrated {len(items)} records into '{self.database_filename}'.")
+
+    @timed('storage.apply_batch')
+    def apply_batch(self, operations):
+        with self.lock, self.connection:
+            for operation in operations:
+                self.data.apply(*operation)
+
+    def replace(self, data):
+        with self.lock, self.connection:
+            self.data.clear()
+            self.data.update(data)
+
+    def copy_records(self):
+        # 另开连接读取：WAL 模式下一次查询就是一致的快照，不阻塞写入，也不填充缓存
+        connection = sqlite3.connect(self.database_filename)
+        try:
+            rows = connection.execute(SQLiteRecords.ALL_RECORDS_SQL).fetchall()
+        finally:
+            connection.close()
+        return {barcode: MedicationRecord(values[0], values[1:])
+                for barcode, values in SQLiteRecords.group_rows(rows).items()}
+
+    def iter_records(self):
+        # 同样另开连接，按游标逐行读取，同一条形码的行是连续的
+        connection = sqlite3.connect(self.database_filename)
+        try:
+            rows = connection.execute(SQLiteRecords.ALL_RECORDS_SQL)
+            for barcode, group in itertools.groupby(rows, key=lambda row: row[0]):
+                group = list(group)
+                yield barcode, MedicationRecord(group[0][1], [row[2] for row in group if row[2] is not None])
+        finally:
+            connection.close()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def open_store(filename, config):
+    if config['storage_mode'] == 'journal':
+        return JournaledStore(filename, config['journal_compact_threshold'])
+    if config['storage_mode'] == 'lazy':
+        return LazyStore(filename, config['journal_compact_threshold'])
+    if config['storage_mode'] == 'sharded':
+        return ShardedStore(filename, config['journal_compact_threshold'], config['shard_count'])
+    if config['storage_mode'] == 'sqlite':
+        return SQLiteStore(filename)
+    return TextStore(filename)
+
+
+def load_terminal_id(filename):
+    """本终端的标识，首次使用时随机生成并保存"""
+    try:
+        with open(filename, 'r') as file:
+            terminal_id = file.read().strip()
+            if terminal_id:
+                return terminal_id
+    except FileNotFoundError:
+        pass
+    terminal_id = uuid.uuid4().hex[:12]
+    with open(filename, 'w') as file:
+        file.write(terminal_id)
+    return terminal_id
+
+
+# 终端操作日志的分段文件名：<终端标识>-<段号>.log
+LOG_SEGMENT_PATTERN = re.compile(r'^([0-9a-f]+)-(\d+)\.log$')
+LOG_CHECKPOINT_NAME = 'checkpoint.json'  # 操作日志目录中记录基线已并入哪些日志字节的文件
+
+
+def parse_terminal_operation(line):
+    # 终端操作日志的一行：逻辑时钟,action,barcode,traceability[,medication]
+    parts = line.rstrip('\n').split(',', 4)
+    if len(parts) < 4 or not parts[0].isdigit():
+        return None
+    return int(parts[0]), (parts[1], parts[2], parts[3], parts[4] if len(parts) > 4 else None)
+
+
+class OperationMerge:
+    """多终端修改的确定性合并
+
+    每个追溯码只认时间戳 (逻辑时钟, 终端标识) 最大的一条操作：ADD/CREATE 使它
+    属于该条形码，DELETE 删除它。合并结果与各终端日志的到达顺序无关。
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.stamps = {}  # 追溯码 -> (时间戳, 条形码)
+        self.names = {}  # 条形码 -> 药品名称的时间戳
+        self.owners = None  # 基线中追溯码 -> 条形码，首次遇到没有时间戳的追溯码时建立
+        self.clock = 0
+
+    def base_owner(self, traceability, default):
+        # 还没有操作改动过的追溯码仍在基线里原来的条形码下
+        if self.owners is None:
+            self.owners = {code: barcode for barcode, record in self.data.items() for code in record.codes()}
+        return self.owners.get(traceability, default)
+
+    def apply(self, stamp, action, barcode, traceability, medication=None):
+        """应用一条操作，返回对数据实际产生的修改"""
+        self.clock = max(self.clock, stamp[0])
+        changes = []
+        record = self.data.get(barcode)
+        created = False
+        if action == 'CREATE':
+            if record is None:
+                record = self.data[barcode] = MedicationRecord(medication, [])
+                changes.append(('CREATE', barcode, traceability, medication))
+                created = True
+            if stamp > self.names.get(barcode, (0, '')):
+                record.medication = medication
+                self.names[barcode] = stamp
+        current = self.stamps.get(traceability)
+        if current is not None and current[0] >= stamp:
+            if created:
+                # 记录要建，但这个追溯码已被更新的操作改动
+                changes.append(('DELETE', barcode, traceability, None))
+            return changes
+        self.stamps[traceability] = (stamp, barcode)
+        previous = current[1] if current is not None else self.base_owner(traceability, barcode)
+        owner = self.data.get(previous)
+        if (previous != barcode or action == 'DELETE') and owner is not None and traceability in owner:
+            owner.remove(traceability)
+            changes.append(('DELETE', previous, traceability, None))
+        if action != 'DELETE':
+            if record is None:
+                # 其他终端的记录还没同步过来，先建一条没有名称的记录
+                record = self.data[barcode] = MedicationRecord('', [])
+                changes.append(('CREATE', barcode, traceability, ''))
+                created = True
+            if traceability not in record:
+                record.append(traceability)
+                if not created:
+                    changes.append(('ADD', barcode, traceability, None))
+        return changes
+
+    def apply_many(self, entries):
+        # 按时间戳顺序应用 [(时间戳, 操作)]
+        changes = []
+        for stamp, operation in sorted(entries):
+            changes.extend(self.apply(stamp, *operation))
+        return changes
+
+
+# WebDAV 压缩传输格式：PACK_MAGIC + 版本号 + 压缩算法各 1 字节，其后是压缩后的打包数据
+PACK_MAGIC = b'TRCPACK'
+PACK_VERSION = 1
+PACK_CODECS = {'none': 0, 'gzip': 1, 'zstd': 2}
+
+_zstandard = None
+
+
+def load_zstandard():
+    # zstd 为可选依赖，未安装时返回 None
+    global _zstandard
+    if _zstandard is None:
+        try:
+            import zstandard
+            _zstandard = zstandard
+        except ImportError:
+            _zstandard = False
+    return _zstandard or None
+
+
+def pack_data(data, codec='gzip'):
+    """把数据打包成压缩传输格式
+
+    文本部分每个条形码一行：条形码、药品名称、20位追溯码数量和非20位的旧数据。20位追溯码
+    按记录顺序存成高位 1 字节 + 低 64 位，低 64 位再按字节分列存放，相邻追溯码的相同字节
+    排在一起，压缩后每个追溯码只占几个字节。
+    """
+    lines = []
+    high = array('B')
+    low = array('Q')
+    for barcode, record in data.items():
+        record_high, record_low, others = record.packed()
+        high.extend(record_high)
+        low.extend(record_low)
+        lines.append('\x1f'.join([barcode, record.medication, str(len(record_low))] + others))
+    text = '\n'.join(lines).encode('utf-8')
+    if sys.byteorder == 'big':
+        low.byteswap()
+    low_bytes = low.tobytes()
+    body = b''.join([struct.pack('<QQ', len(text), len(high)), text, high.tobytes()]
+                    + [low_bytes[position::8] for position in range(8)])
+    if codec == 'gzip':
+        body = gzip.compress(body, compresslevel=6)
+    elif codec == 'zstd':
+        body = load_zstandard().ZstdCompressor(level=10).compress(body)
+    elif codec != 'none':
+        raise ValueError(f"不支持的压缩算法 {codec}")
+    return PACK_MAGIC + bytes([PACK_VERSION, PACK_CODECS[codec]]) + body
+
+
+def unpack_data(blob, barcodes=None):
+    """解析 pack_data 生成的内容，返回 {条形码: MedicationRecord}；格式不对时抛出 ValueError
+
+    给出 barcodes 时只构建其中条形码的记录，其余只跳过，不必逐个建立哈希表。
+    """
+    if blob[:len(PACK_MAGIC)] != PACK_MAGIC or len(blob) < len(PACK_MAGIC) + 2:
+        raise ValueError("不是压缩传输格式")
+    version, codec = blob[len(PACK_MAGIC)], blob[len(PACK_MAGIC) + 1]
+    if version != PACK_VERSION:
+        raise ValueError(f"不支持的传输格式版本 {version}")
+    body = blob[len(PACK_MAGIC) + 2:]
+    if codec == PACK_CODECS['zstd'] and load_zstandard() is None:
+        raise ValueError("读取 zstd 格式需要安装 zstandard")
+    if codec not in PACK_CODECS.values():
+        raise ValueError(f"不支持的压缩算法 {codec}")
+    try:
+        if codec == PACK_CODECS['gzip']:
+            body = gzip.decompress(body)
+        elif codec == PACK_CODECS['zstd']:
+            body = load_zstandard().ZstdDecompressor().decompress(body)
+    except Exception as e:
+        raise ValueError(f"解压失败: {e}")
+    if len(body) < 16:
+        raise ValueError("打包数据不完整")
+    text_length, count = struct.unpack_from('<QQ', body)
+    position = 16 + text_length
+    if len(body) != position + count * 9:
+        raise ValueError("打包数据不完整")
+    text = body[16:position].decode('utf-8')
+    high = array('B', body[position:position + count])
+    position += count
+    low_bytes = bytearray(count * 8)
+    for column in range(8):
+        low_bytes[column::8] = body[position + column * count:position + (column + 1) * count]
+    low = array('Q')
+    low.frombytes(low_bytes)
+    if sys.byteorder == 'big':
+        low.byteswap()
+    data = {}
+    offset = 0
+    for line in text.split('\n') if text else []:
+        barcode, medication, size, *others = line.split('\x1f')
+        size = int(size)
+        if barcodes is None or barcode in barcodes:
+            data[barcode] = MedicationRecord.from_packed(medication, high[offset:offset + size],
+                                                         low[offset:offset + size], others)
+        offset += size
+    return data
+
+
+class WebDAVSync:
+    """WebDAV多终端同步
+
+    远端保存一份完整数据文件作为基线，每个终端只追加上传自己的操作日志
+    （<数据文件>.ops/<终端>-<段号>.log，写满一段后换新段，旧段不再改动）。
+    拉取时列出日志目录，只用 Range 请求下载其他终端新增的字节，再按
+    OperationMerge 确定性合并。同步量只与修改数量有关，与数据总量无关。
+
+    基线仍是旧版本终端读写的纯文本文件；transfer_format 不为 text 时，基线另有一份
+    压缩打包副本（<数据文件>.pack，说明在 .pack.json），基线变化时优先下载它。
+
+    未并入基线的日志超过 compact_threshold 字节时，拉取的终端把合并结果上传为新基线，
+    并在日志目录的 checkpoint.json 记下基线已包含各日志的字节数，见 compact()。
+
+    本终端的修改先按序号写入本地待上传队列（<数据文件>.outbox）再上传，离线或上传失败时
+    留在队列中，下次连接时上传；调用方处理完上传结果后用 acknowledge() 从队列中去掉。
+    """
+
+    def __init__(self, filename, delta_threshold=DEFAULT_APP_CONFIG['webdav_delta_threshold'],
+                 transfer_format=DEFAULT_APP_CONFIG['webdav_transfer_format'],
+                 compact_threshold=DEFAULT_APP_CONFIG['webdav_compact_threshold']):
+        self.filename = filename
+        self.cache_filename = filename + '.remote'  # 远端完整文件的本地缓存
+        self.delta_filename = filename + '.delta'  # 旧版本共用增量文件的本地副本
+        self.ops_directory = filename + '.ops'  # 各终端操作日志的本地副本
+        self.state_filename = filename + '.sync.json'
+        self.terminal_id = load_terminal_id(filename + '.terminal')
+        self.delta_threshold = delta_threshold
+        self.transfer_format = transfer_format
+        self.compact_threshold = compact_threshold
+        self.outbox_filename = filename + '.outbox'
+        self.lock = threading.Lock()
+        self.outbox_lock = threading.Lock()  # 界面线程写入队列时不必等待上传
+        self.state = self.load_state()
+        self.replica = None  # 远端数据（基线 + 全部终端日志）的合并结果，首次使用时载入
+        self.outbox = self.load_outbox()  # 尚未确认上传的本终端修改 [(序号, 操作)]
+
+    def load_state(self):
+        try:
+            with open(self.state_filename, 'r') as file:
+                return json.load(file)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def save_state(self):
+        with open(self.state_filename, 'w') as file:
+            json.dump(self.state, file, indent=4)
+
+    def load_outbox(self):
+        # 启动时还没有未处理的上传结果，已上传的条目直接去掉；崩溃时未写完的最后一行忽略
+        pushed = self.state.get('pushed', 0)
+        entries = []
+        try:
+            with open(self.outbox_filename, 'r') as file:
+                for line in file:
+                    entry = parse_terminal_operation(line) if line.endswith('\n') else None
+                    if entry is not None and entry[0] > pushed:
+                        entries.append(entry)
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def record(self, operations):
+        """把本终端的一批修改追加到待上传队列并落盘，不访问网络"""
+        with self.outbox_lock:
+            last = self.outbox[-1][0] if self.outbox else self.state.get('pushed', 0)
+            entries = [(last + number, operation) for number, operation in enumerate(operations, 1)]
+            with open(self.outbox_filename, 'a') as file:
+                file.writelines(f"{number},{format_operation(*operation)}" for number, operation in entries)
+                file.flush()
+                os.fsync(file.fileno())
+            self.outbox.extend(entries)
+
+    def pending_operations(self):
+        """待上传队列中的全部修改（包括已上传、调用方尚未确认的），按提交顺序"""
+        with self.outbox_lock:
+            return [operation for _, operation in self.outbox]
+
+    def unpushed_operations(self):
+        pushed = self.state.get('pushed', 0)
+        with self.outbox_lock:
+            return [operation for number, operation in self.outbox if number > pushed]
+
+    def acknowledge(self, pushed):
+        """调用方已处理到序号 pushed 为止的上传结果，从队列中去掉这些修改"""
+        with self.outbox_lock:
+            if not self.outbox or self.outbox[0][0] > pushed:
+                return
+            self.outbox = [(number, operation) for number, operation in self.outbox if number > pushed]
+            temp_filename = self.outbox_filename + '.tmp'
+            with open(temp_filename, 'w') as file:
+                file.writelines(f"{number},{format_operation(*operation)}" for number, operation in self.outbox)
+            os.replace(temp_filename, self.outbox_filename)
+
+    def reset(self):
+        # 更换服务器后之前的校验值和缓存都不再可信；待上传队列保留，全部视为未上传
+        with self.lock:
+            self.state = {}
+            self.replica = None
+            for path in (self.state_filename, self.cache_filename, self.delta_filename):
+                if os.path.exists(path):
+                    os.remove(path)
+            if os.path.isdir(self.ops_directory):
+                for name in os.listdir(self.ops_directory):
+                    os.remove(os.path.join(self.ops_directory, name))
+
+    def remote_paths(self):
+        client, config = get_webdav_client()
+        remote_path = f'{config["webdav_root"]}{self.filename}'
+        return client, remote_path, remote_path + '.delta'
+
+    def download_if_changed(self, client, remote_path, local_path, key):
+        """条件下载，返回文件是否有变化"""
+        from webdav3.exceptions import RemoteResourceNotFound
+        from webdav3.urn import Urn
+        headers = []
+        validators = self.state.get(key) or {}
+        if os.path.exists(local_path):
+            if validators.get('etag'):
+                headers.append(f"If-None-Match: {validators['etag']}")
+            if validators.get('last_modified'):
+                headers.append(f"If-Modified-Since: {validators['last_modified']}")
+        try:
+            response = client.execute_request('download', Urn(remote_path).quote(), headers_ext=headers)
+        except RemoteResourceNotFound:
+            if key == 'delta':
+                # 远端没有增量文件，视为空
+                existed = os.path.exists(local_path) and os.path.getsize(local_path) > 0
+                open(local_path, 'w').close()
+                self.state[key] = None
+                self.save_state()
+                return existed
+            raise
+        if response.status_code == 304:
+            return False
+        with open(local_path, 'wb') as file:
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                file.write(chunk)
+        self.remember(key, response)
+        logging.info(f"Downloaded '{remote_path}' from WebDAV.")
+        return True
+
+    def download_base(self, client, remote_path):
+        """下载远端基线，返回是否有变化
+
+        先用 PROPFIND 取纯文本基线的版本，与 .pack.json 记录的来源版本相同时只下载压缩副本；
+        不同时（旧版本终端改写过基线，或还没有副本）下载纯文本，再替其他终端上传新的压缩副本。
+        """
+        if self.transfer_format == 'text':
+            changed = self.download_if_changed(client, remote_path, self.cache_filename, 'base')
+            if changed or 'base_source' not in self.state:
+                self.state['base_source'] = self.base_source(client, remote_path)
+                self.save_state()
+            return changed
+        source = self.base_source(client, remote_path)
+        if self.state.get('base_source') == source and os.path.exists(self.cache_filename):
+            return False
+        data = self.download_pack(client, remote_path, source)
+        if data is not None:
+            write_data(self.cache_filename, data)
+        else:
+            self.download_if_changed(client, remote_path, self.cache_filename, 'base')
+            self.upload_pack(client, remote_path, read_data(self.cache_filename), source)
+        self.state['base_source'] = source
+        self.save_state()
+        return True
+
+    def base_source(self, client, remote_path):
+        # 纯文本基线的版本标识，检查点和压缩副本都以它对应基线
+        info = client.info(remote_path)
+        return info.get('etag') or f"{info.get('size')}|{info.get('modified')}"
+
+    def download_checkpoint(self, client, ops_path):
+        # 基线变化后取检查点，只有它对应当前基线时才据此跳过已并入的日志
+        from webdav3.exceptions import RemoteResourceNotFound
+        from webdav3.urn import Urn
+        try:
+            response = client.execute_request('download', Urn(ops_path + LOG_CHECKPOINT_NAME).quote())
+            checkpoint = json.loads(response.content)
+        except RemoteResourceNotFound:
+            checkpoint = None
+        except ValueError as e:
+            logging.warning(f"Ignoring WebDAV checkpoint: {e}")
+            checkpoint = None
+        if checkpoint is not None and checkpoint.get('base') != self.state.get('base_source'):
+            checkpoint = None
+        self.state['checkpoint'] = checkpoint
+        self.save_state()
+
+    def checkpoint_offsets(self):
+        # 日志文件名 -> 基线已包含的字节数
+        return (self.state.get('checkpoint') or {}).get('offsets', {})
+
+    def download_pack(self, client, remote_path, source):
+        # 压缩副本与纯文本基线为同一版本时下载并解包，否则返回 None
+        from webdav3.exceptions import RemoteResourceNotFound
+        from webdav3.urn import Urn
+        try:
+            response = client.execute_request('download', Urn(remote_path + '.pack.json').quote())
+            manifest = json.loads(response.content)
+            if manifest.get('format') != PACK_VERSION or manifest.get('source') != source:
+                return None
+            response = client.execute_request('download', Urn(remote_path + '.pack').quote())
+            data = unpack_data(response.content)
+        except RemoteResourceNotFound:
+            return None
+        except ValueError as e:
+            logging.warning(f"Ignoring compressed copy of '{remote_path}': {e}")
+            return None
+        logging.info(f"Downloaded '{remote_path}.pack' ({len(response.content)} bytes) from WebDAV.")
+        return data
+
+    def upload_pack(self, client, remote_path, data, source):
+        # 先传副本再传说明，说明指向的版本总不比副本旧；失败时下次仍下载纯文本
+        from webdav3.urn import Urn
+        codec = self.transfer_format
+        if codec == 'zstd' and load_zstandard() is None:
+            logging.warning("zstandard is not installed, using gzip for WebDAV transfers.")
+            codec = 'gzip'
+        try:
+            content = pack_data(data, codec)
+            client.execute_request('upload', Urn(remote_path + '.pack').quote(), data=content)
+            manifest = {'format': PACK_VERSION, 'codec': codec, 'source': source}
+            client.execute_request('upload', Urn(remote_path + '.pack.json').quote(),
+                                   data=json.dumps(manifest).encode('utf-8'))
+        except Exception as e:
+            logging.warning(f"Error uploading compressed copy of '{remote_path}': {e}")
+            return
+        logging.info(f"Uploaded '{remote_path}.pack' ({len(content)} bytes) to WebDAV.")
+
+    def upload(self, client, local_path, remote_path, key=None):
+        # 直接PUT，省去 upload_sync 每次检查父目录的请求
+        from webdav3.urn import Urn
+        with open(local_path, 'rb') as file:
+            response = client.execute_request('upload', Urn(remote_path).quote(), data=file)
+        if key is not None:
+            self.remember(key, response)
+        logging.info(f"Uploaded '{remote_path}' to WebDAV.")
+
+    def remember(self, key, response):
+        self.state[key] = {'etag': response.headers.get('ETag'),
+                           'last_modified': response.headers.get('Last-Modified')}
+        self.save_state()
+
+    def load_remote_data(self):
+        data = read_data(self.cache_filename)
+        replay_journal(data, self.delta_filename)
+        return data
+
+    def read_log(self, name, offset=0):
+        """读取本地日志副本从 offset 开始的操作，返回 [(时间戳, 操作)]"""
+        terminal_id = LOG_SEGMENT_PATTERN.match(name).group(1)
+        entries = []
+        with open(os.path.join(self.ops_directory, name), 'r') as file:
+            file.seek(offset)
+            for line in file:
+                entry = parse_terminal_operation(line)
+                if entry is not None:
+                    entries.append(((entry[0], terminal_id), entry[1]))
+        return entries
+
+    def local_logs(self):
+        # 本地已有的终端日志副本：[(文件名, 大小)]
+        if not os.path.isdir(self.ops_directory):
+            return []
+        return [(name, os.path.getsize(os.path.join(self.ops_directory, name)))
+                for name in os.listdir(self.ops_directory) if LOG_SEGMENT_PATTERN.match(name)]
+
+    def load_replica(self):
+        # 基线数据 + 本地已有的全部终端日志中检查点之后的部分
+        offsets = self.checkpoint_offsets()
+        entries = []
+        for name, _ in self.local_logs():
+            entries.extend(self.read_log(name, offsets.get(name, 0)))
+        replica = OperationMerge(self.load_remote_data())
+        replica.clock = (self.state.get('checkpoint') or {}).get('clock', 0)
+        replica.apply_many(entries)
+        return replica
+
+    def fetch_logs(self, client, ops_path):
+        """下载各终端日志新增的部分，返回新的 [(时间戳, 操作)]"""
+        from webdav3.exceptions import RemoteResourceNotFound
+        from webdav3.urn import Urn
+        try:
+            files = client.list(ops_path, get_info=True)
+        except RemoteResourceNotFound:
+            return []
+        os.makedirs(self.ops_directory, exist_ok=True)
+        offsets = self.checkpoint_offsets()
+        listed = set()
+        entries = []
+        for info in files:
+            name = info['path'].rstrip('/').rsplit('/', 1)[-1]
+            match = LOG_SEGMENT_PATTERN.match(name)
+            if match is None:
+                continue
+            listed.add(name)
+            if match.group(1) == self.terminal_id and int(match.group(2)) > self.state.get('segment', 0):
+                # 本地状态丢失时从远端已有的段继续写，不覆盖旧段
+                self.state['segment'] = int(match.group(2))
+                self.save_state()
+            local_path = os.path.join(self.ops_directory, name)
+            offset = os.path.getsize(local_path) if os.path.exists(local_path) else 0
+            if int(info.get('size') or 0) <= offset:
+                continue
+            # 日志只会追加，只下载本地副本之后的字节
+            response = client.execute_request('download', Urn(ops_path + name).quote(),
+                                              headers_ext=[f"Range: bytes={offset}-"])
+            content = response.content if response.status_code == 206 else response.content[offset:]
+            content = content[:content.rfind(b'\n') + 1]  # 只保留完整的行
+            if not content:
+                continue
+            with open(local_path, 'ab') as file:
+                file.write(content)
+            entries.extend(self.read_log(name, max(offset, offsets.get(name, 0))))
+        for name, size in self.local_logs():
+            if name not in listed and size <= offsets.get(name, 0):
+                # 整段并入基线后已从服务器删除
+                os.remove(os.path.join(self.ops_directory, name))
+        for name in offsets:
+            match = LOG_SEGMENT_PATTERN.match(name)
+            if match.group(1) == self.terminal_id and name not in listed and \
+                    int(match.group(2)) >= self.state.get('segment', 0):
+                # 本终端已删除的段不能再写，否则新内容会被当成已并入基线
+                self.state['segment'] = int(match.group(2)) + 1
+                self.save_state()
+        if entries:
+            logging.info(f"Downloaded {len(entries)} operations from other terminals.")
+        return entries
+
+    @timed('webdav.pull')
+    def pull(self):
+        """拉取远端修改，返回 (完整数据或 None, 修改列表)
+
+        基线变化时返回合并后的完整数据，否则只返回其他终端新操作带来的修改。
+        """
+        with self.lock:
+            client, remote_path, remote_delta_path = self.remote_paths()
+            base_changed = self.download_base(client, remote_path)
+            if base_changed:
+                self.download_checkpoint(client, remote_path + '.ops/')
+            delta_changed = self.download_if_changed(client, remote_delta_path, self.delta_filename, 'delta')
+            if not (base_changed or delta_changed) and self.replica is None:
+                self.replica = self.load_replica()
+            entries = self.fetch_logs(client, remote_path + '.ops/')
+            if base_changed or delta_changed:
+                self.replica = self.load_replica()
+                result = {barcode: record.copy() for barcode, record in self.replica.data.items()}, []
+            else:
+                result = None, self.replica.apply_many(entries)
+            if self.compact_threshold and self.uncompacted_bytes() >= self.compact_threshold:
+                try:
+                    self.compact(client, remote_path, remote_delta_path)
+                except Exception as e:
+                    # 合并失败不影响本次拉取，下次拉取时再试
+                    logging.warning(f"Error compacting WebDAV operation logs: {e}")
+            return result
+
+    def uncompacted_bytes(self):
+        # 本地日志副本中还没有并入基线的字节数
+        offsets = self.checkpoint_offsets()
+        return sum(max(0, size - offsets.get(name, 0)) for name, size in self.local_logs())
+
+    def compact(self, client, remote_path, remote_delta_path):
+        """把全部终端日志并入远端基线，返回是否已合并
+
+        依次上传合并结果作为新的纯文本基线（旧版本终端也就能看到这些修改）及其压缩副本，
+        删除已并入的旧版本共用增量文件，最后上传检查点：新基线的版本、基线已包含各日志的
+        字节数和逻辑时钟。其他终端发现基线变化后只重放检查点之后的日志；检查点与基线
+        版本不符（上传到一半，或两个终端同时合并）时重放全部日志，结果相同，只是慢些。
+        写满的日志段不会再追加，整段并入后从服务器删除。基线在拉取后被改写过时放弃本次合并。
+        """
+        from webdav3.urn import Urn
+        if self.base_source(client, remote_path) != self.state.get('base_source'):
+            return False
+        ops_path = remote_path + '.ops/'
+        logs = self.local_logs()
+        offsets = dict(self.checkpoint_offsets())  # 已删除的段也保留，其他终端据此清理本地副本
+        for name, size in logs:
+            offsets[name] = max(offsets.get(name, 0), size)
+        write_data(self.cache_filename, self.replica.data)
+        self.upload(client, self.cache_filename, remote_path, 'base')
+        source = self.base_source(client, remote_path)
+        if self.transfer_format != 'text':
+            self.upload_pack(client, remote_path, self.replica.data, source)
+        if os.path.exists(self.delta_filename) and os.path.getsize(self.delta_filename) > 0:
+            client.clean(remote_delta_path)
+            open(self.delta_filename, 'w').close()
+            self.state['delta'] = None
+        checkpoint = {'base': source, 'offsets': offsets, 'clock': self.replica.clock}
+        client.execute_request('upload', Urn(ops_path + LOG_CHECKPOINT_NAME).quote(),
+                               data=json.dumps(checkpoint).encode('utf-8'))
+        self.state['base_source'] = source
+        self.state['checkpoint'] = checkpoint
+        self.save_state()
+        current = self.current_segment()[0]
+        removed = 0
+        for name, size in logs:
+            if size >= self.delta_threshold and name != current:
+                client.clean(ops_path + name)
+                os.remove(os.path.join(self.ops_directory, name))
+                removed += 1
+        logging.info(f"Compacted {len(logs)} operation logs into '{remote_path}', removed {removed} full segments.")
+        return True
+
+    def check(self):
+        """检查WebDAV连接，返回 (是否连接, 完整数据或 None, 修改列表)"""
+        try:
+            data, changes = self.pull()
+            logging.info(f"WebDAV connection successful.")
+            return True, data, changes
+        except Exception:
+            return False, None, []
+
+    @timed('webdav.push')
+    def push(self, operations=()):
+        """把待上传队列中尚未上传的修改追加到自己的日志并上传，成功（或没有要上传的）返回 True
+
+        operations 为新的一批修改 (action, barcode, traceability, medication)，先加入队列。
+        成功后 state['pushed'] 为已上传的最大序号。
+        """
+        if operations:
+            self.record(operations)
+        with self.lock:
+            pushed = self.state.get('pushed', 0)
+            with self.outbox_lock:
+                outbox = [(number, operation) for number, operation in self.outbox if number > pushed]
+            if not outbox:
+                return True
+            operations = [operation for _, operation in outbox]
+            if self.replica is None:
+                self.replica = self.load_replica()
+            os.makedirs(self.ops_directory, exist_ok=True)
+            name, local_path, size = self.current_segment()
+            if size >= self.delta_threshold:
+                self.state['segment'] = self.state.get('segment', 0) + 1
+                self.save_state()
+                name, local_path, size = self.current_segment()
+            clock = self.replica.clock
+            entries = []
+            for operation in operations:
+                clock += 1
+                entries.append(((clock, self.terminal_id), operation))
+            try:
+                with open(local_path, 'a') as log:
+                    log.writelines(f"{stamp[0]},{format_operation(*operation)}" for stamp, operation in entries)
+                client, remote_path, remote_delta_path = self.remote_paths()
+                ops_path = remote_path + '.ops/'
+                if size == 0 and not client.check(ops_path):
+                    # 直接发 MKCOL，client.mkdir 会往 stdout 打印
+                    from webdav3.urn import Urn
+                    client.execute_request('mkdir', Urn(ops_path, directory=True).quote())
+                self.upload(client, local_path, ops_path + name)
+            except Exception as e:
+                # 撤回本批追加的内容，由调用方稍后重试
+                with open(local_path, 'r+') as log:
+                    log.truncate(size)
+                logging.error(f"Error writing data to WebDAV: {e}")
+                return False
+            self.replica.apply_many(entries)
+            self.state['pushed'] = outbox[-1][0]
+            self.save_state()
+            return True
+
+    def current_segment(self):
+        # 本终端正在写的日志段：(文件名, 本地路径, 大小)
+        name = f"{self.terminal_id}-{self.state.get('segment', 0):06d}.log"
+        local_path = os.path.join(self.ops_directory, name)
+        return name, local_path, os.path.getsize(local_path) if os.path.exists(local_path) else 0
+
+
+class SyncWorker:
+    """后台写回线程：界面线程只提交修改，合并连续的修改后一次上传，失败时稍后重试；空闲时定期拉取其他终端的修改"""
+
+    def __init__(self, webdav_sync, flush_delay=0.3, retry_delay=5,
+                 pull_interval=DEFAULT_APP_CONFIG['webdav_pull_interval']):
+        self.webdav_sync = webdav_sync
+        self.flush_delay = flush_delay
+        self.retry_delay = retry_delay
+        self.pull_interval = pull_interval
+        self.pull_enabled = threading.Event()  # 连接检查成功后才定期拉取
+        self.operations = queue.Queue()
+        self.statuses = queue.Queue()  # 由界面线程轮询
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, action, barcode, traceability, medication=None):
+        # 修改已由调用方写入待上传队列，这里只用于合并计数和唤醒线程
+        self.operations.put((action, barcode, traceability, medication))
+
+    def run(self):
+        pending = []
+        while True:
+            if not pending:
+                try:
+                    pending.append(self.operations.get(timeout=self.pull_interval))
+                except queue.Empty:
+                    if self.pull_enabled.is_set():
+                        self.pull()
+                    continue
+            # 稍等片刻，把连续扫码产生的修改合并成一次上传
+            deadline = time.monotonic() + self.flush_delay
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    pending.append(self.operations.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self.statuses.put(('syncing', len(pending)))
+            if self.webdav_sync.push():
+                # 界面线程按顺序处理到这条状态时再确认，之前排队的远端数据仍以这些修改为本地修改
+                self.statuses.put(('synced', (len(pending), self.webdav_sync.state.get('pushed', 0))))
+                for _ in pending:
+                    self.operations.task_done()
+                pending = []
+            else:
+                self.statuses.put(('error', len(pending)))
+                time.sleep(self.retry_delay)
+
+    def pull(self):
+        # 远端修改和上传状态放进同一个队列，界面线程按发生顺序处理
+        try:
+            data, changes = self.webdav_sync.pull()
+        except Exception as e:
+            logging.error(f"Error pulling changes from WebDAV: {e}")
+            return
+        if data is not None or changes:
+            self.statuses.put(('remote', (data, changes)))
+
+    def wait_idle(self, timeout):
+        """等待已提交的修改全部上传，超时返回 False"""
+        deadline = time.monotonic() + timeout
+        while self.operations.unfinished_tasks:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+
+# 批量导入导出
+IMPORT_CHUNK_SIZE = 5000  # 每块校验、提交的行数
+IMPORT_COLUMN_ALIASES = {
+    'barcode': 'barcode', '条形码': 'barcode',
+    'traceability': 'traceability', '追溯码': 'traceability',
+    'medication': 'medication', '药品名称': 'medication',
+}
+
+
+def is_valid_barcode(barcode):
+    return (barcode.isdigit() and len(barcode) == 13) or barcode == "0"
+
+
+def is_valid_traceability(traceability):
+    return traceability.isdigit() and len(traceability) == 20
+
+
+def iter_import_rows(filename, progress):
+    """逐行读取导入文件（CSV 或 JSONL），产出 (行号, 条形码, 追溯码, 药品名称, 错误)
+
+    progress[0] 随读取更新为已读字节数。CSV 第一行不是数字时视为表头，按列名
+    （barcode/traceability/medication 或 条形码/追溯码/药品名称）确定各列；没有表头时
+    依次为 条形码, 追溯码, 药品名称（可省略）。
+    """
+    with open(filename, 'rb') as file:
+        def lines():
+            for raw_line in file:
+                progress[0] += len(raw_line)
+                try:
+                    yield raw_line.decode('utf-8-sig')
+                except UnicodeDecodeError:
+                    yield raw_line.decode('gbk', errors='replace')  # Excel 另存的 CSV 常为 GBK 编码
+
+        if filename.lower().endswith(('.jsonl', '.json')):
+            for line_number, line in enumerate(lines(), 1):
+                if not line.strip():
+                    continue
+                try:
+                    item = json.loads(line)
+                    fields = {IMPORT_COLUMN_ALIASES.get(key.lower()): str(value).strip()
+                              for key, value in item.items() if value is not None}
+                except (ValueError, AttributeError):
+                    yield line_number, None, None, None, "不是有效的JSON对象"
+                    continue
+                yield (line_number, fields.get('barcode', ''), fields.get('traceability', ''),
+                       fields.get('medication') or None, None)
+        else:
+            reader = csv.reader(lines())
+            columns = (0, 1, 2)
+            for row in reader:
+                row = [value.strip() for value in row]
+                if not any(row):
+                    continue
+                if reader.line_num == 1 and not row[0].isdigit():
+                    # 表头：按列名确定列的位置
+                    names = [IMPORT_COLUMN_ALIASES.get(value.lower()) for value in row]
+                    columns = tuple(names.index(name) if name in names else None
+                                    for name in ('barcode', 'traceability', 'medication'))
+                    continue
+                barcode, traceability, medication = (
+                    row[column] if column is not None and column < len(row) else '' for column in columns)
+                yield reader.line_num, barcode, traceability, medication or None, None
+
+
+def iter_import_chunks(filename, chunk_size=IMPORT_CHUNK_SIZE):
+    """按块读取并校验导入文件，产出 (已读字节数, 有效行, 错误)，不会一次读入整个文件"""
+    progress = [0]
+    rows = []
+    errors = []
+    for line_number, barcode, traceability, medication, error in iter_import_rows(filename, progress):
+        if error is None and not is_valid_barcode(barcode):
+            error = "条形码必须是13位数字。"
+        if error is None and not is_valid_traceability(traceability):
+            error = "追溯码必须是20位数字。"
+        if error is None:
+            rows.append((line_number, barcode, traceability, medication))
+        else:
+            errors.append((line_number, error))
+        if len(rows) + len(errors) >= chunk_size:
+            yield progress[0], rows, errors
+            rows = []
+            errors = []
+    yield progress[0], rows, errors
+
+
+def add_import_error(stats, line_number, message):
+    # 只保留前100条错误明细，其余只计数
+    stats['error_count'] += 1
+    if len(stats['errors']) < 100:
+        stats['errors'].append((line_number, message))
+
+
+def plan_import(data, trace_index, rows, stats):
+    """对一块有效行查重，返回需要执行的修改 (action, barcode, traceability, medication)"""
+    operations = []
+    accepted = set()  # 本块中已接受的追溯码
+    created = set()  # 本块中新建的条形码
+    for line_number, barcode, traceability, medication in rows:
+        record = data.get(barcode)
+        # 已在本条形码下，或仍在索引记录的条形码下
+        owner = trace_index.barcode_of(traceability)
+        if (traceability in accepted
+                or (record is not None and traceability in record)
+                or (owner is not None and owner in data and traceability in data[owner])):
+            stats['duplicates'] += 1
+            continue
+        if traceability in trace_index:
+            stats['seen_before'] += 1
+        if record is None and barcode not in created:
+            if not medication:
+                add_import_error(stats, line_number, "未找到条形码信息，且未提供药品名称。")
+                continue
+            operations.append(('CREATE', barcode, traceability, medication))
+            created.add(barcode)
+        else:
+            operations.append(('ADD', barcode, traceability, None))
+        accepted.add(traceability)
+    stats['imported'] += len(operations)
+    return operations
+
+
+def export_data(records, filename, progress=None, total=None):
+    """流式导出 (条形码, MedicationRecord)：CSV 每个追溯码一行，JSONL 每个追溯码一个对象；返回导出的追溯码数量
+
+    没有追溯码的药品也导出一行（追溯码为空），保留药品名称。total 为预计的条形码数量，只用于进度。
+    """
+    position = 0
+    is_jsonl = filename.lower().endswith(('.jsonl', '.json'))
+    count = 0
+    with open(filename, 'w', encoding='utf-8' if is_jsonl else 'utf-8-sig', newline='') as file:
+        writer = None if is_jsonl else csv.writer(file)
+        if writer:
+            writer.writerow(['barcode', 'medication', 'traceability'])
+        for position, (barcode, record) in enumerate(records, 1):
+            values = iter(record)
+            medication = next(values)
+            traceabilities = list(values) or ['']
+            for traceability in traceabilities:
+                if writer:
+                    writer.writerow([barcode, medication, traceability])
+                else:
+                    file.write(json.dumps({'barcode': barcode, 'medication': medication,
+                                           'traceability': traceability}, ensure_ascii=False) + '\n')
+            count += len(record) - 1
+            if progress is not None and position % 500 == 0:
+                progress(position, max(total or 0, position))
+    if progress is not None:
+        progress(position, position)
+    return count
+
+
+def parse_sale_events(body):
+    """解析销售平台推送的内容，返回 ([(条形码或None, 追溯码)], 无效条目数)
+
+    支持一个 JSON 值或每行一个 JSON 值；每项可以是追溯码字符串，
+    或 {"traceability": ...} / {"traceabilities": [...]}，可附带 "barcode"。
+    """
+    text = body.decode('utf-8-sig').strip()
+    if not text:
+        return [], 0
+    try:
+        items = json.loads(text)
+    except ValueError:
+        items = [json.loads(line) for line in text.splitlines() if line.strip()]
+    if not isinstance(items, list):
+        items = [items]
+    events = []
+    rejected = 0
+    for item in items:
+        if isinstance(item, dict):
+            barcode = str(item.get('barcode') or '').strip() or None
+            codes = item.get('traceabilities')
+            if not isinstance(codes, list):
+                codes = [item.get('traceability')]
+        else:
+            barcode, codes = None, [item]
+        if barcode is not None and not is_valid_barcode(barcode):
+            barcode = None
+        for code in codes:
+            code = str(code if code is not None else '').strip()
+            if is_valid_traceability(code):
+                events.append((barcode, code))
+            else:
+                rejected += 1
+    return events, rejected
+
+
+class SalesListener:
+    """销售平台监听：本地 HTTP 接口接收售出的追溯码，放入队列由界面线程批量删除"""
+
+    def __init__(self, host, port):
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        events = self.events = queue.Queue()
+
+        class SaleHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path.rstrip('/') != '/sale':
+                    self.respond(404, {'error': 'not found'})
+                    return
+                length = int(self.headers.get('Content-Length') or 0)
+                try:
+                    accepted, rejected = parse_sale_events(self.rfile.read(length))
+                except ValueError as e:
+                    self.respond(400, {'error': str(e)})
+                    return
+                for event in accepted:
+                    events.put(event)
+                self.respond(202, {'accepted': len(accepted), 'rejected': rejected})
+
+            def respond(self, status, body):
+                payload = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                logging.debug("Sales listener: " + format, *args)
+
+        self.server = ThreadingHTTPServer((host, port), SaleHandler)
+        self.server.daemon_threads = True
+        self.url = f"http://{host}:{self.server.server_address[1]}/sale"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def drain(self):
+        # 取出目前收到的全部销售事件
+        events = []
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                return events
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+_pypinyin = None
+
+
+def load_pypinyin():
+    # pypinyin 是可选依赖，未安装时只按药品名称检索
+    global _pypinyin
+    if _pypinyin is None:
+        try:
+            import pypinyin
+            _pypinyin = pypinyin
+        except ImportError:
+            _pypinyin = False
+    return _pypinyin
+
+
+def medication_search_keys(medication):
+    """药品名称的检索键：名称、全拼、拼音首字母"""
+    name = medication.lower()
+    keys = [name]
+    pypinyin = load_pypinyin()
+    if pypinyin:
+        full = ''.join(pypinyin.lazy_pinyin(name)).replace(' ', '')
+        initials = ''.join(pypinyin.lazy_pinyin(name, style=pypinyin.Style.FIRST_LETTER)).replace(' ', '')
+        for key in (full, initials):
+            if key not in keys:
+                keys.append(key)
+    return keys
+
+
+def iter_medications(data):
+    """依次返回 (条形码, 药品名称)；按需加载的存储只读名称，不解析也不缓存追溯码"""
+    if isinstance(data, (LazyRecords, SQLiteRecords)):
+        return data.medications()
+    return ((barcode, values[0]) for barcode, values in data.items())
+
+
+class MedicationSearchIndex:
+    """药品名称检索索引：对名称、全拼、首字母的单字和二元组建立倒排表"""
+
+    @timed('search.build_index')
+    def __init__(self, data=None):
+        self.keys = {}  # 条形码 -> 检索键
+        self.postings = {}  # 单字/二元组 -> 条形码集合
+        for barcode, medication in iter_medications(data or {}):
+            self.add(barcode, medication)
+
+    @staticmethod
+    def grams(text):
+        grams = set(text)
+        grams.update(text[i:i + 2] for i in range(len(text) - 1))
+        return grams
+
+    def add(self, barcode, medication):
+        self.remove(barcode)
+        keys = medication_search_keys(medication)
+        self.keys[barcode] = keys
+        for key in keys:
+            for gram in self.grams(key):
+                self.postings.setdefault(gram, set()).add(barcode)
+
+    def remove(self, barcode):
+        keys = self.keys.pop(barcode, None)
+        if keys is None:
+            return
+        for key in keys:
+            for gram in self.grams(key):
+                barcodes = self.postings.get(gram)
+                if barcodes is not None:
+                    barcodes.discard(barcode)
+                    if not barcodes:
+                        del self.postings[gram]
+
+    @timed('search.query')
+    def search(self, term, limit=None):
+        """返回匹配的条形码：完全匹配、前缀匹配、包含匹配依次排序，同级按名称长度"""
+        term = term.strip().lower()
+        if not term:
+            return []
+        query_grams = {term} if len(term) == 1 else {term[i:i + 2] for i in range(len(term) - 1)}
+        candidate_sets = [self.postings.get(gram) for gram in query_grams]
+        if not all(candidate_sets):
+            return []
+        candidate_sets.sort(key=len)
+        candidates = candidate_sets[0].intersection(*candidate_sets[1:])
+
+        ranked = []
+        for barcode in candidates:
+            keys = self.keys[barcode]
+            rank = None
+            for key in keys:
+                if key == term:
+                    rank = 0
+                    break
+                if key.startswith(term):
+                    rank = 1
+                elif term in key and rank is None:
+                    rank = 2
+            if rank is not None:
+                ranked.append((rank, len(keys[0]), keys[0], barcode))
+        ranked = heapq.nsmallest(limit, ranked) if limit is not None else sorted(ranked)
+        return [barcode for _, _, _, barcode in ranked]
+
+
+# 事件日志分段文件名：events-<日期>-<序号>.jsonl
+AUDIT_SEGMENT_PATTERN = re.compile(r'^events-(\d{8})-(\d{3})\.jsonl$')
+
+
+def audit_time(value, end=False):
+    # 查询时间：datetime 或 'YYYY-MM-DD[ HH:MM:SS]'，只有日期时 end 取当天最后一秒
+    if value is None:
+        return None
+    if isinstance(value, datetime.datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    if isinstance(value, datetime.date):
+        value = value.isoformat()
+    if len(value) == 10:
+        value += ' 23:59:59' if end else ' 00:00:00'
+    return value
+
+
+class AuditLog:
+    """结构化事件日志：JSONL 分段按天和大小轮转，并建立条形码索引
+
+    每个分段 events-YYYYMMDD-NNN.jsonl 旁有 .idx（条形码,字节偏移），
+    barcodes.idx 记录条形码出现在哪些分段；分段名本身就是按日期的索引。
+    按条形码或日期查询时只读取相关的分段。
+    """
+
+    def __init__(self, directory, segment_size=DEFAULT_APP_CONFIG['audit_segment_size']):
+        self.directory = directory
+        self.segment_size = segment_size
+        os.makedirs(directory, exist_ok=True)
+        self.barcodes_filename = os.path.join(directory, 'barcodes.idx')
+        self.barcode_segments = None  # 条形码 -> 分段列表，首次按条形码查询时读取
+        self.segment = None
+        self.file = None
+        self.index_file = None
+        self.size = 0
+        self.segment_barcodes = set()
+        self.lock = threading.Lock()
+
+    def segments(self):
+        return sorted(name for name in os.listdir(self.directory) if AUDIT_SEGMENT_PATTERN.match(name))
+
+    def path(self, segment, suffix='.jsonl'):
+        return os.path.join(self.directory, segment[:-len('.jsonl')] + suffix)
+
+    def open_segment(self, date):
+        # 当天最后一个分段未写满则继续写，否则开始新分段
+        existing = [name for name in self.segments() if name.startswith(f'events-{date}-')]
+        number = int(AUDIT_SEGMENT_PATTERN.match(existing[-1]).group(2)) if existing else 0
+        if existing and os.path.getsize(self.path(existing[-1])) >= self.segment_size:
+            number += 1
+        self.close()
+        self.segment = f'events-{date}-{number:03d}.jsonl'
+        self.file = open(self.path(self.segment), 'ab')
+        self.size = self.file.tell()
+        self.segment_barcodes = set()
+        if os.path.exists(self.path(self.segment, '.idx')):
+            with open(self.path(self.segment, '.idx'), 'r') as index_file:
+                self.segment_barcodes = {line.split(',', 1)[0] for line in index_file}
+        self.index_file = open(self.path(self.segment, '.idx'), 'a')
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.index_file.close()
+            self.file = self.index_file = None
+
+    def write_many(self, events):
+        """追加一批事件 (时间, action, barcode, medication, traceability)"""
+        for date, group in itertools.groupby(events, key=lambda event: event[0][:10].replace('-', '')):
+            self.write_segment(date, list(group))
+
+    def write_segment(self, date, events):
+        # 同一天的事件写入当天的分段
+        with self.lock:
+            if self.file is None or not self.segment.startswith(f'events-{date}-') or self.size >= self.segment_size:
+                self.open_segment(date)
+            # 偏移按文件的实际末尾计算，不依赖缓存的大小
+            self.file.seek(0, 2)
+            offset = self.file.tell()
+            lines = []
+            index_lines = []
+            new_barcodes = []
+            for timestamp, action, barcode, medication, traceability in events:
+                line = json.dumps({'time': timestamp, 'action': action, 'barcode': barcode,
+                                   'medication': medication, 'traceability': traceability},
+                                  ensure_ascii=False).encode('utf-8') + b'\n'
+                index_lines.append(f"{barcode},{offset}\n")
+                offset += len(line)
+                lines.append(line)
+                if barcode not in self.segment_barcodes:
+                    self.segment_barcodes.add(barcode)
+                    new_barcodes.append(barcode)
+            self.file.write(b''.join(lines))
+            self.file.flush()
+            self.size = self.file.tell()
+            self.index_file.writelines(index_lines)
+            self.index_file.flush()
+            if new_barcodes:
+                with open(self.barcodes_filename, 'a') as file:
+                    file.writelines(f"{barcode},{self.segment}\n" for barcode in new_barcodes)
+                if self.barcode_segments is not None:
+                    for barcode in new_barcodes:
+                        self.barcode_segments.setdefault(barcode, []).append(self.segment)
+
+    def load_barcode_segments(self):
+        if self.barcode_segments is None:
+            self.barcode_segments = {}
+            try:
+                with open(self.barcodes_filename, 'r') as file:
+                    for line in file:
+                        barcode, _, segment = line.rstrip('\n').partition(',')
+                        segments = self.barcode_segments.setdefault(barcode, [])
+                        if segment not in segments:
+                            segments.append(segment)
+            except FileNotFoundError:
+                pass
+        return self.barcode_segments
+
+    def position(self):
+        """事件日志的末尾位置 (分段, 字节偏移)，可按元组比较先后；还没有事件时返回 None"""
+        if self.file is not None:
+            return self.segment, self.size
+        segments = self.segments()
+        if not segments:
+            return None
+        return segments[-1], os.path.getsize(self.path(segments[-1]))
+
+    def drop_segments(self, segments):
+        """删除已归档的分段及其 .idx，并从 barcodes.idx 中去掉这些分段"""
+        dropped = set(segments)
+        if not dropped:
+            return
+        barcode_segments = self.load_barcode_segments()
+        for barcode in list(barcode_segments):
+            barcode_segments[barcode] = [name for name in barcode_segments[barcode] if name not in dropped]
+            if not barcode_segments[barcode]:
+                del barcode_segments[barcode]
+        temp_filename = self.barcodes_filename + '.tmp'
+        with open(temp_filename, 'w') as file:
+            for barcode, names in barcode_segments.items():
+                file.writelines(f"{barcode},{name}\n" for name in names)
+        os.replace(temp_filename, self.barcodes_filename)
+        for segment in dropped:
+            for suffix in ('.jsonl', '.idx'):
+                try:
+                    os.remove(self.path(segment, suffix))
+                except FileNotFoundError:
+                    pass
+
+    def iter_events(self, segments, barcode=None, after=None):
+        """按顺序读取分段中的事件；给出条形码时只按 .idx 中的偏移读取该条形码的事件
+
+        after 为 position() 返回的位置时只读取该位置之后写入的事件。
+        """
+        for segment in segments:
+            start = 0
+            if after is not None:
+                if segment < after[0]:
+                    continue
+                if segment == after[0]:
+                    start = after[1]
+            try:
+                with open(self.path(segment), 'rb') as file:
+                    if barcode is None:
+                        file.seek(start)
+                        for line in file:
+                            if line.endswith(b'\n'):
+                                yield json.loads(line)
+                        continue
+                    prefix = barcode + ','
+                    with open(self.path(segment, '.idx'), 'r') as index_file:
+                        offsets = [int(line[len(prefix):]) for line in index_file if line.startswith(prefix)]
+                    offsets = [offset for offset in offsets if offset >= start]
+                    events = []
+                    for offset in offsets:
+                        file.seek(offset)
+                        line = file.readline()
+                        try:
+                            event = json.loads(line)
+                        except ValueError:
+                            event = None
+                        if event is None or event.get('barcode') != barcode:
+                            # 索引与分段不一致时改为顺序读取整个分段
+                            logging.warning(f"Audit index mismatch in {segment} at offset {offset}, scanning segment")
+                            file.seek(start)
+                            events = [json.loads(line) for line in file if line.endswith(b'\n')]
+                            events = [event for event in events if event.get('barcode') == barcode]
+                            break
+                        events.append(event)
+                    yield from events
+            except FileNotFoundError:
+                continue
+
+    @timed('logs.audit_query')
+    def query(self, barcode=None, action=None, start=None, end=None):
+        """查询事件，按时间顺序返回字典列表
+
+        例如 query(barcode='6901234567890') 返回该条形码的全部事件，
+        query(action='ADD', start='2024-01-01', end='2024-01-31') 返回一月份的所有添加。
+        """
+        start, end = audit_time(start), audit_time(end, end=True)
+        if barcode is not None:
+            segments = self.load_barcode_segments().get(barcode, [])
+        else:
+            segments = self.segments()
+        # 分段名中的日期即按日期的索引
+        segments = [segment for segment in segments
+                    if (start is None or segment[7:15] >= start[:10].replace('-', ''))
+                    and (end is None or segment[7:15] <= end[:10].replace('-', ''))]
+        events = []
+        for event in self.iter_events(segments, barcode):
+            if ((action is None or event['action'] == action)
+                    and (start is None or event['time'] >= start)
+                    and (end is None or event['time'] <= end)):
+                events.append(event)
+        return events
+
+
+class StateSnapshots:
+    """定期保存的数据快照，每个快照记下保存时事件日志的末尾位置
+
+    快照为 pack_data 格式的 snapshot-<时间>.pack，清单 snapshots.jsonl 每行一个
+    {time, file, segment, offset}。重建某一时刻的数据时读取此前最近的快照，只重放其后的事件。
+    """
+
+    def __init__(self, directory, audit_log, interval_hours=DEFAULT_APP_CONFIG['snapshot_interval_hours']):
+        self.directory = directory
+        self.audit_log = audit_log
+        self.interval = datetime.timedelta(hours=interval_hours)
+        os.makedirs(directory, exist_ok=True)
+        self.manifest_filename = os.path.join(directory, 'snapshots.jsonl')
+        self.lock = threading.Lock()
+        self.entries = self.load_entries()
+        self.last_taken = self.entries[-1]['time'] if self.entries else None
+        self.writers = []  # 正在后台压缩写入的线程
+        self.cache = None  # (快照文件, 数据)，连续查询时不必重复解包
+
+    def load_entries(self):
+        entries = []
+        try:
+            with open(self.manifest_filename, 'r', encoding='utf-8') as file:
+                for line in file:
+                    if not line.endswith('\n'):
+                        break  # 崩溃时未写完的最后一行
+                    entry = json.loads(line)
+                    if os.path.exists(os.path.join(self.directory, entry['file'])):
+                        entries.append(entry)
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def due(self):
+        # 距离上次快照已超过间隔
+        if self.last_taken is None:
+            return True
+        last = datetime.datetime.strptime(self.last_taken, "%Y-%m-%d %H:%M:%S")
+        return datetime.datetime.now() - last >= self.interval
+
+    def take(self, copy_records, timestamp=None):
+        """保存快照：位置取事件日志当前末尾，复制数据（copy_records()）和压缩写入都在后台线程
+
+        复制时可能已包含此后的修改，快照时间取复制完成的时刻，重建时从该位置重放的事件
+        再应用一次，结果不变。不给 timestamp 时即用该时刻。
+        """
+        position = self.audit_log.position()
+        self.last_taken = timestamp or datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.writers = [writer for writer in self.writers if writer.is_alive()]
+        writer = threading.Thread(target=self.write, args=(copy_records, position, timestamp), daemon=True)
+        self.writers.append(writer)
+        writer.start()
+
+    @timed('logs.snapshot')
+    def write(self, copy_records, position, timestamp=None):
+        # 先写快照文件，再追加清单；中途失败时清单中没有这个快照
+        try:
+            snapshot = copy_records()
+            now = datetime.datetime.now()
+            entry = {'time': timestamp or now.strftime("%Y-%m-%d %H:%M:%S"),
+                     'file': f"snapshot-{now.strftime('%Y%m%d-%H%M%S-%f')}.pack",
+                     'segment': position[0] if position else None, 'offset': position[1] if position else 0}
+            filename = os.path.join(self.directory, entry['file'])
+            with open(filename + '.tmp', 'wb') as file:
+                file.write(pack_data(snapshot))
+            os.replace(filename + '.tmp', filename)
+            with self.lock:
+                with open(self.manifest_filename, 'a', encoding='utf-8') as file:
+                    file.write(json.dumps(entry) + '\n')
+                self.entries.append(entry)
+                self.entries.sort(key=lambda item: item['time'])
+        except Exception as e:
+            logging.error(f"Error saving snapshot: {e}")
+            return
+        logging.info(f"Saved snapshot '{entry['file']}' with {len(snapshot)} barcodes.")
+
+    def prune(self, horizon):
+        """删除早于 horizon 的快照，只保留其中最近的一个作为之后重建的起点"""
+        self.close()
+        with self.lock:
+            older = [entry for entry in self.entries if entry['time'] < horizon][:-1]
+            if not older:
+                return
+            self.entries = [entry for entry in self.entries if entry not in older]
+            temp_filename = self.manifest_filename + '.tmp'
+            with open(temp_filename, 'w', encoding='utf-8') as file:
+                file.writelines(json.dumps(entry) + '\n' for entry in self.entries)
+            os.replace(temp_filename, self.manifest_filename)
+        for entry in older:
+            os.remove(os.path.join(self.directory, entry['file']))
+        self.cache = None
+
+    def close(self):
+        # 等待后台写入完成
+        for writer in self.writers:
+            writer.join()
+        self.writers = []
+
+    def load(self, entry, barcode=None):
+        # 只查一个条形码时只解析它的记录；完整解析的快照保留在缓存中
+        if self.cache is not None and self.cache[0] == entry['file']:
+            return self.cache[1]
+        with open(os.path.join(self.directory, entry['file']), 'rb') as file:
+            blob = file.read()
+        if barcode is not None:
+            return unpack_data(blob, {barcode})
+        self.cache = (entry['file'], unpack_data(blob))
+        return self.cache[1]
+
+    @timed('logs.reconstruct')
+    def reconstruct(self, at, barcode=None):
+        """重建 at 时刻（含）的数据 {条形码: MedicationRecord}；给出条形码时只重建该条形码
+
+        at 为 datetime 或 'YYYY-MM-DD[ HH:MM:SS]'，只有日期时取当天结束。没有更早的快照时
+        从事件日志开头重放，只包含事件日志记录过的修改。
+        """
+        at = audit_time(at, end=True)
+        with self.lock:
+            earlier = [entry for entry in self.entries if entry['time'] <= at]
+        data = {}
+        after = None
+        if earlier:
+            entry = earlier[-1]
+            snapshot = self.load(entry, barcode)
+            if barcode is not None:
+                data = {barcode: snapshot[barcode].copy()} if barcode in snapshot else {}
+            else:
+                data = {key: values.copy() for key, values in snapshot.items()}
+            if entry['segment'] is not None:
+                after = (entry['segment'], entry['offset'])
+        if barcode is not None:
+            segments = self.audit_log.load_barcode_segments().get(barcode, [])
+        else:
+            segments = self.audit_log.segments()
+        segments = [segment for segment in segments
+                    if segment[7:15] <= at[:10].replace('-', '') and (after is None or segment >= after[0])]
+        for event in self.audit_log.iter_events(segments, barcode, after):
+            if event['time'] > at:
+                break  # 事件按写入顺序排列，之后的都更晚
+            if event.get('traceability'):
+                apply_operation(data, event['action'], event['barcode'], event['traceability'], event['medication'])
+        return data
+
+
+STATS_SAVE_INTERVAL = 1000  # 库存统计每累计多少个事件保存一次
+
+
+class InventoryStats:
+    """库存统计：各药品的在库追溯码数、最近进出时间和每天的添加/删除数，随每次修改增量更新
+
+    保存在 stats.json 中并记下当时事件日志的末尾位置，启动时只重放此后的事件；
+    没有统计文件或事件日志对不上时，从数据和事件日志重建一次。
+    """
+
+    def __init__(self, filename, audit_log):
+        self.filename = filename
+        self.audit_log = audit_log
+        self.items = {}  # 条形码 -> [药品名称, 在库数, 最近添加时间, 最近删除时间]
+        self.daily = {}  # 日期 -> [添加数, 删除数]
+        self.unsaved = 0
+
+    def load(self, data):
+        try:
+            with open(self.filename, 'r', encoding='utf-8') as file:
+                saved = json.load(file)
+        except (FileNotFoundError, ValueError):
+            self.rebuild(data)
+            return
+        self.items = saved['items']
+        self.daily = saved['daily']
+        after = tuple(saved['position']) if saved['position'] else None
+        segments = self.audit_log.segments()
+        current = self.audit_log.position()
+        if after is not None and (after[0] not in segments or after > current):
+            self.rebuild(data)  # 事件日志被删除或替换过
+            return
+        events = [(event['time'], event['action'], event['barcode'], event['medication'], event['traceability'])
+                  for event in self.audit_log.iter_events(segments, after=after)]
+        if events:
+            self.record(events, data)
+        if len(self.items) != len(data):
+            # 有没经过本服务的修改，重新统计一次在库数
+            self.refresh(data, set(data) | set(self.items))
+
+    @timed('stats.rebuild')
+    def rebuild(self, data):
+        """从当前数据统计在库数，再扫描一次事件日志得到最近进出时间和每天的添加/删除数"""
+        self.items = {}
+        self.daily = {}
+        self.refresh(data, list(data))
+        for event in self.audit_log.iter_events(self.audit_log.segments()):
+            self.count_event(event['time'], event['action'], event['barcode'])
+        self.save()
+        logging.info(f"Rebuilt inventory statistics for {len(self.items)} barcodes.")
+
+    def count_event(self, timestamp, action, barcode):
+        # 已不在数据中的条形码只计入每天的添加/删除数
+        deleted = action == 'DELETE'
+        self.daily.setdefault(timestamp[:10], [0, 0])[1 if deleted else 0] += 1
+        item = self.items.get(barcode)
+        if item is not None:
+            item[3 if deleted else 2] = timestamp
+
+    def record(self, events, data):
+        """增量更新一批已写入事件日志的修改 (时间, action, barcode, medication, traceability)"""
+        # 在库数直接取修改后的记录长度，重复添加、删除不存在的追溯码不会计错
+        self.refresh(data, {event[2] for event in events})
+        for timestamp, action, barcode, medication, traceability in events:
+            self.count_event(timestamp, action, barcode)
+        self.unsaved += len(events)
+        if self.unsaved >= STATS_SAVE_INTERVAL:
+            self.save()
+
+    def refresh(self, data, barcodes):
+        # 重新读取这些条形码的药品名称和在库数，已不在数据中的移除
+        for barcode in barcodes:
+            record = data.get(barcode)
+            if record is None:
+                self.items.pop(barcode, None)
+                continue
+            item = self.items.setdefault(barcode, [None, 0, None, None])
+            item[0] = record[0]
+            item[1] = len(record) - 1
+
+    def save(self):
+        # 记下事件日志当前位置，下次启动只重放其后的事件
+        position = self.audit_log.position()
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'w', encoding='utf-8') as file:
+            json.dump({'position': list(position) if position else None, 'items': self.items,
+                       'daily': self.daily}, file, ensure_ascii=False)
+        os.replace(temp_filename, self.filename)
+        self.unsaved = 0
+
+    def summary(self):
+        # (药品种类数, 在库追溯码总数)
+        return len(self.items), sum(item[1] for item in self.items.values())
+
+    def top_stock(self, count=20):
+        """在库追溯码最多的药品 [(条形码, 药品名称, 在库数)]"""
+        top = heapq.nlargest(count, self.items.items(), key=lambda entry: entry[1][1])
+        return [(barcode, item[0], item[1]) for barcode, item in top]
+
+    def slowest(self, count=20):
+        """滞销药品：有库存、最近删除（售出）最早的在前，从未删除过的按最近添加时间排 [(条形码, 药品名称, 在库数, 最近删除时间)]"""
+        stocked = ((barcode, item) for barcode, item in self.items.items() if item[1] > 0)
+        slow = heapq.nsmallest(count, stocked, key=lambda entry: (entry[1][3] or '', entry[1][2] or ''))
+        return [(barcode, item[0], item[1], item[3]) for barcode, item in slow]
+
+    def recent_days(self, count=30):
+        """最近若干天的 [(日期, 添加数, 删除数)]，新的在前"""
+        return [(day, *self.daily[day]) for day in sorted(self.daily, reverse=True)[:count]]
+
+
+# 归档分段文件名：archive-<年月>.jsonl.gz
+ARCHIVE_SEGMENT_PATTERN = re.compile(r'^archive-(\d{6})\.jsonl\.gz$')
+ARCHIVE_BLOCK_RECORDS = 256  # 每个压缩块的记录数，查询时只解压命中的块
+ARCHIVE_INDEX_WIDTH = 34  # 索引定长行：20位追溯码,12位块偏移\n
+
+
+class CodeArchive:
+    """冷数据归档：按月分段、只追加的压缩 JSONL，按追溯码建立索引
+
+    分段 archive-YYYYMM.jsonl.gz 由若干独立的 gzip 块组成，追加时只在末尾写新块；
+    旁边的 .idx 是按追溯码排序的定长行（追溯码,块偏移），查询时在各分段的索引中
+    二分查找，只解压命中的块。记录与事件日志相同（time, action, barcode, medication,
+    traceability），另有 SEEN（移出追溯码索引的条目，time 为最近添加，first 为首次添加）。
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.state_filename = os.path.join(directory, 'archive.json')
+        try:
+            with open(self.state_filename, 'r') as file:
+                self.state = json.load(file)  # last_run: 上次归档的日期；horizon: 已归档到的时间
+        except (FileNotFoundError, ValueError):
+            self.state = {}
+        self.maps = {}  # 分段 -> 索引的内存映射，首次查询时打开
+        self.segment_names = None  # 已有的分段，首次使用时列出
+
+    def save_state(self):
+        with open(self.state_filename, 'w') as file:
+            json.dump(self.state, file, indent=4)
+
+    def segments(self):
+        if self.segment_names is None:
+            self.segment_names = sorted(name for name in os.listdir(self.directory)
+                                        if ARCHIVE_SEGMENT_PATTERN.match(name))
+        return self.segment_names
+
+    def path(self, segment, suffix='.jsonl.gz'):
+        return os.path.join(self.directory, segment[:-len('.jsonl.gz')] + suffix)
+
+    @timed('archive.append')
+    def append(self, records):
+        """追加一批记录（字典），按记录时间的月份写入各分段"""
+        months = collections.defaultdict(list)
+        for record in records:
+            months[record['time'][:7].replace('-', '')].append(record)
+        for month, group in sorted(months.items()):
+            segment = f'archive-{month}.jsonl.gz'
+            entries = []
+            with open(self.path(segment), 'ab') as file:
+                for start in range(0, len(group), ARCHIVE_BLOCK_RECORDS):
+                    block = group[start:start + ARCHIVE_BLOCK_RECORDS]
+                    offset = file.tell()
+                    file.write(gzip.compress(b''.join(json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n'
+                                                      for record in block)))
+                    entries.extend(f"{record['traceability']},{offset:012d}\n".encode('ascii') for record in block
+                                   if is_valid_traceability(record.get('traceability') or ''))
+                file.flush()
+                os.fsync(file.fileno())
+            self.merge_index(segment, sorted(entries))
+            self.segment_names = None
+
+    def merge_index(self, segment, entries):
+        # 与已有索引归并后整体替换，保持按追溯码排序；按二进制读写，每行都是 ARCHIVE_INDEX_WIDTH 字节
+        index = self.maps.pop(segment, None)
+        if index is not None:
+            index.close()
+        index_filename = self.path(segment, '.idx')
+        temp_filename = index_filename + '.tmp'
+        previous = None
+        with open(temp_filename, 'wb') as file:
+            old = open(index_filename, 'rb') if os.path.exists(index_filename) else io.BytesIO()
+            with old:
+                for line in heapq.merge(old, entries):
+                    if line != previous:
+                        file.write(line)
+                        previous = line
+        os.replace(temp_filename, index_filename)
+
+    def index_map(self, segment):
+        if segment not in self.maps:
+            index_filename = self.path(segment, '.idx')
+            index = None
+            if os.path.exists(index_filename) and os.path.getsize(index_filename):
+                with open(index_filename, 'rb') as file:
+                    index = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[segment] = index
+        return self.maps[segment]
+
+    def close(self):
+        for index in self.maps.values():
+            if index is not None:
+                index.close()
+        self.maps = {}
+
+    def read_block(self, file, offset, traceability):
+        # 只解压从 offset 开始的一个 gzip 块，只解析含该追溯码的行
+        file.seek(offset)
+        decompressor = zlib.decompressobj(wbits=31)
+        chunks = []
+        while not decompressor.eof:
+            chunk = file.read(64 * 1024)
+            if not chunk:
+                break
+            chunks.append(decompressor.decompress(chunk))
+        key = traceability.encode('ascii')
+        records = (json.loads(line) for line in b''.join(chunks).splitlines() if key in line)
+        return [record for record in records if record['traceability'] == traceability]
+
+    def lookup(self, traceability):
+        """查询追溯码的全部归档记录，按时间排序"""
+        key = traceability.encode('ascii', 'replace')
+        width = ARCHIVE_INDEX_WIDTH
+        records = []
+        for segment in self.segments():
+            index = self.index_map(segment)
+            if index is None:
+                continue
+            low, high = 0, len(index) // width
+            while low < high:
+                middle = (low + high) // 2
+                if index[middle * width:middle * width + 20] < key:
+                    low = middle + 1
+                else:
+                    high = middle
+            offsets = []
+            while low < len(index) // width and index[low * width:low * width + 20] == key:
+                offsets.append(int(index[low * width + 21:low * width + 33]))
+                low += 1
+            if offsets:
+                with open(self.path(segment), 'rb') as file:
+                    for offset in offsets:
+                        records.extend(self.read_block(file, offset, traceability))
+        records.sort(key=lambda record: record['time'])
+        return records
+
+    def summary(self, traceability):
+        """归档中该追溯码的 [首次添加, 最近添加, 最近添加到的条形码]，没有添加记录时返回 None"""
+        entry = None
+        for record in self.lookup(traceability):
+            if record['action'] in ('ADD', 'CREATE', 'SEEN'):
+                first = record.get('first', record['time'])
+                if entry is None:
+                    entry = [first, record['time'], record['barcode']]
+                else:
+                    entry[0] = min(entry[0], first)
+                    if record['time'] >= entry[1]:
+                        entry[1:] = [record['time'], record['barcode']]
+        return entry
+
+
+class TraceabilityIndex:
+    """追溯码索引：记录每个追溯码首次、最近一次添加的时间及其条形码
+
+    移入归档的条目不在内存中，查询不到时再查归档（archive）。
+    """
+
+    def __init__(self, filename, log_filename, audit_log=None, archive=None):
+        self.filename = filename
+        self.log_filename = log_filename
+        self.audit_log = audit_log
+        self.archive = archive
+        self.entries = {}
+        if os.path.exists(self.filename):
+            self.load()
+        else:
+            self.rebuild()
+
+    def load(self):
+        self.entries = {}
+        with open(self.filename, 'r') as file:
+            for line in file:
+                parts = line.strip().split(',')
+                if len(parts) == 3:
+                    self._apply(*parts)
+
+    @timed('logs.rebuild_index')
+    def rebuild(self):
+        """扫描一次现有日志（含轮转的旧文件）和事件日志重建索引"""
+        self.entries = {}
+        log_filenames = [f"{self.log_filename}.{number}" for number in range(LOG_BACKUP_COUNT, 0, -1)]
+        for log_filename in log_filenames + [self.log_filename]:
+            try:
+                with open(log_filename, 'r') as log_file:
+                    for line in log_file:
+                        match = LOG_EVENT_PATTERN.search(line)
+                        if match and match.group(2) in ('ADD', 'CREATE'):
+                            timestamp, _, barcode, traceability = match.groups()
+                            self._apply(traceability, timestamp, barcode)
+            except FileNotFoundError:
+                pass
+        if self.audit_log is not None:
+            for event in self.audit_log.iter_events(self.audit_log.segments()):
+                if event['action'] in ('ADD', 'CREATE') and event.get('traceability'):
+                    self._apply(event['traceability'], event['time'], event['barcode'])
+        self.save()
+        logging.info(f"Rebuilt traceability index with {len(self.entries)} codes.")
+
+    def save(self):
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'w') as file:
+            for traceability, (first, last, barcode) in self.entries.items():
+                file.write(f"{traceability},{first},{barcode}\n")
+                if last != first:
+                    file.write(f"{traceability},{last},{barcode}\n")
+        os.replace(temp_filename, self.filename)
+
+    def older_than(self, horizon):
+        """最近添加早于 horizon 的条目 [(追溯码, 首次, 最近, 条形码)]"""
+        return [(traceability, first, last, barcode)
+                for traceability, (first, last, barcode) in self.entries.items() if last < horizon]
+
+    def remove(self, traceabilities):
+        # 移出已归档的条目并重写索引文件
+        for traceability in traceabilities:
+            self.entries.pop(traceability, None)
+        self.save()
+
+    def record(self, traceability, timestamp, barcode):
+        self.record_many([(traceability, timestamp, barcode)])
+
+    def record_many(self, entries):
+        # 增量更新：内存中更新并把 (追溯码, 时间, 条形码) 追加到索引文件
+        if not entries:
+            return
+        for entry in entries:
+            self._apply(*entry)
+        with open(self.filename, 'a') as file:
+            file.writelines(f"{traceability},{timestamp},{barcode}\n" for traceability, timestamp, barcode in entries)
+
+    def _apply(self, traceability, timestamp, barcode):
+        # 同一事件可能同时出现在文本日志和事件日志中，按时间取最早和最近
+        entry = self.entries.get(traceability)
+        if entry is None:
+            self.entries[traceability] = [timestamp, timestamp, barcode]
+        else:
+            if timestamp < entry[0]:
+                entry[0] = timestamp
+            if timestamp >= entry[1]:
+                entry[1] = timestamp
+                entry[2] = barcode
+
+    def entry(self, traceability):
+        entry = self.entries.get(traceability)
+        if entry is None and self.archive is not None:
+            entry = self.archive.summary(traceability)
+        return entry
+
+    def __contains__(self, traceability):
+        return self.entry(traceability) is not None
+
+    def first_seen(self, traceability):
+        entry = self.entry(traceability)
+        return entry[0] if entry else None
+
+    def last_seen(self, traceability):
+        entry = self.entry(traceability)
+        return entry[1] if entry else None
+
+    def barcode_of(self, traceability):
+        entry = self.entry(traceability)
+        return entry[2] if entry else None
+
+
+def format_import_summary(stats):
+    # 导入结果的说明文字，界面和命令行共用
+    message = (f"导入完成：新增 {stats['imported']} 个追溯码，跳过重复 {stats['duplicates']} 个，"
+               f"错误 {stats['error_count']} 行")
+    if stats['seen_before']:
+        message += f"，其中 {stats['seen_before']} 个曾经添加过"
+    if stats['errors']:
+        message += "\n" + "\n".join(f"第 {line_number} 行: {error}" for line_number, error in stats['errors'][:3])
+    return message
+
+
+def enable_console_log():
+    """把运行日志同时输出到 stderr，重复调用只添加一个处理器"""
+    root = logging.getLogger()
+    if not any(getattr(handler, 'console', False) for handler in root.handlers):
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        handler.addFilter(lambda record: getattr(record, 'console', True))  # extra={'console': False} 只写入日志文件
+        handler.console = True
+        root.addHandler(handler)
+
+
+def acquire_lock_file(filename):
+    """以独占方式锁定 filename 并返回打开的文件，关闭文件即释放；已被其他进程锁定时抛出 ValueError"""
+    file = open(filename, 'a+')
+    try:
+        if os.name == 'nt':
+            import msvcrt
+            file.seek(0)
+            msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        file.close()
+        raise ValueError("数据正被另一个追溯码记录器（图形界面或命令行）使用，请先关闭它再试。")
+    return file
+
+
+def release_lock_file(file):
+    if os.name == 'nt':
+        import msvcrt
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+    file.close()
+
+
+def serialized(method):
+    """装饰器：在服务的 write_lock 内执行，批量导入在后台线程提交，与界面线程的修改互斥"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.write_lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class TraceabilityService:
+    """追溯码记录的核心服务：查询、添加、删除、批量导入导出和 WebDAV 同步
+
+    界面和命令行都通过它修改数据，存储、事件日志、追溯码索引和同步保持一致。
+    background=True 时修改交给后台线程上传，并定期拉取其他终端的修改（调用方轮询
+    sync_worker.statuses）；否则 check_webdav() 连接成功后的修改在当前线程直接上传。
+    echo=True 时运行日志（包括每条修改记录）同时输出到控制台的 stderr；命令行不打开，
+    stdout 只输出结果。
+    存储、事件日志和索引文件由一个进程独占：另一个进程已打开服务时构造抛出 ValueError。
+    """
+
+    def __init__(self, filename=data_filename, config=None, background=False, echo=False):
+        self.lock_file = acquire_lock_file(lock_filename)
+        self.filename = filename
+        self.config = config or load_app_config()
+        self.echo = echo
+        if echo:
+            enable_console_log()
+        perf_stats.slow_threshold_ms = self.config['slow_operation_ms']
+        self.search_index = None  # 首次按名称搜索时建立
+        self.webdav_checking = False  # 正在检查WebDAV连接，期间的修改只写入待上传队列
+        self.webdav_connected = False
+        self.write_lock = threading.RLock()  # 查重和提交修改在同一把锁内
+
+        # 结构化事件日志，可按条形码、日期查询
+        self.audit_log = AuditLog(audit_directory, self.config['audit_segment_size'])
+
+        # 冷数据归档：早于 archive_after_days 的事件、追溯码和索引条目
+        self.archive = CodeArchive(archive_directory)
+
+        # 追溯码索引，查重时不再扫描日志；内存中没有的再查归档
+        self.trace_index = TraceabilityIndex(index_filename, log_filename, self.audit_log, self.archive)
+
+        # 从本地快照和日志读取数据
+        self.store = open_store(filename, self.config)
+        self.data = self.store.data
+
+        # 定期保存数据快照，用于重建历史某一时刻的数据
+        self.snapshots = StateSnapshots(snapshot_directory, self.audit_log, self.config['snapshot_interval_hours'])
+        if self.snapshots.due():
+            self.snapshots.take(self.store.copy_records)
+
+        # 库存统计，随每次修改增量更新
+        self.stats = InventoryStats(stats_filename, self.audit_log)
+        self.stats.load(self.data)
+
+        self.webdav_sync = WebDAVSync(filename, self.config['webdav_delta_threshold'],
+                                      self.config['webdav_transfer_format'],
+                                      self.config['webdav_compact_threshold'])
+        self.sync_worker = None
+        if background:
+            self.sync_worker = SyncWorker(self.webdav_sync, pull_interval=self.config['webdav_pull_interval'])
+
+    def close(self):
+        # 尽量把未上传的修改同步完，再关闭事件日志和存储
+        if self.sync_worker is not None:
+            self.sync_worker.wait_idle(timeout=5)
+        self.snapshots.close()
+        self.stats.save()
+        self.audit_log.close()
+        self.archive.close()
+        self.store.close()
+        release_lock_file(self.lock_file)
+
+    # 查询
+
+    def lookup(self, barcode):
+        """返回 (药品名称, [追溯码])，条形码不存在时返回 None"""
+        record = self.data.get(barcode)
+        if record is None:
+            return None
+        return record[0], list(record.codes())
+
+    def medication_names(self):
+        """返回 {条形码: 药品名称}，不解析追溯码"""
+        return dict(iter_medications(self.data))
+
+    def summary(self, barcode):
+        """返回 (药品名称, 在库追溯码数)，优先取库存统计，不必解析记录"""
+        item = self.stats.items.get(barcode)
+        if item is not None:
+            return item[0], item[1]
+        record = self.data[barcode]
+        return record[0], len(record) - 1
+
+    def lookup_at(self, barcode, when):
+        """某一时刻该条形码的 (药品名称, [追溯码])，当时不存在时返回 None；when 同 state_at"""
+        self.check_reconstructable(when)
+        record = self.snapshots.reconstruct(when, barcode).get(barcode)
+        if record is None:
+            return None
+        return record[0], list(record.codes())
+
+    def state_at(self, when):
+        """重建某一时刻的全部数据 {条形码: MedicationRecord}
+
+        when 为 datetime 或 'YYYY-MM-DD[ HH:MM:SS]'，只有日期时取当天结束。
+        """
+        self.check_reconstructable(when)
+        return self.snapshots.reconstruct(when)
+
+    def check_reconstructable(self, when):
+        # 归档期限之前的事件已移出事件日志，无法重放
+        horizon = self.archive.state.get('horizon')
+        if horizon is not None and audit_time(when, end=True) < horizon:
+            raise ValueError(f"{horizon} 之前的记录已归档，无法重建该时刻的数据。")
+
+    def search(self, term):
+        """按药品名称（支持拼音）搜索，返回匹配的条形码"""
+        if self.search_index is None:
+            self.search_index = MedicationSearchIndex(self.data)
+        return self.search_index.search(term)
+
+    def seen_before(self, traceability):
+        # 检查该追溯码是否添加过（查索引，不再扫描日志）
+        return traceability in self.trace_index
+
+    def last_seen(self, traceability):
+        # 追溯码最近一次添加的时间，没有记录时返回 None
+        return self.trace_index.last_seen(traceability)
+
+    def find_traceability_owner(self, traceability, barcode=None):
+        """返回当前持有该追溯码的条形码；只查给出的条形码和索引（含归档）记录的条形码，都没有即不在库"""
+        for candidate in (barcode, self.trace_index.barcode_of(traceability)):
+            if candidate in self.data and traceability in self.data[candidate]:
+                return candidate
+        return None
+
+    # 修改
+
+    def check_new_traceability(self, barcode, traceability, allow_seen_before=True):
+        """校验要添加到该条形码下的追溯码，不通过时抛出 ValueError"""
+        if not is_valid_traceability(traceability):
+            raise ValueError(f"追溯码必须是20位数字：{traceability}")
+        if barcode in self.data and traceability in self.data[barcode]:
+            raise ValueError(f"该追溯码已存在，不能添加重复的追溯码：{traceability}")
+        if not allow_seen_before and self.seen_before(traceability):
+            raise ValueError(f"该追溯码已于 {self.last_seen(traceability)} 添加过：{traceability}")
+
+    @serialized
+    def create(self, barcode, medication, traceability, allow_seen_before=True):
+        """新建药品记录并添加第一个追溯码，返回写入日志的内容"""
+        if not is_valid_barcode(barcode):
+            raise ValueError("条形码必须是13位数字。")
+        if barcode in self.data:
+            raise ValueError(f"条形码 {barcode} 已存在。")
+        if not medication:
+            raise ValueError("请输入药品名称。")
+        self.check_new_traceability(barcode, traceability, allow_seen_before)
+        return self.commit_operations([('CREATE', barcode, traceability, medication)])
+
+    @serialized
+    def add(self, barcode, traceabilities, allow_seen_before=True):
+        """把一批追溯码添加到已有的条形码下，全部校验通过才提交；返回写入日志的内容"""
+        if barcode not in self.data:
+            raise ValueError(f"未找到条形码 {barcode}，请先创建记录。")
+        traceabilities = list(dict.fromkeys(traceabilities))
+        for traceability in traceabilities:
+            self.check_new_traceability(barcode, traceability, allow_seen_before)
+        return self.commit_operations([('ADD', barcode, traceability, None) for traceability in traceabilities])
+
+    @serialized
+    def delete(self, barcode, traceabilities):
+        """删除该条形码下的一批追溯码，全部存在才提交；返回写入日志的内容"""
+        if barcode not in self.data:
+            raise ValueError(f"未找到条形码 {barcode}。")
+        traceabilities = list(dict.fromkeys(traceabilities))
+        for traceability in traceabilities:
+            if traceability not in self.data[barcode]:
+                raise ValueError(f"条形码 {barcode} 下没有追溯码 {traceability}。")
+        return self.commit_operations([('DELETE', barcode, traceability, None) for traceability in traceabilities])
+
+    @serialized
+    def commit_sales(self, events):
+        """删除售出的追溯码 [(条形码或None, 追溯码)]：一批事件只写一次存储和日志，返回执行的删除"""
+        operations = []
+        sold = set()
+        not_found = []
+        for barcode, traceability in events:
+            if traceability in sold:
+                continue  # 同一追溯码重复推送
+            owner = self.find_traceability_owner(traceability, barcode)
+            if owner is None:
+                not_found.append(traceability)
+                continue
+            sold.add(traceability)
+            operations.append(('DELETE', owner, traceability, None))
+        if operations:
+            self.commit_operations(operations)
+        if not_found:
+            logging.warning(f"Sales: {len(not_found)} traceability codes not found: {', '.join(not_found[:10])}")
+        return operations
+
+    @serialized
+    def commit_operations(self, operations, echo=True):
+        """批量提交修改：存储写一次、日志写一次，再交给 WebDAV 同步；返回写入日志的内容
+
+        echo=False 时修改记录只写入日志文件，不输出到控制台（批量导入）。
+        """
+        self.store.apply_batch(operations)
+        message = self.log_events([(action, barcode, medication or self.data[barcode][0], traceability)
+                                   for action, barcode, traceability, medication in operations], echo)
+        self.sync_operations(operations)
+        return message
+
+    def log_events(self, events, echo=True):
+        """记录一批修改 (action, barcode, medication, traceability)：日志只写一次，索引一次更新"""
+        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        messages = []
+        index_entries = []
+        for action, barcode, medication, traceability in events:
+            message = f"{timestamp} - {action} - Barcode: {barcode}, Medication: {medication}"
+            if traceability:
+                message += f", Traceability: {traceability}"
+                if action in ('ADD', 'CREATE'):
+                    index_entries.append((traceability, timestamp, barcode))
+            if action == 'CREATE' and self.search_index is not None:
+                self.search_index.add(barcode, medication)
+            messages.append(message)
+        message = '\n'.join(messages)
+        logging.info(message, extra={'console': echo})
+        audit_events = [(timestamp, action, barcode, medication, traceability)
+                        for action, barcode, medication, traceability in events]
+        self.audit_log.write_many(audit_events)
+        self.trace_index.record_many(index_entries)
+        self.stats.record(audit_events, self.data)
+        if self.snapshots.due():
+            self.snapshots.take(self.store.copy_records)
+        return message
+
+    # 归档
+
+    def archive_if_due(self):
+        """每天第一次调用时执行归档，返回 archive_cold_data 的结果；未启用或今天已归档时返回 None"""
+        if not self.config['archive_after_days'] or \
+                self.archive.state.get('last_run') == datetime.date.today().isoformat():
+            return None
+        return self.archive_cold_data()
+
+    @timed('archive.run')
+    @serialized
+    def archive_cold_data(self, now=None):
+        """把早于 archive_after_days 的冷数据移入归档，返回 {events, index_entries}
+
+        事件日志中整天都早于期限的分段整体移入归档后删除；最近添加早于期限、已不在库的
+        追溯码从追溯码索引移入归档（SEEN）。仍在库的追溯码留在索引中，数据本身不做修改，
+        也不产生需要同步的操作。
+        """
+        now = now or datetime.datetime.now()
+        horizon = (now - datetime.timedelta(days=self.config['archive_after_days'])).strftime("%Y-%m-%d %H:%M:%S")
+        result = {'events': 0, 'index_entries': 0}
+
+        writing = self.audit_log.segment if self.audit_log.file is not None else None
+        segments = [segment for segment in self.audit_log.segments()
+                    if segment[7:15] < horizon[:10].replace('-', '') and segment != writing]
+        for segment in segments:
+            events = list(self.audit_log.iter_events([segment]))
+            self.archive.append(events)
+            result['events'] += len(events)
+        self.audit_log.drop_segments(segments)
+
+        records = []
+        for traceability, first, last, barcode in self.trace_index.older_than(horizon):
+            record = self.data.get(barcode)
+            if record is not None and traceability in record:
+                continue  # 仍在库，售出时还要按索引找到它
+            records.append({'time': last, 'action': 'SEEN', 'barcode': barcode,
+                            'medication': record[0] if record is not None else None,
+                            'traceability': traceability, 'first': first})
+        # 先写归档再移出，中途失败时最多在归档中留下重复记录
+        self.archive.append(records)
+        self.trace_index.remove([record['traceability'] for record in records])
+        self.snapshots.prune(horizon)
+        self.stats.save()  # 统计记下的事件日志位置可能在已删除的分段中
+        result['index_entries'] = len(records)
+
+        self.archive.state['last_run'] = now.date().isoformat()
+        self.archive.state['horizon'] = max(self.archive.state.get('horizon') or '', horizon[:10] + ' 00:00:00')
+        self.archive.save_state()
+        logging.info(f"Archived {result['events']} events and {result['index_entries']} index entries "
+                     f"older than {horizon}.")
+        return result
+
+    # 批量导入导出
+
+    def import_file(self, filename, progress=None):
+        """在当前线程导入 CSV/JSONL 文件，逐块查重提交；返回统计信息
+
+        可在后台线程调用：每块的查重和提交在 write_lock 内，块与块之间界面线程可以修改。
+        progress(已读字节, 总字节, 统计信息) 在每块提交后调用。
+        """
+        total_size = os.path.getsize(filename)
+        stats = {'imported': 0, 'duplicates': 0, 'seen_before': 0, 'error_count': 0, 'errors': []}
+        for bytes_read, rows, errors in iter_import_chunks(filename):
+            for line_number, error in errors:
+                add_import_error(stats, line_number, error)
+            with self.write_lock:
+                operations = plan_import(self.data, self.trace_index, rows, stats)
+                if operations:
+                    self.commit_operations(operations, echo=False)
+            if progress is not None:
+                progress(bytes_read, total_size, stats)
+        logging.info(format_import_summary(stats))
+        return stats
+
+    def export(self, filename, progress=None):
+        # 导出全部记录，返回导出的追溯码数量；按存储开始读取时的状态逐条写出，可在后台线程调用
+        with self.store.lock:
+            total = len(self.data)
+        return export_data(self.store.iter_records(), filename, progress, total)
+
+    # WebDAV 同步
+
+    def sync_operations(self, operations):
+        # 本地修改已由存储引擎持久化；先写入待上传队列，离线时留到下次连接再上传
+        if not operations:
+            return
+        self.webdav_sync.record(operations)
+        if self.webdav_connected and not self.webdav_checking:
+            self.push_outbox(operations)
+
+    def push_outbox(self, operations):
+        # 上传待上传队列；后台线程上传时 operations 只用于计数
+        if self.sync_worker is not None:
+            for operation in operations:
+                self.sync_worker.submit(*operation)
+        elif self.webdav_sync.push():
+            self.webdav_sync.acknowledge(self.webdav_sync.state.get('pushed', 0))
+        else:
+            # 前台上传失败时不再重试，修改留在待上传队列中，下次连接时上传
+            self.webdav_connected = False
+
+    def check_webdav(self):
+        """在当前线程检查WebDAV连接并合并远端修改，返回可能变化的条形码"""
+        self.webdav_checking = True
+        return self.on_webdav_checked(*self.webdav_sync.check())
+
+    @serialized
+    def on_webdav_checked(self, connected, remote_data, changes):
+        """连接检查完成：合并远端数据，再补上未上传的本地修改并上传；返回可能变化的条形码"""
+        self.webdav_checking = False
+        self.webdav_connected = connected
+        changed = set()
+        if remote_data is not None:
+            # 新基线可能已经过其他终端合并，未确认上传的本地修改重放在它上面
+            for action, barcode, traceability, medication in self.webdav_sync.pending_operations():
+                if action == 'CREATE' and barcode in remote_data:
+                    action = 'ADD'  # 记录已在基线中，不能清掉其他终端之后添加的追溯码
+                apply_operation(remote_data, action, barcode, traceability, medication)
+            self.store.replace(remote_data)
+            self.search_index = None
+            changed = set(self.data)
+            self.index_replaced_codes()
+            self.stats.refresh(self.data, changed | set(self.stats.items))
+            self.stats.save()
+            self.snapshots.take(self.store.copy_records)  # 整体替换没有写入事件日志，重放无法得到，需要新快照
+        elif changes:
+            changed = self.apply_remote_changes(changes)
+        unpushed = self.webdav_sync.unpushed_operations()
+        if connected and unpushed:
+            self.push_outbox(unpushed)
+        if self.sync_worker is not None:
+            if connected:
+                self.sync_worker.pull_enabled.set()
+            else:
+                self.sync_worker.pull_enabled.clear()
+        return changed
+
+    def index_replaced_codes(self):
+        # 整体替换带来的追溯码没有经过 log_events，补记到追溯码索引，按追溯码查找持有者时只需查索引
+        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.trace_index.record_many([(traceability, timestamp, barcode) for barcode, record in self.data.items()
+                                      for traceability in record.codes()
+                                      if self.trace_index.barcode_of(traceability) != barcode])
+
+    @serialized
+    def apply_remote_changes(self, changes, local_operations=()):
+        """合并其他终端的修改，返回变化的条形码；本终端尚未上传的追溯码以本地为准，上传后在远端同样胜出"""
+        local_codes = {operation[2] for operation in local_operations}
+        local_codes.update(operation[2] for operation in self.webdav_sync.pending_operations())
+        operations = []
+        names = {}  # 本批 CREATE 带来的药品名称，包括因追溯码冲突而跳过的
+        created = set()
+        for action, barcode, traceability, medication in changes:
+            if action == 'CREATE':
+                names[barcode] = medication
+            if traceability in local_codes:
+                continue
+            exists = barcode in self.data or barcode in created
+            if action == 'CREATE' and exists:
+                action = 'ADD'
+            elif action != 'CREATE' and not exists:
+                # 本地没有该条形码（建立它的 CREATE 被跳过）：删除无须执行，添加时按 CREATE 建立记录
+                if action == 'DELETE' or barcode not in names:
+                    continue
+                action, medication = 'CREATE', names[barcode]
+            if action == 'CREATE':
+                created.add(barcode)
+            operations.append((action, barcode, traceability, medication))
+        if not operations:
+            return set()
+        self.store.apply_batch(operations)
+        self.log_events([(action, barcode, medication or self.data[barcode][0], traceability)
+                         for action, barcode, traceability, medication in operations])
+        logging.info(f"Merged {len(operations)} changes from other terminals.")
+        return {barcode for _, barcode, _, _ in operations}
+
+    def reset_webdav(self):
+        # 更换服务器后之前的连接状态和缓存都不再可信
+        reset_webdav_client()
+        if self.sync_worker is not None:
+            self.sync_worker.pull_enabled.clear()
+        self.webdav_sync.reset()
+        self.webdav_connected = False
@@ -0,0 +1,265 @@
+"""追溯码标签页批量生成：每页排列多个 Code128 条形码，输出 PDF 或 PNG
+
+渲染分散到多个进程，每次只有少数几页在内存中，生成好的页按顺序直接写入文件。
+PDF 中条形码为矢量矩形，下方印有追溯码数字；PNG 为 1 位黑白图像（不含数字），
+每页一个文件（<文件名>-001.png、<文件名>-002.png ...）。
+
+    from traceability_labels import generate_label_sheets
+    generate_label_sheets(codes, 'labels.pdf')
+"""
+import collections
+import itertools
+import os
+import struct
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+MM_PER_INCH = 25.4
+POINTS_PER_MM = 72 / MM_PER_INCH
+PNG_DPI = 300
+QUIET_ZONE_MODULES = 10  # 条形码左右至少留白的模块数
+MAX_MODULE_WIDTH_MM = 0.4  # 标签较宽时条形码也不再放大
+TEXT_SIZE_PT = 8
+
+
+class LabelLayout:
+    """标签页排版：纸张尺寸和页边距（毫米），每页的行列数"""
+
+    def __init__(self, page_width=210, page_height=297, columns=3, rows=8, margin=10):
+        self.page_width = page_width
+        self.page_height = page_height
+        self.columns = columns
+        self.rows = rows
+        self.margin = margin
+
+    @property
+    def per_page(self):
+        return self.columns * self.rows
+
+    def cells(self, count):
+        """前 count 个标签的位置 (左, 上, 宽, 高)，单位毫米，从左上角按行排列"""
+        width = (self.page_width - 2 * self.margin) / self.columns
+        height = (self.page_height - 2 * self.margin) / self.rows
+        return [(self.margin + (index % self.columns) * width, self.margin + (index // self.columns) * height,
+                 width, height) for index in range(count)]
+
+
+def code128_modules(code):
+    # 条形码的模块串（'1' 为黑条），不含留白
+    from barcode import Code128
+    return Code128(code).build()[0]
+
+
+def bar_runs(modules):
+    """把模块串合并成连续黑条 [(起始模块, 模块数)]"""
+    runs = []
+    start = None
+    for position, module in enumerate(modules + '0'):
+        if module == '1' and start is None:
+            start = position
+        elif module != '1' and start is not None:
+            runs.append((start, position - start))
+            start = None
+    return runs
+
+
+def pdf_text(code):
+    return code.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+
+def render_pdf_page(layout, codes):
+    """一页的 PDF 内容流（已压缩）"""
+    page_height = layout.page_height * POINTS_PER_MM
+    commands = ['0 g']
+    for code, (left, top, width, height) in zip(codes, layout.cells(len(codes))):
+        modules = code128_modules(code)
+        module_width = min(MAX_MODULE_WIDTH_MM, width / (len(modules) + 2 * QUIET_ZONE_MODULES)) * POINTS_PER_MM
+        bar_height = height * 0.55 * POINTS_PER_MM
+        x = (left + width / 2) * POINTS_PER_MM - len(modules) * module_width / 2
+        y = page_height - (top + height * 0.15) * POINTS_PER_MM - bar_height
+        for start, length in bar_runs(modules):
+            commands.append(f"{x + start * module_width:.2f} {y:.2f} {length * module_width:.2f} {bar_height:.2f} re")
+        commands.append('f')
+        text_width = len(code) * 0.556 * TEXT_SIZE_PT  # Helvetica 数字宽度
+        commands.append(f"BT /F1 {TEXT_SIZE_PT} Tf {(left + width / 2) * POINTS_PER_MM - text_width / 2:.2f} "
+                        f"{y - TEXT_SIZE_PT * 1.3:.2f} Td ({pdf_text(code)}) Tj ET")
+    return zlib.compress('\n'.join(commands).encode('latin-1'))
+
+
+def render_png_page(layout, codes):
+    """一页的 PNG 文件内容（1 位黑白）"""
+    scale = PNG_DPI / MM_PER_INCH
+    width = round(layout.page_width * scale)
+    height = round(layout.page_height * scale)
+    white = bytearray(b'\x01') * width
+    bands = collections.defaultdict(lambda: bytearray(white))  # 每种条高范围的一行像素
+    for code, (left, top, cell_width, cell_height) in zip(codes, layout.cells(len(codes))):
+        modules = code128_modules(code)
+        module_width = max(1, int(min(MAX_MODULE_WIDTH_MM, cell_width / (len(modules) + 2 * QUIET_ZONE_MODULES))
+                                  * scale))
+        x = round((left + cell_width / 2) * scale) - len(modules) * module_width // 2
+        band = bands[(round((top + cell_height * 0.15) * scale), round((top + cell_height * 0.7) * scale))]
+        for start, length in bar_runs(modules):
+            band[x + start * module_width:x + (start + length) * module_width] = bytes(length * module_width)
+    padding = b'1' * (-width % 8)
+    packed_white = pack_png_row(white, padding)
+    rows = [packed_white] * height
+    for (band_top, band_bottom), band in bands.items():
+        packed = pack_png_row(band, padding)
+        for y in range(band_top, min(band_bottom, height)):
+            rows[y] = packed
+    raw = b''.join(b'\x00' + row for row in rows)
+    return (b'\x89PNG\r\n\x1a\n'
+            + png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 1, 0, 0, 0, 0))
+            + png_chunk(b'pHYs', struct.pack('>IIB', round(PNG_DPI / 0.0254), round(PNG_DPI / 0.0254), 1))
+            + png_chunk(b'IDAT', zlib.compress(raw, 9))
+            + png_chunk(b'IEND', b''))
+
+
+def pack_png_row(pixels, padding):
+    # 每像素一个字节（0 黑 1 白）压成每像素一位
+    bits = pixels.translate(bytes.maketrans(b'\x00\x01', b'01')) + padding
+    return int(bits, 2).to_bytes(len(bits) // 8, 'big')
+
+
+def png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+
+def render_page(page_format, layout, codes):
+    # 在工作进程中执行，只传入排版和本页的追溯码
+    if page_format == 'pdf':
+        return render_pdf_page(layout, codes)
+    return render_png_page(layout, codes)
+
+
+class PDFSheetWriter:
+    """逐页写入 PDF：页面内容生成后立即落盘，最后补上页面树和交叉引用表"""
+
+    format = 'pdf'
+
+    def __init__(self, filename, layout):
+        self.filename = filename
+        self.layout = layout
+        self.file = open(filename, 'wb')
+        self.offsets = {}
+        self.pages = []
+        self.next_object = 4  # 1 目录、2 页面树、3 字体在最后写入
+        self.file.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def write_object(self, number, body):
+        self.offsets[number] = self.file.tell()
+        self.file.write(f"{number} 0 obj\n".encode('ascii') + body + b"\nendobj\n")
+
+    def add_page(self, content):
+        content_number, page_number = self.next_object, self.next_object + 1
+        self.next_object += 2
+        self.write_object(content_number, f"<< /Length {len(content)} /Filter /FlateDecode >>\nstream\n"
+                          .encode('ascii') + content + b"\nendstream")
+        width = self.layout.page_width * POINTS_PER_MM
+        height = self.layout.page_height * POINTS_PER_MM
+        self.write_object(page_number, (f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {width:.2f} {height:.2f}] "
+                                        f"/Resources << /Font << /F1 3 0 R >> >> /Contents {content_number} 0 R >>")
+                          .encode('ascii'))
+        self.pages.append(page_number)
+
+    def close(self):
+        self.write_object(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+        kids = ' '.join(f"{number} 0 R" for number in self.pages)
+        self.write_object(2, f"<< /Type /Pages /Kids [{kids}] /Count {len(self.pages)} >>".encode('ascii'))
+        self.write_object(3, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+        xref = self.file.tell()
+        lines = [f"xref\n0 {self.next_object}\n", "0000000000 65535 f \n"]
+        for number in range(1, self.next_object):
+            lines.append(f"{self.offsets[number]:010d} 00000 n \n")
+        lines.append(f"trailer\n<< /Size {self.next_object} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n")
+        self.file.write(''.join(lines).encode('ascii'))
+        self.file.close()
+        return [self.filename]
+
+    def abort(self):
+        # 生成失败时删除不完整的文件
+        self.file.close()
+        os.remove(self.filename)
+
+
+class PNGSheetWriter:
+    """每页写成一个 PNG 文件：<文件名>-001.png、<文件名>-002.png ..."""
+
+    format = 'png'
+
+    def __init__(self, filename, layout):
+        self.base = filename[:-4] if filename.lower().endswith('.png') else filename
+        self.filenames = []
+
+    def add_page(self, content):
+        filename = f"{self.base}-{len(self.filenames) + 1:03d}.png"
+        with open(filename, 'wb') as file:
+            file.write(content)
+        self.filenames.append(filename)
+
+    def close(self):
+        return self.filenames
+
+    def abort(self):
+        for filename in self.filenames:
+            os.remove(filename)
+
+
+def iter_pages(codes, per_page):
+    page = []
+    for code in codes:
+        if not code or not code.isascii():
+            raise ValueError(f"Code128 只能编码 ASCII 字符：{code!r}")
+        page.append(code)
+        if len(page) == per_page:
+            yield page
+            page = []
+    if page:
+        yield page
+
+
+def generate_label_sheets(codes, filename, layout=None, workers=None, progress=None):
+    """把追溯码排成标签页写入 PDF（.pdf）或 PNG 文件，返回生成的文件列表
+
+    codes 可以是任意可迭代对象，按页读取；workers 为渲染进程数，默认按 CPU 数，
+    为 1 或只有一页时在当前进程渲染。progress(已完成的标签数) 在每页写完后调用。
+    """
+    layout = layout or LabelLayout()
+    writer_class = PDFSheetWriter if filename.lower().endswith('.pdf') else PNGSheetWriter
+    writer = writer_class(filename, layout)
+    workers = workers or os.cpu_count() or 1
+    pages = iter_pages(codes, layout.per_page)
+    first_pages = list(itertools.islice(pages, 2))
+    pages = itertools.chain(first_pages, pages)
+    done = 0
+    try:
+        if workers == 1 or len(first_pages) < 2:
+            for page in pages:
+                writer.add_page(render_page(writer.format, layout, page))
+                done += len(page)
+                if progress is not None:
+                    progress(done)
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                # 最多预先提交 2 倍进程数的页，按提交顺序取回写入
+                pending = collections.deque()
+                for page in pages:
+                    if len(pending) >= workers * 2:
+                        done = write_next_page(writer, pending, done, progress)
+                    pending.append((len(page), executor.submit(render_page, writer.format, layout, page)))
+                while pending:
+                    done = write_next_page(writer, pending, done, progress)
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.close()
+
+
+def write_next_page(writer, pending, done, progress):
+    count, future = pending.popleft()
+    writer.add_page(future.result())
+    done += count
+    if progress is not None:
+        progress(done)
+    return done